@@ -0,0 +1,51 @@
+# Codec benchmark: encode/decode throughput of peer messages, JSON + base64 framing against the binary codec
+#   python benchmarks/bench_codec.py [--seconds 0.5]
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'bittorrent'))
+
+from components.codec import encode_message, decode_message, CODEC_JSON, CODEC_BINARY
+
+
+def piece_message(size):
+    return {'type': "Piece", 'len': 9 + size, 'id': 7, 'file': 'bench.bin', 'index': 42, 'piece': os.urandom(size)}
+
+
+def bitfield_message(pieces):
+    return {'type': "Bitfield", 'len': 2, 'id': 5, 'bitfield': {'bench.bin': [1, 0] * (pieces // 2)}}
+
+
+def measure(fn, arg, seconds):
+    n = 0
+    start = time.perf_counter()
+    while True:
+        fn(arg)
+        n += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return n / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Codec benchmark')
+    parser.add_argument('--seconds', type=float, default=0.5, help='Time spent on each measurement')
+    args = parser.parse_args()
+
+    cases = [(f'Piece {size // 1024} KiB', piece_message(size), size) for size in [4096, 16384, 262144, 1048576]]
+    cases.append(('Bitfield 100k pieces', bitfield_message(100000), 100000 // 8))
+
+    print(f'{"message":<22}{"codec":<8}{"wire bytes":>12}{"encode MB/s":>14}{"decode MB/s":>14}')
+    for name, message, payload in cases:
+        for codec in [CODEC_JSON, CODEC_BINARY]:
+            package = encode_message(message, codec)
+            encode_rate = measure(lambda m: encode_message(m, codec), message, args.seconds)
+            decode_rate = measure(decode_message, package, args.seconds)
+            print(f'{name:<22}{codec:<8}{len(package):>12}'
+                  f'{encode_rate * payload / 1e6:>14.1f}{decode_rate * payload / 1e6:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+# Networking engine benchmark: many concurrent peer connections ping-ponging keep-alives, thread model against asyncio
+#   python benchmarks/bench_engine.py [--connections 100 1000] [--rounds 20]
+# Every (engine, connections) case runs in its own process, so threads, memory and CPU time are measured in isolation.
+import os
+import sys
+import json
+import time
+import socket
+import resource
+import argparse
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'bittorrent'))
+
+from components import ENGINES
+from components.client import KEEP_ALIVE
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def worker(engine, connections, rounds):
+    server_cls, _, connection_cls = ENGINES[engine]
+    port = free_port()
+    done = threading.Semaphore(0)
+    peak_threads = [threading.active_count()]
+
+    def serve_server(peer_id, message, connectionSocket, states):
+        return [], False
+
+    def serve_client(peer_id, message, connectionSocket, states):
+        states['rounds'] += 1
+        return [], states['rounds'] >= rounds
+
+    def connected(message, connectionSocket):
+        connection = connection_cls(message['peer_id'], recv_fn=serve_server, states={'duplex': False})
+        connection.set_server(KEEP_ALIVE, socket=connectionSocket)
+        connection.start()
+        return None
+
+    def closed(peer_id, states):
+        done.release()
+
+    server = server_cls('127.0.0.1', port, connected)
+    server.start()
+
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    clients = []
+    for i in range(connections):
+        connection = connection_cls(f'client-{i}', '127.0.0.1', port, recv_fn=serve_client,
+                                    states={'duplex': False, 'rounds': 0}, close_fn=closed)
+        connection.set_server({'type': "KeepAlive", 'len': 0, 'peer_id': f'client-{i}'})
+        connection.start()
+        clients.append(connection)
+        peak_threads[0] = max(peak_threads[0], threading.active_count())
+    for _ in range(connections):
+        done.acquire()
+        peak_threads[0] = max(peak_threads[0], threading.active_count())
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+
+    return {
+        'engine': engine,
+        'connections': connections,
+        'rounds': rounds,
+        'seconds': elapsed,
+        'cpu_seconds': cpu,
+        'messages_per_second': 2 * connections * rounds / elapsed,
+        'peak_threads': peak_threads[0],
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Networking engine benchmark')
+    parser.add_argument('--connections', type=int, nargs='+', default=[100, 1000], help='Concurrent connections')
+    parser.add_argument('--rounds', type=int, default=20, help='Keep-alive round trips per connection')
+    parser.add_argument('--engines', type=str, nargs='+', default=list(ENGINES), help='Engines to compare')
+    parser.add_argument('--timeout', type=float, default=300, help='Seconds before a case is given up')
+    parser.add_argument('--worker', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        result = worker(args.worker, args.connections[0], args.rounds)
+        print(json.dumps(result), flush=True)
+        os._exit(0)
+
+    print(f'{"engine":<10}{"conns":>7}{"seconds":>10}{"cpu s":>9}{"msgs/s":>11}{"threads":>9}{"RSS MB":>9}')
+    for connections in args.connections:
+        for engine in args.engines:
+            cmd = [sys.executable, os.path.abspath(__file__), '--worker', engine,
+                   '--connections', str(connections), '--rounds', str(args.rounds)]
+            try:
+                out = subprocess.run(cmd, capture_output=True, text=True, timeout=args.timeout).stdout
+                r = json.loads(out.strip().splitlines()[-1])
+            except (subprocess.TimeoutExpired, IndexError, ValueError):
+                print(f'{engine:<10}{connections:>7}{"failed or timed out":>55}')
+                continue
+            print(f'{engine:<10}{connections:>7}{r["seconds"]:>10.2f}{r["cpu_seconds"]:>9.2f}'
+                  f'{r["messages_per_second"]:>11.0f}{r["peak_threads"]:>9}{r["max_rss_mb"]:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# Hashing benchmark: piece digests of one file, serial against the thread and process pools at growing worker counts
+#   python benchmarks/bench_hash.py [--size-mb 512] [--piece-len 262144] [--workers 1 2 4 8]
+# The serial pass runs first and warms the page cache, so the cases after it measure the hashing rather than the disk.
+import os
+import sys
+import time
+import hashlib
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'bittorrent'))
+
+from torrent import hash_file, HASH_WORKERS
+
+
+def hash_serial(file_name, piece_len):
+    # the loop `Torrent.make_torrent` used to run
+    digests = []
+    with open(file_name, 'rb') as f:
+        while True:
+            piece = f.read(piece_len)
+            if not piece:
+                break
+            digests.append(hashlib.sha1(piece).digest())
+    return digests
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hashing benchmark')
+    parser.add_argument('--size-mb', type=int, default=512, help='Size of the file hashed')
+    parser.add_argument('--piece-len', type=int, default=256 * 1024, help='Piece length')
+    parser.add_argument('--workers', type=int, nargs='+', default=None, help='Worker counts, powers of two up to the cores if not given')
+    parser.add_argument('--modes', type=str, nargs='+', default=['thread', 'process'], help='Pools to compare')
+    parser.add_argument('--file', type=str, default=None, help='Hash this file instead of a temporary one')
+    args = parser.parse_args()
+
+    workers = args.workers
+    if workers is None:
+        workers = [1]
+        while workers[-1] * 2 <= HASH_WORKERS:
+            workers.append(workers[-1] * 2)
+        if workers[-1] != HASH_WORKERS:
+            workers.append(HASH_WORKERS)
+
+    file_name = args.file
+    if file_name is None:
+        fd, file_name = tempfile.mkstemp(suffix='.bin')
+        with os.fdopen(fd, 'wb') as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(1024 * 1024))
+    size = os.path.getsize(file_name)
+
+    try:
+        start = time.perf_counter()
+        reference = hash_serial(file_name, args.piece_len)
+        serial = time.perf_counter() - start
+        print(f'{size / 2 ** 20:.0f} MiB, {len(reference)} pieces of {args.piece_len} bytes, {HASH_WORKERS} usable cores')
+        print(f'{"mode":<10}{"workers":>8}{"seconds":>10}{"MiB/s":>10}{"speedup":>9}')
+        print(f'{"serial":<10}{1:>8}{serial:>10.2f}{size / 2 ** 20 / serial:>10.0f}{1:>9.2f}')
+        for mode in args.modes:
+            for n in workers:
+                start = time.perf_counter()
+                digests = hash_file(file_name, args.piece_len, workers=n, mode=mode)
+                elapsed = time.perf_counter() - start
+                if digests != reference:
+                    raise RuntimeError(f'{mode} hashing with {n} workers differs from the serial digests')
+                print(f'{mode:<10}{n:>8}{elapsed:>10.2f}{size / 2 ** 20 / elapsed:>10.0f}{serial / elapsed:>9.2f}')
+    finally:
+        if args.file is None:
+            os.remove(file_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+# Piece picker benchmark: availability updates and rarest-first picks over a large swarm, against the sorted lists it replaced
+#   python benchmarks/bench_picker.py [--pieces 1000000] [--peers 1000] [--ops 100000] [--bitfield-ops 10] [--legacy-ops 20]
+import os
+import sys
+import time
+import random
+import bisect
+import argparse
+import bitarray
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'bittorrent'))
+
+from picker import PiecePicker
+
+FILE = 'file'
+
+
+class LegacyPicker:
+    # the parallel sorted lists `PieceManager` used to keep, for comparison
+    def __init__(self, counts):
+        self.count = {FILE: counts}
+        self.required_pieces = []
+        self.required_pieces_count = []
+
+    def require(self, file, index):
+        if (file, index) in self.required_pieces:
+            idx = self.required_pieces.index((file, index))
+            self.required_pieces.pop(idx)
+            self.required_pieces_count.pop(idx)
+        idx = bisect.bisect_left(self.required_pieces_count, self.count[file][index])
+        self.required_pieces_count.insert(idx, self.count[file][index])
+        self.required_pieces.insert(idx, (file, index))
+
+    def update(self, file, index, delta):
+        self.count[file][index] += delta
+        if (file, index) in self.required_pieces:
+            self.require(file, index)
+
+    def pick(self, peer_bitfield):
+        pieces = []
+        for idx, (file, index) in enumerate(self.required_pieces):
+            if peer_bitfield[file][index]:
+                pieces.append((idx, (file, index)))
+                if len(pieces) == 10:
+                    break
+        if not pieces:
+            return None
+        idx, key = random.choice(pieces)
+        self.required_pieces.pop(idx)
+        self.required_pieces_count.pop(idx)
+        return key
+
+
+def timed(fn, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n
+
+
+def report(name, per_op):
+    print(f'{name:<34}{per_op * 1e6:>12.2f} us/op{1 / per_op:>14.0f} ops/s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Piece picker benchmark')
+    parser.add_argument('--pieces', type=int, default=1000000, help='Pieces of the torrent')
+    parser.add_argument('--peers', type=int, default=1000, help='Peers in the swarm')
+    parser.add_argument('--ops', type=int, default=100000, help='Operations timed per case')
+    parser.add_argument('--bitfield-ops', type=int, default=10, help='Peers that leave and come back')
+    parser.add_argument('--legacy-ops', type=int, default=20, help='Operations timed per case of the old lists, 0 to skip')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    args.ops = min(args.ops, args.pieces // 2)  # picks must not run out of required pieces
+
+    print(f'{args.pieces} pieces, {args.peers} peers having each piece with probability 1/2')
+    start = time.perf_counter()
+    peers = []
+    for _ in range(args.peers):
+        bitfield = bitarray.bitarray()
+        bitfield.frombytes(random.randbytes((args.pieces + 7) // 8))
+        del bitfield[args.pieces:]
+        peers.append({FILE: bitfield})
+    print(f'swarm generated in {time.perf_counter() - start:.1f} s')
+
+    picker = PiecePicker()
+    start = time.perf_counter()
+    for peer in peers:
+        picker.update_bitfield(FILE, peer[FILE], 1)
+    report('bitfield of a peer, nothing required', (time.perf_counter() - start) / args.peers)
+    counts = picker.availability[FILE].tolist()
+    start = time.perf_counter()
+    for index in range(args.pieces):
+        picker.require(FILE, index)
+    report('require every piece', (time.perf_counter() - start) / args.pieces)
+    print(f'{len(picker.levels)} availability levels')
+
+    it = iter(random.choices(peers, k=args.bitfield_ops))
+    report('peer leaves and comes back', timed(lambda: [picker.update_bitfield(FILE, bitfield[FILE], delta)
+                                                        for bitfield in [next(it)] for delta in (-1, 1)],
+                                               args.bitfield_ops))
+
+    indices = [random.randrange(args.pieces) for _ in range(args.ops)]
+    it = iter(indices)
+    report('have (availability +1)', timed(lambda: picker.update(FILE, next(it), 1), args.ops))
+
+    picked = []
+    it = iter(random.choices(peers, k=args.ops))
+    report('pick rarest for a peer', timed(lambda: picked.append(picker.pick(next(it))), args.ops))
+    it = iter(picked)
+    report('require again', timed(lambda: picker.require(FILE, next(it)[1]), args.ops))
+    it = iter(random.choices(peers, k=args.ops))
+    report('is interesting', timed(lambda: picker.is_interesting(next(it)), args.ops))
+
+    # a peer that just joined has a piece in a thousand, a pick cannot find its rarest by walking the rarest pieces
+    sparse = []
+    for _ in range(100):
+        bitfield = bitarray.bitarray(args.pieces)
+        bitfield.setall(False)
+        for index in random.sample(range(args.pieces), max(1, args.pieces // 1000)):
+            bitfield[index] = True
+        sparse.append({FILE: bitfield})
+    picked = []
+    it = iter(random.choices(sparse, k=args.ops // 10))
+    report('pick for a peer with few pieces', timed(lambda: picked.append(picker.pick(next(it))), args.ops // 10))
+    for piece in picked:
+        if piece is not None:
+            picker.require(*piece)
+
+    if args.legacy_ops:
+        legacy = LegacyPicker(list(counts))
+        order = sorted(range(args.pieces), key=counts.__getitem__)
+        legacy.required_pieces = [(FILE, index) for index in order]
+        legacy.required_pieces_count = [counts[index] for index in order]
+        start = time.perf_counter()
+        for index in peers[0][FILE].search(1):
+            legacy.count[FILE][index] += 1
+        report('legacy: bitfield, counts only', time.perf_counter() - start)
+        it = iter(indices)
+        report('legacy: have (availability +1)', timed(lambda: legacy.update(FILE, next(it), 1), args.legacy_ops))
+        it = iter(random.choices(peers, k=args.legacy_ops))
+        picked = []
+        report('legacy: pick rarest for a peer', timed(lambda: picked.append(legacy.pick(next(it))), args.legacy_ops))
+        it = iter(picked)
+        report('legacy: require again', timed(lambda: legacy.require(FILE, next(it)[1]), args.legacy_ops))
+
+
+if __name__ == '__main__':
+    main()
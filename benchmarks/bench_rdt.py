@@ -0,0 +1,102 @@
+# rdt_socket benchmark: frame throughput over loopback TCP, arena receive path against the former 1 KiB read loop
+#   python benchmarks/bench_rdt.py [--bytes 64M] [--legacy-max 1M]
+import os
+import sys
+import time
+import struct
+import socket
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'bittorrent'))
+
+from components.rdt_socket import rdt_socket, FILE_HEADER_SIZE
+
+
+class legacy_rdt_socket(rdt_socket):
+    """
+    The receive path before the arena rewrite: 1 KiB reads appended to a `bytes` buffer
+    """
+    def __init__(self, s):
+        super().__init__(s, buffer_size=0)
+        self.databuf = bytes()
+
+    def recvBytes(self):
+        if len(self.databuf) >= FILE_HEADER_SIZE:
+            body_size, = struct.unpack("!1Q", self.databuf[:FILE_HEADER_SIZE])
+            if len(self.databuf) >= FILE_HEADER_SIZE + body_size:
+                body = self.databuf[FILE_HEADER_SIZE:FILE_HEADER_SIZE + body_size]
+                self.databuf = self.databuf[FILE_HEADER_SIZE + body_size:]
+                return body
+        while True:
+            data = self.s.recv(1024)
+            if data:
+                self.databuf += data
+                while True:
+                    if len(self.databuf) < FILE_HEADER_SIZE:
+                        break
+                    body_size, = struct.unpack("!1Q", self.databuf[:FILE_HEADER_SIZE])
+                    if len(self.databuf) < FILE_HEADER_SIZE + body_size:
+                        break
+                    body = self.databuf[FILE_HEADER_SIZE:FILE_HEADER_SIZE + body_size]
+                    self.databuf = self.databuf[FILE_HEADER_SIZE + body_size:]
+                    return body
+
+
+def parse_size(s):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if s[-1].upper() in units:
+        return int(float(s[:-1]) * units[s[-1].upper()])
+    return int(s)
+
+
+def run(cls, frame_size, count):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    sender = socket.create_connection(listener.getsockname())
+    receiver, _ = listener.accept()
+    listener.close()
+
+    frame = os.urandom(frame_size)
+
+    def send():
+        rdt = rdt_socket(sender)
+        for _ in range(count):
+            rdt.sendBytes(frame)
+
+    thread = threading.Thread(target=send)
+    rdt = cls(receiver)
+    start = time.perf_counter()
+    thread.start()
+    for _ in range(count):
+        body = rdt.recvBytes()
+        assert len(body) == frame_size
+    elapsed = time.perf_counter() - start
+    thread.join()
+    sender.close()
+    receiver.close()
+    return frame_size * count / elapsed / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='rdt_socket benchmark')
+    parser.add_argument('--bytes', type=str, default='64M', help='Bytes transferred for each frame size')
+    parser.add_argument('--legacy-max', type=str, default='1M', help='Largest frame measured on the legacy path')
+    args = parser.parse_args()
+
+    total = parse_size(args.bytes)
+    legacy_max = parse_size(args.legacy_max)
+
+    print(f'{"frame":>10}{"frames":>8}{"arena MB/s":>14}{"legacy MB/s":>14}')
+    frame_size = 16 * 1024
+    while frame_size <= 16 * 1024 * 1024:
+        count = max(1, total // frame_size)
+        arena = run(rdt_socket, frame_size, count)
+        legacy = f'{run(legacy_rdt_socket, frame_size, count):.1f}' if frame_size <= legacy_max else 'skipped'
+        print(f'{frame_size // 1024:>7} KiB{count:>8}{arena:>14.1f}{legacy:>14}')
+        frame_size *= 4
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+# Tracker benchmark: announce throughput and latency against swarm size, simulated peers joining, re-announcing and leaving
+#   python benchmarks/bench_tracker.py [--peers 100 1000 10000] [--announces 20000] [--protocol tcp udp] [--output r.json]
+# Every case starts its own tracker process on loopback, so its CPU time is measured apart from the load generator's.
+import os
+import sys
+import json
+import time
+import random
+import socket
+import resource
+import argparse
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'bittorrent'))
+
+from components import ENGINES
+from components.rdt_socket import rdt_socket
+from components.codec import decode_message
+from utils import obj_encode
+from udp_tracker import UdpTrackerClient
+
+
+def free_port():
+    # a port free for TCP and UDP both, the tracker serves the two on the same number
+    while True:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        u = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            u.bind(('127.0.0.1', port))
+            return port
+        except OSError:
+            continue
+        finally:
+            u.close()
+
+
+def usage():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return {'cpu_seconds': r.ru_utime + r.ru_stime, 'max_rss_mb': r.ru_maxrss / 1024}
+
+
+def tracker_worker(engine, udp):
+    """
+    Run a tracker until stdin closes, answering every line on stdin with a JSON line of its resource usage
+    """
+    from tracker import Tracker
+
+    control = sys.stdout
+    sys.stdout = open(os.devnull, 'w')  # the tracker prints its log
+    port = free_port()
+    tracker = Tracker('bench', base_dir=tempfile.mkdtemp(prefix='bench_tracker_'), host='127.0.0.1', port=port,
+                      engine=engine, udp=udp)
+    tracker.start()
+    while not tracker.running or tracker.busy:  # not busy once its servers are started
+        time.sleep(0.01)
+    print(json.dumps({'port': port}), file=control, flush=True)
+    for _ in sys.stdin:
+        print(json.dumps(dict(usage(), cache=tracker.cache_stats.stats())), file=control, flush=True)
+    tracker.stop()
+    tracker.join()
+    os._exit(0)
+
+
+class SimulatedPeer:
+    def __init__(self, i, torrents, size):
+        self.peer_id = f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}:6881'
+        self.ip = self.peer_id.split(':')[0]
+        self.info_hash = f'{i % torrents:040x}'
+        self.size = size
+        self.left = size
+        self.joined = False
+
+    def next_event(self, stop_rate, rng):
+        if not self.joined:
+            return 'started'
+        if rng.random() < stop_rate:
+            return 'stopped'
+        if self.left and rng.random() < 0.1:
+            self.left = 0
+            return 'completed'
+        return ''
+
+
+class TcpAnnouncer:
+    def __init__(self, port, numwant, compact):
+        self.socket = socket.create_connection(('127.0.0.1', port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rdt = rdt_socket(self.socket)
+        self.numwant = numwant
+        self.compact = compact
+
+    def announce(self, peer, event):
+        request = {'event': event, 'peer_id': peer.peer_id, 'ip': peer.ip, 'port': 6881, 'info_hash': peer.info_hash,
+                   'numwant': self.numwant, 'compact': self.compact, 'left': peer.left}
+        self.rdt.sendBytes(obj_encode(request))
+        return decode_message(self.rdt.recvBytes())
+
+    def close(self):
+        self.socket.close()
+
+
+class UdpAnnouncer:
+    def __init__(self, port, numwant, compact):
+        self.client = UdpTrackerClient('127.0.0.1', port, timeout=2.0, retries=2)
+        self.numwant = numwant
+
+    def announce(self, peer, event):
+        return self.client.announce(peer.info_hash, peer.ip, 6881, event=event or None, left=peer.left,
+                                    numwant=self.numwant)
+
+    def close(self):
+        self.client.close()
+
+
+ANNOUNCERS = {'tcp': TcpAnnouncer, 'udp': UdpAnnouncer}
+
+
+def drive(announcers, peers, announces, stop_rate, seed):
+    """
+    Send `announces` announces from the threads of `announcers` at once, each for its own share of `peers`
+    :return: the latencies of every event, the seconds it took and the announces that failed
+    """
+    latencies = {}
+    lock = threading.Lock()
+    remaining = [announces]
+    errors = [0]
+
+    def run(k, announcer):
+        rng = random.Random(seed * 1000003 + k)
+        mine = peers[k::len(announcers)]
+        local = {}
+        failed = 0
+        while mine:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            peer = rng.choice(mine)
+            event = peer.next_event(stop_rate, rng)
+            start = time.perf_counter()
+            try:
+                response = announcer.announce(peer, event)
+            except OSError:
+                response = None
+            local.setdefault(event, []).append(time.perf_counter() - start)
+            if response is None or response.get('error_code'):
+                failed += 1
+            if event == 'stopped':
+                peer.joined, peer.left = False, peer.size
+            elif event == 'started':
+                peer.joined = True
+        with lock:
+            errors[0] += failed
+            for event, values in local.items():
+                latencies.setdefault(event, []).extend(values)
+
+    threads = [threading.Thread(target=run, args=(k, announcer)) for k, announcer in enumerate(announcers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - start, errors[0]
+
+
+def join_all(announcers, peers):
+    def run(k, announcer):
+        for peer in peers[k::len(announcers)]:
+            announcer.announce(peer, 'started')
+            peer.joined = True
+
+    threads = [threading.Thread(target=run, args=(k, announcer)) for k, announcer in enumerate(announcers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))] * 1000 if values else None
+
+
+def run_case(engine, protocol, n_peers, args):
+    cmd = [sys.executable, os.path.abspath(__file__), '--worker', engine]
+    if protocol == 'udp':
+        cmd.append('--worker-udp')
+    tracker = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+
+    def tracker_usage():
+        tracker.stdin.write('usage\n')
+        tracker.stdin.flush()
+        return json.loads(tracker.stdout.readline())
+
+    try:
+        port = json.loads(tracker.stdout.readline())['port']
+        peers = [SimulatedPeer(i, args.torrents, args.size) for i in range(n_peers)]
+        announcers = [ANNOUNCERS[protocol](port, args.numwant, not args.no_compact) for _ in range(args.clients)]
+
+        # every peer joins before the clock starts, so that the swarms are as large as asked for
+        join_all(announcers, peers)
+        before, own_before = tracker_usage(), usage()
+        latencies, elapsed, errors = drive(announcers, peers, args.announces, args.stop_rate, args.seed)
+        after, own_after = tracker_usage(), usage()
+        for announcer in announcers:
+            announcer.close()
+    finally:
+        tracker.stdin.close()
+        tracker.wait(timeout=30)
+
+    every = sorted(value for values in latencies.values() for value in values)
+    return {
+        'engine': engine,
+        'protocol': protocol,
+        'peers': n_peers,
+        'torrents': args.torrents,
+        'clients': args.clients,
+        'numwant': args.numwant,
+        'announces': len(every),
+        'errors': errors,
+        'seconds': elapsed,
+        'announces_per_second': len(every) / elapsed,
+        'p50_ms': percentile(every, 0.5),
+        'p99_ms': percentile(every, 0.99),
+        'events': {event or 'regular': {'count': len(values), 'p50_ms': percentile(sorted(values), 0.5),
+                                        'p99_ms': percentile(sorted(values), 0.99)}
+                   for event, values in latencies.items()},
+        'tracker_cpu_seconds': after['cpu_seconds'] - before['cpu_seconds'],
+        'tracker_cpu_per_announce_us': (after['cpu_seconds'] - before['cpu_seconds']) / max(1, len(every)) * 1e6,
+        'tracker_max_rss_mb': after['max_rss_mb'],
+        'load_cpu_seconds': own_after['cpu_seconds'] - own_before['cpu_seconds'],
+        'cache': cache_delta(before['cache'], after['cache']),
+    }
+
+
+def cache_delta(before, after):
+    hits, misses = after['hits'] - before['hits'], after['misses'] - before['misses']
+    return {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else 0.0}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tracker benchmark')
+    parser.add_argument('--peers', type=int, nargs='+', default=[100, 1000, 10000], help='Simulated peers per case')
+    parser.add_argument('--announces', type=int, default=20000, help='Announces timed per case')
+    parser.add_argument('--clients', type=int, default=8, help='Connections announcing at the same time')
+    parser.add_argument('--torrents', type=int, default=1, help='Swarms the peers are spread over')
+    parser.add_argument('--numwant', type=int, default=50, help='Peers asked for in every announce')
+    parser.add_argument('--stop-rate', type=float, default=0.05, help='Share of announces that leave the swarm')
+    parser.add_argument('--size', type=int, default=1 << 30, help='Bytes left to download by a peer that joins')
+    parser.add_argument('--no-compact', action='store_true', help='Ask for peer dicts rather than compact lists')
+    parser.add_argument('--protocol', type=str, nargs='+', default=['tcp'], choices=list(ANNOUNCERS))
+    parser.add_argument('--engines', type=str, nargs='+', default=['thread'], help='Engines of the tracker')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', type=str, default=None, help='Write the results to this JSON file')
+    parser.add_argument('--worker', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--worker-udp', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        tracker_worker(args.worker, args.worker_udp)
+
+    results = []
+    print(f'{"engine":<9}{"proto":<6}{"peers":>8}{"ann/s":>9}{"p50 ms":>9}{"p99 ms":>9}{"cpu us/ann":>12}'
+          f'{"errors":>8}{"hit rate":>10}')
+    for n_peers in args.peers:
+        for protocol in args.protocol:
+            for engine in args.engines:
+                if engine not in ENGINES:
+                    parser.error(f'Unknown engine {engine}')
+                r = run_case(engine, protocol, n_peers, args)
+                results.append(r)
+                print(f'{engine:<9}{protocol:<6}{n_peers:>8}{r["announces_per_second"]:>9.0f}{r["p50_ms"]:>9.2f}'
+                      f'{r["p99_ms"]:>9.2f}{r["tracker_cpu_per_announce_us"]:>12.0f}{r["errors"]:>8}'
+                      f'{r["cache"]["hit_rate"]:>10.2f}', flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'commit': git_commit(), 'timestamp': time.time(), 'args': vars(args), 'results': results}, f,
+                      indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import bitarray
+
+
+# the unit of a request, pieces are split into blocks of this size, the last one of a piece may be shorter
+BLOCK_SIZE = 16 * 1024
+
+
+class PartialPiece:
+    def __init__(self, size, block_size=BLOCK_SIZE):
+        """
+        A piece being downloaded block by block, possibly from several peers at once
+        :param size: bytes of the piece
+        :param block_size:
+
+        Blocks are written into `data` at their offset as they arrive, `received` marks the ones that did, and
+        `requested` counts the requests outstanding for each block, so that a block given up by one peer can be
+        handed to another and endgame duplicates can be told apart from the last request of a block.
+        """
+        self.size = size
+        self.block_size = block_size
+        self.data = bytearray(size)
+        self.blocks = max(1, -(-size // block_size))
+        self.received = bitarray.bitarray(self.blocks)
+        self.received.setall(False)
+        self.requested = [0] * self.blocks
+
+    def block_range(self, block):
+        begin = block * self.block_size
+        return begin, min(self.block_size, self.size - begin)
+
+    def block_of(self, begin, length):
+        """
+        :return: the block that starts at `begin` and is `length` long, None for anything else
+        """
+        if begin % self.block_size or not 0 <= begin < max(self.size, 1):
+            return None
+        block = begin // self.block_size
+        return block if self.block_range(block)[1] == length else None
+
+    def open_blocks(self):
+        # blocks neither received nor asked for
+        return [block for block in range(self.blocks) if not self.received[block] and not self.requested[block]]
+
+    @property
+    def open(self):
+        return any(not self.received[block] and not self.requested[block] for block in range(self.blocks))
+
+    @property
+    def idle(self):
+        # nothing received and nothing asked for, the piece may as well start over
+        return not self.received.any() and not any(self.requested)
+
+    @property
+    def done(self):
+        return self.received.all()
+
+    def add(self, block, data):
+        """
+        :return: whether the block was new
+        """
+        if self.received[block]:
+            return False
+        begin = block * self.block_size
+        self.data[begin:begin + len(data)] = data
+        self.received[block] = True
+        return True
@@ -0,0 +1,101 @@
+import math
+import time
+import random
+import threading
+
+
+class RateMeter:
+    def __init__(self, window=20.0):
+        """
+        Bytes per second through one connection, an exponentially decaying sum of the bytes over `window` seconds
+        :param window:
+
+        Only one thread may `add`, any thread may read `rate`.
+        """
+        self.window = window
+        self.value = 0.0
+        self.last = time.monotonic()
+
+    def add(self, size, now=None):
+        now = time.monotonic() if now is None else now
+        self.value = self.value * math.exp((self.last - now) / self.window) + size
+        self.last = now
+
+    def rate(self, now=None):
+        now = time.monotonic() if now is None else now
+        value, last = self.value, self.last
+        return value * math.exp(min(0.0, last - now) / self.window) / self.window
+
+
+class Choker:
+    def __init__(self, slots=4, interval=10.0, optimistic_interval=30.0):
+        """
+        Decides which interested peers may download from us
+        :param slots: peers unchoked at once, one of them the optimistic unchoke
+        :param interval: seconds between rechoke rounds
+        :param optimistic_interval: seconds an optimistic unchoke lasts
+
+        Every round the peers are ranked by a rate, the one they upload to us at while we download (tit-for-tat), the
+        one we upload to them at once we seed, and all slots but one go to the best of them. The last slot rotates
+        among the others at random, so that new peers get a chance to show what they give back.
+
+        Between rounds a peer that becomes interested takes a free slot at once, and a slot given up makes the next
+        round come early.
+        """
+        self.slots = max(1, slots)
+        self.interval = interval
+        self.optimistic_interval = optimistic_interval
+        self.unchoked = set()
+        self.optimistic = None
+        self.next_round = 0.0
+        self.next_optimistic = 0.0
+        self.lock = threading.Lock()
+
+    def due(self, now=None):
+        now = time.monotonic() if now is None else now
+        return now >= self.next_round
+
+    def request(self, peer_id):
+        """
+        A peer became interested
+        :return: whether it is unchoked right away
+        """
+        with self.lock:
+            if peer_id in self.unchoked:
+                return True
+            if len(self.unchoked) < self.slots:
+                self.unchoked.add(peer_id)
+                return True
+            return False
+
+    def release(self, peer_id):
+        """
+        A peer lost interest or went away, its slot is handed out in the next round
+        """
+        with self.lock:
+            if peer_id in self.unchoked:
+                self.unchoked.discard(peer_id)
+                self.next_round = 0.0
+            if peer_id == self.optimistic:
+                self.optimistic = None
+
+    def rechoke(self, peers, now=None):
+        """
+        :param peers: the interested peers, as a dict of peer_id to the rate that ranks them
+        :return: the peer_ids to unchoke
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            ranked = sorted(peers, key=peers.get, reverse=True)
+            if len(ranked) <= self.slots:
+                self.unchoked = set(ranked)
+                self.optimistic = None
+            else:
+                regular = ranked[:self.slots - 1]
+                if now >= self.next_optimistic or self.optimistic not in peers or self.optimistic in regular:
+                    self.optimistic = random.choice(ranked[self.slots - 1:])
+                    self.next_optimistic = now + self.optimistic_interval
+                self.unchoked = set(regular)
+                self.unchoked.add(self.optimistic)
+            self.next_round = now + self.interval
+            return set(self.unchoked)
@@ -1,2 +1,13 @@
 from .client import Client, PeerClient
 from .server import Server
+from .codec import encode_message, decode_message, choose_codec, SUPPORTED_CODECS, CODEC_JSON, CODEC_BINARY
+from .codec import pack_bitfield, unpack_bitfield, Encoded, encode_response
+from .shaping import Shaper, TokenBucket
+from .udp import UdpServer
+from .aio import AsyncServer, AsyncClient, AsyncPeerConnection
+
+# the transport each networking engine builds servers, tracker clients and peer connections from
+ENGINES = {
+    "thread": (Server, Client, PeerClient),
+    "asyncio": (AsyncServer, AsyncClient, AsyncPeerConnection),
+}
@@ -0,0 +1,423 @@
+import asyncio
+import itertools
+import threading
+import traceback
+import collections
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import obj_encode, obj_decode, console_log, ERROR
+from .rdt_socket import HEADER, FILE_HEADER_SIZE, SEND_COPY_LIMIT
+from .codec import encode_message, decode_message, encode_response, CODEC_JSON
+from .client import KEEP_ALIVE, TICK_INTERVAL, idempotent
+from .shaping import UP, DOWN
+
+
+INBOX_SIZE = 64
+# threads the handlers run in, so that disk I/O and hashing in them never hold up the event loop
+HANDLER_WORKERS = 32
+
+
+class EventLoopThread(threading.Thread):
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        """
+        The event loop that drives every asyncio server and connection of the process, run by a daemon thread so the
+        command loops of `Peer` and `Tracker` stay as they are
+
+        Handlers such as `recv_fn` block on disk, hashes and locks, so they run in `executor`, awaited with `run`.
+        """
+        super().__init__(daemon=True)
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=HANDLER_WORKERS, thread_name_prefix='AsyncHandler')
+        self.ready = threading.Event()
+
+    @classmethod
+    def get(cls):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                cls._instance.start()
+                cls._instance.ready.wait()
+            return cls._instance
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self.ready.set)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def run_handler(self, fn, *args):
+        return await self.loop.run_in_executor(self.executor, fn, *args)
+
+    def call(self, fn, *args):
+        if threading.current_thread() is self:
+            fn(*args)
+        else:
+            self.loop.call_soon_threadsafe(fn, *args)
+
+
+async def read_frame(reader):
+    header = await reader.readexactly(FILE_HEADER_SIZE)
+    body_size, = HEADER.unpack(header)
+    return await reader.readexactly(body_size)
+
+
+def write_frame(writer, package):
+    if len(package) < SEND_COPY_LIMIT:
+        writer.write(HEADER.pack(len(package)) + package)
+    else:
+        writer.write(HEADER.pack(len(package)))
+        writer.write(package)
+
+
+class AsyncServer:
+    def __init__(self, host="", port=7889, recv_fn=None, backlog=128, max_workers=None, timeout=10.0, keep_alive=60.0):
+        """
+        The asyncio counterpart of `Server`: receives files on every connection and calls recv_fn with each of them
+        :param host:
+        :param port:
+        :param recv_fn: called as recv_fn(file, (reader, writer)), a None response leaves the connection to recv_fn
+        :param backlog:
+        :param max_workers: requests handled at the same time, unbounded if None
+        :param timeout: seconds a client gets to send its first request
+        :param keep_alive: seconds an answered connection may stay idle before it is closed, 0 to close at once
+        """
+        self.host = host
+        self.port = port
+        self.recv_fn = recv_fn
+        self.backlog = backlog
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.free_workers = None
+        # with the protocol given, so that asyncio sets TCP_NODELAY on the connections it accepts
+        self.serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+        self.serverSocket.bind((host, self.port))
+        self.engine = EventLoopThread.get()
+        self.server = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.engine.submit(self._start()).result()
+
+    async def _start(self):
+        if self.max_workers:
+            self.free_workers = asyncio.Semaphore(self.max_workers)
+        self.server = await asyncio.start_server(self.handle, sock=self.serverSocket, backlog=self.backlog)
+
+    async def handle(self, reader, writer):
+        timeout = self.timeout
+        while True:
+            try:
+                package = await asyncio.wait_for(read_frame(reader), timeout)
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                writer.close()
+                return
+            file = decode_message(package)
+            if self.recv_fn is None:
+                response = None
+            elif self.free_workers is None:
+                response = await self.engine.run_handler(self.recv_fn, file, (reader, writer))
+            else:
+                async with self.free_workers:
+                    response = await self.engine.run_handler(self.recv_fn, file, (reader, writer))
+            if response is None:
+                return  # taken over by recv_fn
+            write_frame(writer, encode_response(response, file))
+            await writer.drain()
+            if not self.keep_alive:
+                writer.close()
+                return
+            timeout = self.keep_alive
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.engine.submit(self._stop()).result()
+
+    async def _stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def join(self, timeout=None):
+        pass
+
+
+class AsyncClient:
+    def __init__(self, host="", port=7889, recv_fn=None, timeout=10.0, retries=3, backoff=0.5, log=None):
+        """
+        The asyncio counterpart of `Client`: sends queued files to the server over one kept-alive connection, and
+        calls their recv_fn on the response, retrying a failed request with exponential backoff, one the server may
+        have received only if it is `idempotent`
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.log = console_log if log is None else log
+        self.files = collections.deque()
+        self.in_flight = False
+        self.sent = False
+        self.running = False
+        self.engine = EventLoopThread.get()
+        self.wakeup = None
+        self.task = None
+        self.reader = None
+        self.writer = None
+        self.rids = itertools.count()
+
+    def send_file(self, file, recv_fn=None):
+        self.files.append((file, recv_fn))
+        if self.wakeup is not None:
+            self.engine.call(self.wakeup.set)
+
+    @property
+    def busy(self):
+        return len(self.files) > 0 or self.in_flight
+
+    def start(self):
+        self.running = True
+        self.task = self.engine.submit(self._run())
+
+    async def _request(self, file):
+        if self.writer is None or self.writer.is_closing():
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port),
+                                                              self.timeout)
+        rid = next(self.rids)
+        write_frame(self.writer, obj_encode(dict(file, rid=rid)))
+        self.sent = True
+        await self.writer.drain()
+        while True:
+            response = obj_decode(await asyncio.wait_for(read_frame(self.reader), self.timeout))
+            if response.pop('rid', rid) == rid:
+                return response
+
+    async def _run(self):
+        self.wakeup = asyncio.Event()
+        while self.running or self.files:
+            if not self.files:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            file, recv_fn = self.files.popleft()
+            self.in_flight = True
+            try:
+                for attempt in range(self.retries + 1):
+                    self.sent = False
+                    try:
+                        file_back = await self._request(file)
+                        break
+                    except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                        if self.writer is not None:
+                            self.writer.close()
+                            self.writer = None
+                        if attempt == self.retries or self.sent and not idempotent(file):
+                            self.log(f'[ERROR] Request to {self.host}:{self.port} failed: {type(e).__name__} {e}',
+                                     ERROR)
+                            file_back = None
+                            break
+                        await asyncio.sleep(self.backoff * 2 ** attempt)
+                if recv_fn and file_back is not None:
+                    recv_fn(file_back, self.writer)
+            except Exception:
+                self.log(f'[ERROR] Handling the response of {self.host}:{self.port} failed:\n{traceback.format_exc()}',
+                         ERROR)
+            finally:
+                self.in_flight = False
+        if self.writer is not None:
+            self.writer.close()
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            if self.wakeup is not None:
+                self.engine.call(self.wakeup.set)
+
+    def join(self, timeout=None):
+        if self.task is not None:
+            self.task.result(timeout)
+
+
+class AsyncPeerConnection:
+    def __init__(self, peer_id=None, host="", port=7889, recv_fn=None, states=None, close_fn=None, tick=TICK_INTERVAL,
+                 shaper=None):
+        """
+        The asyncio counterpart of `PeerClient`, with the same lockstep and duplex modes, and bandwidth limits
+
+        A reader task moves decoded messages into `inbox`, and the connection task serves them one at a time in the
+        engine's handler threads, awaiting each before the next, so `recv_fn` never runs concurrently for one
+        connection and sees its messages in order. On a duplex connection a writer task sends `outbox`.
+        """
+        self.host = host
+        self.port = port
+        self.recv_fn = recv_fn
+        self.close_fn = close_fn
+        self.tick = tick
+        self.shaper = shaper
+        self.peer_id = f"{host}:{port}" if peer_id is None else peer_id
+        self.states = states.copy()
+        self.running = False
+        self.file_init = None
+        self.socket_init = None
+        self.engine = EventLoopThread.get()
+        self.reader = None
+        self.writer = None
+        self.inbox = None
+        self.outbox = collections.deque()
+        self.outbox_ready = None
+        self.task = None
+
+    def set_server(self, file, socket=None):
+        self.file_init = file
+        self.socket_init = socket
+
+    @property
+    def duplex(self):
+        return self.states.get('duplex', False)
+
+    def send(self, message):
+        """
+        Queue a message for the peer, from any thread
+        """
+        self.engine.call(self._enqueue, message)
+
+    def _enqueue(self, message):
+        self.outbox.append(message)
+        if self.outbox_ready is not None:
+            self.outbox_ready.set()
+
+    def discard(self, match):
+        """
+        Drop the queued messages `match` is true for, from any thread
+        """
+        self.engine.call(self._discard, match)
+
+    def _discard(self, match):
+        kept = [m for m in self.outbox if not match(m)]
+        if len(kept) != len(self.outbox):
+            self.outbox = collections.deque(kept)
+
+    def start(self):
+        self.running = True
+        self.task = self.engine.submit(self._run())
+
+    def stop(self):
+        self.running = False
+        self.engine.call(self._wake)
+
+    def _wake(self):
+        if self.outbox_ready is not None:
+            self.outbox_ready.set()
+        if self.inbox is not None:
+            try:
+                self.inbox.put_nowait(None)
+            except asyncio.QueueFull:
+                pass
+
+    def join(self, timeout=None):
+        if self.task is not None:
+            try:
+                self.task.result(timeout)
+            except Exception:
+                pass
+
+    def is_alive(self):
+        return self.task is not None and not self.task.done()
+
+    def _send_now(self, message):
+        """
+        :return: seconds to wait before the next frame, as the shaper has it
+        """
+        package = encode_message(message, self.states.get('codec', CODEC_JSON))
+        write_frame(self.writer, package)
+        return self.shaper.charge(UP, len(package), message) if self.shaper is not None else 0.0
+
+    async def _read_loop(self):
+        try:
+            while True:
+                package = await read_frame(self.reader)
+                message = decode_message(package)
+                await self.inbox.put(message)
+                if self.shaper is not None:
+                    wait = self.shaper.charge(DOWN, len(package), message)
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            await self.inbox.put(None)
+
+    async def _write_loop(self):
+        while True:
+            while self.outbox:
+                wait = self._send_now(self.outbox.popleft())
+                if wait > 0:
+                    await self.writer.drain()
+                    await asyncio.sleep(wait)
+            await self.writer.drain()
+            if not self.running:
+                return
+            if not self.outbox:
+                self.outbox_ready.clear()
+                await self.outbox_ready.wait()
+
+    async def _run(self):
+        self.inbox = asyncio.Queue(INBOX_SIZE)
+        self.outbox_ready = asyncio.Event()
+        reader_task = None
+        writer_task = None
+        try:
+            if self.socket_init is None:
+                self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+            else:
+                self.reader, self.writer = self.socket_init
+            reader_task = asyncio.ensure_future(self._read_loop())
+
+            self._send_now(self.file_init)
+            await self.writer.drain()
+            while self.running:
+                if self.duplex and writer_task is None:
+                    writer_task = asyncio.ensure_future(self._write_loop())
+
+                try:
+                    message = await asyncio.wait_for(self.inbox.get(), self.tick if self.duplex else None)
+                except asyncio.TimeoutError:
+                    message = KEEP_ALIVE
+                if message is None:
+                    break
+
+                messages, stop = await self.engine.run_handler(self.recv_fn, self.peer_id, message, self.writer,
+                                                               self.states)
+                self.outbox.extend(messages)
+                if self.duplex:
+                    self.outbox_ready.set()
+                else:
+                    wait = self._send_now(self.outbox.popleft() if self.outbox else KEEP_ALIVE)
+                    await self.writer.drain()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                if stop:
+                    break
+        except OSError:  # refused or reset connections included
+            pass
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.running = False
+            if writer_task is not None:
+                self.outbox_ready.set()
+                try:
+                    await writer_task
+                except ConnectionError:
+                    pass
+            if reader_task is not None:
+                reader_task.cancel()
+            if self.writer is not None:
+                self.writer.close()
+            if self.close_fn:
+                await self.engine.run_handler(self.close_fn, self.peer_id, self.states)
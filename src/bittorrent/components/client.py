@@ -1,80 +1,380 @@
 import os
 import time
+import heapq
+import queue
+import itertools
 import threading
+import traceback
+import collections
 from socket import *
 
 from .utils import *
 from .rdt_socket import rdt_socket
+from .codec import encode_message, decode_message, CODEC_JSON
+from .shaping import UP, DOWN
+
+
+KEEP_ALIVE = {'type': "KeepAlive", 'len': 0}
+TICK_INTERVAL = 0.2
+
+
+def idempotent(file):
+    """
+    Whether a request can be sent again when its response was lost: a regular announce can, one with an event
+    cannot, e.g. a "stopped" or "completed" the tracker may have acted on already
+    """
+    return not (isinstance(file, dict) and file.get('event'))
+
+
+class PooledConnection:
+    def __init__(self, host, port, timeout=10.0):
+        """
+        A kept-alive connection to a server, shared by every Client of that server
+
+        A request is tagged with a request id `rid` and written at once, and a reader thread hands each response to
+        the callback of the request it answers, so any number of requests can be in flight on the connection.
+        """
+        self.host = host
+        self.port = port
+        self.connectionSocket = socket.create_connection((host, port), timeout)
+        self.connectionSocket.settimeout(None)
+        self.connectionSocket.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+        self.rdt = rdt_socket(self.connectionSocket)
+        self.lock = threading.Lock()
+        self.rids = itertools.count()
+        self.pending = {}
+        self.alive = True
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+
+    def request(self, file, callback):
+        """
+        Send a request, callback(response, error) is called with exactly one of them set
+        :raise OSError: if the request could not be sent, the connection is closed then and callback is not called
+        """
+        rid = next(self.rids)
+        with self.lock:
+            if not self.alive:
+                raise ConnectionResetError('Connection closed')
+            try:
+                self.rdt.sendBytes(obj_encode(dict(file, rid=rid)))
+                self.pending[rid] = callback
+                return
+            except OSError as e:
+                error = e
+        # the requests in flight on the connection fail with it
+        self.close(error)
+        raise error
+
+    def read_loop(self):
+        error = None
+        try:
+            while True:
+                response = obj_decode(self.rdt.recvBytes())
+                rid = response.pop('rid', None) if isinstance(response, dict) else None
+                with self.lock:
+                    if rid is None and self.pending:
+                        # a server that does not echo request ids answers in order
+                        rid = next(iter(self.pending))
+                    callback = self.pending.pop(rid, None)
+                if callback:
+                    callback(response, None)
+        except (OSError, ValueError) as e:
+            error = e
+        finally:
+            self.close(error)
+
+    def close(self, error=None):
+        with self.lock:
+            if not self.alive:
+                return
+            self.alive = False
+            pending, self.pending = self.pending, {}
+        try:
+            self.connectionSocket.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+        self.connectionSocket.close()
+        for callback in pending.values():
+            callback(None, error or ConnectionResetError('Connection closed'))
+
+
+class ConnectionPool:
+    def __init__(self):
+        """
+        The `PooledConnection`s of the Clients of a process, one per server, counting the Clients that use each so
+        that it is closed, with its reader thread, once the last of them is stopped
+        """
+        self.connections = {}
+        self.users = collections.Counter()
+        self.lock = threading.Lock()
+
+    def acquire(self, host, port):
+        with self.lock:
+            self.users[(host, port)] += 1
+
+    def release(self, host, port):
+        with self.lock:
+            self.users[(host, port)] -= 1
+            if self.users[(host, port)] > 0:
+                return
+            del self.users[(host, port)]
+            connection = self.connections.pop((host, port), None)
+        if connection is not None:
+            connection.close()
+
+    def get(self, host, port, timeout=10.0):
+        with self.lock:
+            connection = self.connections.get((host, port))
+            if connection is None or not connection.alive:
+                connection = PooledConnection(host, port, timeout)
+                self.connections[(host, port)] = connection
+            return connection
+
+
+POOL = ConnectionPool()
+
+
+class Request:
+    __slots__ = ('file', 'recv_fn', 'attempt', 'deadline', 'connection', 'sent')
+
+    def __init__(self, file, recv_fn):
+        self.file = file
+        self.recv_fn = recv_fn
+        self.attempt = 0
+        self.deadline = None
+        self.connection = None
+        # whether the server may have the request, it is then only sent again if that is harmless
+        self.sent = False
 
 
 class Client(threading.Thread):
-    def __init__(self, host="", port=7889, recv_fn=None):
+    def __init__(self, host="", port=7889, recv_fn=None, timeout=10.0, retries=3, backoff=0.5, pool=None, log=None):
         """
         A client that connects to a server, sends files to the server, receives files from the server, and calls recv_fn when a file is received
         :param host:
         :param port:
+        :param timeout: seconds to wait for a response before the connection is given up
+        :param retries: times a failed request is sent again
+        :param backoff: seconds before the first retry, doubled for every further one
+        :param log: called as log(msg, level) with the requests that fail, a `Peer`'s log for instance
+
+        Files are sent over a connection from `pool` as soon as they are queued, and the thread sleeps on its event
+        queue in between, woken up by new files, responses, failures, or the next timeout or retry that is due.
+        A request that could not be sent is retried, one the server may have received only if it is `idempotent`.
+        The connection is released when the client stops, and closed once no other client uses it.
         """
         super().__init__()
 
         self.host = host
         self.port = port
-        self.files = []
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool = POOL if pool is None else pool
+        self.log = console_log if log is None else log
+        self.events = queue.Queue()
+        self.in_flight = set()
+        self.delayed = []
+        self.seq = itertools.count()
+        self.outstanding = 0
+        self.lock = threading.Lock()
         self.running = False
 
     def send_file(self, file, recv_fn=None):
-        self.files.append((file, recv_fn))
+        with self.lock:
+            self.outstanding += 1
+        self.events.put(('send', Request(file, recv_fn), None))
 
     @property
     def busy(self):
-        return len(self.files) > 0
+        return self.outstanding > 0
 
     def stop(self):
         if self.running:
             self.running = False
+            self.events.put(('stop', None, None))
 
     def run(self):
         self.running = True
-        connectionSocket = None
-
-        while self.running:
-            if len(self.files) > 0:
-                connectionSocket = socket.socket(AF_INET, SOCK_STREAM)
-                connectionSocket.connect((self.host, self.port))
-                rdt = rdt_socket(connectionSocket)
-                file, recv_fn = self.files.pop(0)
-                # print(f"Sending file to {self.host}:{self.port}")
-                package = obj_encode(file)
-                rdt.sendBytes(package)
-                package_back = rdt.recvBytes()
-                file_back = obj_decode(package_back)
-                # print(f"Received file from {self.host}:{self.port}")
-                if recv_fn:
-                    recv_fn(file_back, connectionSocket)
+        self.pool.acquire(self.host, self.port)
+
+        try:
+            while self.running:
+                try:
+                    kind, request, payload = self.events.get(timeout=self.next_wakeup())
+                except queue.Empty:
+                    kind = None
+                if kind == 'send':
+                    self.submit(request)
+                elif kind == 'response':
+                    self.finish(request, payload)
+                elif kind == 'error':
+                    self.retry(request, payload)
+                self.expire()
+        finally:
+            self.pool.release(self.host, self.port)
+
+    def next_wakeup(self):
+        wakeups = [request.deadline for request in self.in_flight]
+        if self.delayed:
+            wakeups.append(self.delayed[0][0])
+        if not wakeups:
+            return None
+        return max(0, min(wakeups) - time.monotonic())
+
+    def submit(self, request):
+        def callback(response, error):
+            if error is None:
+                self.events.put(('response', request, response))
             else:
-                time.sleep(0.1)
-        
-        if connectionSocket:
-            connectionSocket.close()
+                self.events.put(('error', request, error))
+
+        self.in_flight.add(request)
+        request.sent = False
+        try:
+            request.connection = self.pool.get(self.host, self.port, self.timeout)
+            request.deadline = time.monotonic() + self.timeout
+            request.connection.request(request.file, callback)
+            request.sent = True
+        except OSError as e:
+            self.retry(request, e)
+
+    def finish(self, request, file_back):
+        if request not in self.in_flight:
+            return  # answered after it was given up
+        self.in_flight.remove(request)
+        with self.lock:
+            self.outstanding -= 1
+        if request.recv_fn:
+            try:
+                request.recv_fn(file_back, request.connection.connectionSocket)
+            except Exception:
+                self.log(f'[ERROR] Handling the response of {self.host}:{self.port} failed:\n{traceback.format_exc()}',
+                         ERROR)
+
+    def retry(self, request, error):
+        if request not in self.in_flight:
+            return
+        self.in_flight.remove(request)
+        request.attempt += 1
+        if request.attempt > self.retries or request.sent and not idempotent(request.file):
+            self.log(f'[ERROR] Request to {self.host}:{self.port} failed: {type(error).__name__} {error}', ERROR)
+            with self.lock:
+                self.outstanding -= 1
+            return
+        due = time.monotonic() + self.backoff * 2 ** (request.attempt - 1)
+        heapq.heappush(self.delayed, (due, next(self.seq), request))
+
+    def expire(self):
+        now = time.monotonic()
+        for request in list(self.in_flight):
+            if request.deadline <= now:
+                # a connection that stops answering is dropped, which fails every request on it
+                request.connection.close(TimeoutError('Request timed out'))
+        while self.delayed and self.delayed[0][0] <= now:
+            _, _, request = heapq.heappop(self.delayed)
+            self.submit(request)
 
 
 class PeerClient(threading.Thread):
-    def __init__(self, peer_id=None, host="", port=7889, recv_fn=None, states=None):
+    def __init__(self, peer_id=None, host="", port=7889, recv_fn=None, states=None, close_fn=None, tick=TICK_INTERVAL,
+                 shaper=None):
+        """
+        A connection to another peer, driven by `recv_fn` for every message received
+        :param peer_id:
+        :param host:
+        :param port:
+        :param recv_fn: called as recv_fn(peer_id, message, connectionSocket, states) -> (messages, stop)
+        :param states:
+        :param close_fn: called as close_fn(peer_id, states) once the connection is over
+        :param tick: seconds between idle calls of recv_fn on a duplex connection
+        :param shaper: a `ConnectionShaper` that limits the bandwidth, each frame waits out what the previous one cost
+
+        Until both ends agree on `states['duplex']`, the connection runs in lockstep: every message received is
+        answered with exactly one message, the first one queued or a keep-alive. A duplex connection instead has a
+        writer thread that sends queued messages as soon as they are queued, while this thread keeps receiving.
+        """
         super().__init__()
 
         self.host = host
         self.port = port
         self.connectionSocket = socket.socket(AF_INET, SOCK_STREAM)
         self.recv_fn = recv_fn
+        self.close_fn = close_fn
+        self.tick = tick
+        self.shaper = shaper
         self.peer_id = f"{host}:{port}" if peer_id is None else peer_id
         self.states = states.copy()
         self.running = False
         self.file_init = None
         self.socket_init = None
+        self.rdt = None
+        self.outbox = collections.deque()
+        self.outbox_ready = threading.Condition()
+        self.writer = None
 
     def set_server(self, file, socket=None):
         self.file_init = file
         self.socket_init = socket
 
+    @property
+    def duplex(self):
+        return self.states.get('duplex', False)
+
+    def send(self, message):
+        """
+        Queue a message for the peer
+        """
+        with self.outbox_ready:
+            self.outbox.append(message)
+            self.outbox_ready.notify()
+
+    def discard(self, match):
+        """
+        Drop the queued messages `match` is true for, e.g. a block the peer cancelled before it was sent
+        :return: how many were dropped
+        """
+        with self.outbox_ready:
+            kept = [m for m in self.outbox if not match(m)]
+            dropped = len(self.outbox) - len(kept)
+            if dropped:
+                self.outbox = collections.deque(kept)
+            return dropped
+
+    def send_now(self, message):
+        package = encode_message(message, self.states.get('codec', CODEC_JSON))
+        self.rdt.sendBytes(package)
+        self.throttle(UP, len(package), message)
+
+    def throttle(self, direction, size, message):
+        if self.shaper is not None:
+            wait = self.shaper.charge(direction, size, message)
+            if wait > 0:
+                time.sleep(wait)
+
+    def write_loop(self):
+        try:
+            while True:
+                with self.outbox_ready:
+                    while not self.outbox and self.running:
+                        self.outbox_ready.wait()
+                    if not self.outbox:
+                        return
+                    message = self.outbox.popleft()
+                self.send_now(message)
+        except OSError:
+            # the receiving side stops at its next tick, if the failure has not stopped it already
+            self.stop()
+
+    def receive(self):
+        if self.duplex and not self.rdt.readable(self.tick):
+            return KEEP_ALIVE
+        package = self.rdt.recvBytes()
+        message = decode_message(package)
+        self.throttle(DOWN, len(package), message)
+        return message
+
     def run(self):
         """
         Send a file and serve the server's response, round n round
@@ -85,29 +385,43 @@ class PeerClient(threading.Thread):
 
         soc, file = self.socket_init, self.file_init
 
-        if soc is None:
-            self.connectionSocket.connect((self.host, self.port))
-            rdt = rdt_socket(self.connectionSocket)
-        else:
-            self.connectionSocket = soc
-            rdt = rdt_socket(self.connectionSocket)
-
-        while self.running:
-            package = obj_encode(file)
-            rdt.sendBytes(package)
-            package_back = rdt.recvBytes()
-            file_back = obj_decode(package_back)
-            file, stop = self.recv_fn(self.peer_id, file_back, self.connectionSocket, self.states)
-            if stop:
-                self.stop()
-                break
+        try:
+            if soc is None:
+                self.connectionSocket.connect((self.host, self.port))
+            else:
+                self.connectionSocket = soc
+            self.rdt = rdt_socket(self.connectionSocket)
 
-        self.connectionSocket.close()
+            self.send_now(file)
+            while self.running:
+                if self.duplex and self.writer is None:
+                    self.writer = threading.Thread(target=self.write_loop, daemon=True)
+                    self.writer.start()
+
+                message = self.receive()
+                messages, stop = self.recv_fn(self.peer_id, message, self.connectionSocket, self.states)
+                for m in messages:
+                    self.send(m)
+                if not self.duplex:
+                    with self.outbox_ready:
+                        m = self.outbox.popleft() if self.outbox else KEEP_ALIVE
+                    self.send_now(m)
+                if stop:
+                    break
+        except OSError:  # refused or reset connections included
+            pass
+        finally:
+            self.stop()
+            if self.writer is not None:
+                self.writer.join()
+            self.connectionSocket.close()
+            if self.close_fn:
+                self.close_fn(self.peer_id, self.states)
 
     def stop(self):
         self.running = False
+        with self.outbox_ready:
+            self.outbox_ready.notify_all()
 
     def __del__(self):
         self.connectionSocket.close()
-
-
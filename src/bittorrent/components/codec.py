@@ -0,0 +1,311 @@
+import json
+import struct
+
+import bitarray
+
+from .utils import obj_encode, obj_decode
+
+
+CODEC_JSON = "json"
+CODEC_BINARY = "binary"
+SUPPORTED_CODECS = [CODEC_BINARY, CODEC_JSON]
+
+# 0xB7 is a UTF-8 continuation byte, so it can never start a JSON frame
+MAGIC = b'\xb7'
+HEADER = struct.Struct('!cBI')  # magic, message id, length of the JSON extras
+STR_LEN = struct.Struct('!H')
+INDEX = struct.Struct('!I')
+BLOCK = struct.Struct('!III')  # index, begin, length
+BLOCK_PIECE = struct.Struct('!II')  # index, begin
+HAVE = struct.Struct('!I?')
+HAVE_BATCH_COUNT = struct.Struct('!I')
+BITFIELD_COUNT = struct.Struct('!H')
+BITFIELD_BITS = struct.Struct('!I')
+
+KEEP_ALIVE_ID = 0xFF
+MESSAGE_IDS = {
+    "Choke": 0,
+    "UnChoke": 1,
+    "Interested": 2,
+    "UnInterested": 3,
+    "Have": 4,
+    "Bitfield": 5,
+    "Request": 6,
+    "Piece": 7,
+    "ServerClose": 8,
+    "Cancel": 9,
+    "HaveBatch": 12,
+    "KeepAlive": KEEP_ALIVE_ID,
+}
+# block requests and blocks have layouts of their own, whole-piece ones keep theirs
+BLOCK_IDS = {
+    "Request": 10,
+    "Piece": 11,
+}
+MESSAGE_TYPES = {v: k for k, v in MESSAGE_IDS.items()}
+MESSAGE_TYPES.update({v: k for k, v in BLOCK_IDS.items()})
+
+# keys that are carried by the fixed layout of each message type, anything else travels in the extras
+FIELDS = {
+    "Choke": (),
+    "UnChoke": (),
+    "Interested": (),
+    "UnInterested": (),
+    "Have": ('file', 'index', 'have'),
+    "Bitfield": ('bitfield',),
+    "Request": ('file', 'index'),
+    "Piece": ('file', 'index', 'piece'),
+    "ServerClose": (),
+    "Cancel": ('file', 'index', 'begin', 'length'),
+    "HaveBatch": ('file', 'indices'),
+    "KeepAlive": (),
+}
+BLOCK_FIELDS = {
+    "Request": ('file', 'index', 'begin', 'length'),
+    "Piece": ('file', 'index', 'begin', 'piece'),
+}
+IMPLICIT_FIELDS = ('type', 'len', 'id')
+
+
+def choose_codec(codecs):
+    """
+    Pick the best codec both ends support, given the list a peer advertised in its handshake
+    :param codecs: None for peers that predate codec negotiation
+    """
+    if not codecs:
+        return CODEC_JSON
+    for codec in SUPPORTED_CODECS:
+        if codec in codecs:
+            return codec
+    return CODEC_JSON
+
+
+def pack_bitfield(bf):
+    """
+    A bitfield in the compact form peers that advertise "packed_bitfield" understand: "all" or "none" when every bit
+    is the same, otherwise the packed bits ("raw") or, if shorter, the lengths of its runs of equal bits ("rle")
+    """
+    n = len(bf)
+    if n == 0 or not bf.any():
+        return {'enc': "none", 'n': n}
+    if bf.all():
+        return {'enc': "all", 'n': n}
+    raw = bf.tobytes()
+    # every run takes at least a byte, don't bother when there are too many of them
+    runs = (bf[1:] ^ bf[:-1]).count() + 1
+    if runs < len(raw):
+        rle = _encode_runs(bf)
+        if len(rle) < len(raw):
+            return {'enc': "rle", 'n': n, 'first': bf[0], 'data': rle}
+    return {'enc': "raw", 'n': n, 'data': raw}
+
+
+def unpack_bitfield(packed):
+    """
+    A bitarray from a bitfield as any peer sends it, a list of ints, a bitarray, or the form of `pack_bitfield`
+    """
+    if isinstance(packed, bitarray.bitarray):
+        return packed
+    if not isinstance(packed, dict):
+        return bitarray.bitarray(packed)
+    n = packed['n']
+    bf = bitarray.bitarray(n)
+    if packed['enc'] in ("all", "none"):
+        bf.setall(packed['enc'] == "all")
+    elif packed['enc'] == "raw":
+        bf = bitarray.bitarray()
+        bf.frombytes(packed['data'])
+        del bf[n:]
+    elif packed['enc'] == "rle":
+        bit, offset = bool(packed['first']), 0
+        for run in _decode_runs(packed['data']):
+            bf[offset:offset + run] = bit
+            offset += run
+            bit = not bit
+    else:
+        raise ValueError(f'Invalid bitfield encoding {packed["enc"]}')
+    return bf
+
+
+def _encode_runs(bf):
+    # run lengths as LEB128 varints
+    out = bytearray()
+    start = 0
+    for end in list((bf[1:] ^ bf[:-1]).search(1)) + [len(bf) - 1]:
+        run = end + 1 - start
+        start = end + 1
+        while run >= 0x80:
+            out.append(run & 0x7F | 0x80)
+            run >>= 7
+        out.append(run)
+    return bytes(out)
+
+
+def _decode_runs(data):
+    run, shift = 0, 0
+    for byte in data:
+        run |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            yield run
+            run, shift = 0, 0
+
+
+def _pack_str(s):
+    b = s.encode('utf-8')
+    return STR_LEN.pack(len(b)) + b
+
+
+def _unpack_str(view, offset):
+    l, = STR_LEN.unpack_from(view, offset)
+    offset += STR_LEN.size
+    return str(view[offset:offset + l], 'utf-8'), offset + l
+
+
+def message_len(message):
+    """
+    The `len` field as `Peer.make_message` fills it, so decoded messages look exactly like JSON ones
+    """
+    type = message['type']
+    if type == "KeepAlive":
+        return 0
+    if type == "Have":
+        return 6
+    if type == "HaveBatch":
+        return 5 + 4 * len(message['indices'])
+    if type == "Bitfield":
+        return 1 + len(message['bitfield'])
+    if type in ("Request", "Cancel"):
+        return 13
+    if type == "Piece":
+        return 9 + len(message['piece'])
+    return 1
+
+
+def binary_encode(message):
+    type = message['type']
+    block = type in BLOCK_IDS and 'begin' in message
+    fields = BLOCK_FIELDS[type] if block else FIELDS[type]
+    extras = {k: v for k, v in message.items() if k not in fields and k not in IMPLICIT_FIELDS}
+    extras = json.dumps(extras, separators=(',', ':')).encode('utf-8') if extras else b''
+    parts = [HEADER.pack(MAGIC, BLOCK_IDS[type] if block else MESSAGE_IDS[type], len(extras)), extras]
+
+    if block and type == "Piece":
+        parts += [BLOCK_PIECE.pack(message['index'], message['begin']), _pack_str(message['file']), message['piece']]
+    elif block or type == "Cancel":
+        parts += [BLOCK.pack(message['index'], message['begin'], message['length']), _pack_str(message['file'])]
+    elif type == "Have":
+        parts += [HAVE.pack(message['index'], bool(message['have'])), _pack_str(message['file'])]
+    elif type == "HaveBatch":
+        indices = message['indices']
+        parts += [_pack_str(message['file']), HAVE_BATCH_COUNT.pack(len(indices)),
+                  struct.pack(f'!{len(indices)}I', *indices)]
+    elif type == "Request":
+        parts += [INDEX.pack(message['index']), _pack_str(message['file'])]
+    elif type == "Piece":
+        # the payload is the tail of the frame, so it needs no length prefix of its own
+        parts += [INDEX.pack(message['index']), _pack_str(message['file']), message['piece']]
+    elif type == "Bitfield":
+        parts.append(BITFIELD_COUNT.pack(len(message['bitfield'])))
+        for file, bf in message['bitfield'].items():
+            bf = unpack_bitfield(bf)
+            parts += [_pack_str(file), BITFIELD_BITS.pack(len(bf)), bf.tobytes()]
+
+    return b''.join(parts)
+
+
+def binary_decode(binary):
+    view = memoryview(binary)
+    _, id, extras_len = HEADER.unpack_from(view)
+    offset = HEADER.size
+    type = MESSAGE_TYPES.get(id)
+    if type is None:
+        raise ValueError(f'Invalid message id {id}')
+
+    message = {'type': type}
+    if extras_len:
+        message.update(json.loads(str(view[offset:offset + extras_len], 'utf-8')))
+        offset += extras_len
+
+    if id == BLOCK_IDS["Piece"]:
+        message['index'], message['begin'] = BLOCK_PIECE.unpack_from(view, offset)
+        message['file'], offset = _unpack_str(view, offset + BLOCK_PIECE.size)
+        message['piece'] = bytes(view[offset:])
+    elif id == BLOCK_IDS["Request"] or type == "Cancel":
+        message['index'], message['begin'], message['length'] = BLOCK.unpack_from(view, offset)
+        message['file'], offset = _unpack_str(view, offset + BLOCK.size)
+    elif type == "Have":
+        message['index'], message['have'] = HAVE.unpack_from(view, offset)
+        message['file'], offset = _unpack_str(view, offset + HAVE.size)
+    elif type == "HaveBatch":
+        message['file'], offset = _unpack_str(view, offset)
+        count, = HAVE_BATCH_COUNT.unpack_from(view, offset)
+        message['indices'] = list(struct.unpack_from(f'!{count}I', view, offset + HAVE_BATCH_COUNT.size))
+    elif type == "Request":
+        message['index'], = INDEX.unpack_from(view, offset)
+        message['file'], offset = _unpack_str(view, offset + INDEX.size)
+    elif type == "Piece":
+        message['index'], = INDEX.unpack_from(view, offset)
+        message['file'], offset = _unpack_str(view, offset + INDEX.size)
+        message['piece'] = bytes(view[offset:])
+    elif type == "Bitfield":
+        count, = BITFIELD_COUNT.unpack_from(view, offset)
+        offset += BITFIELD_COUNT.size
+        message['bitfield'] = {}
+        for _ in range(count):
+            file, offset = _unpack_str(view, offset)
+            nbits, = BITFIELD_BITS.unpack_from(view, offset)
+            offset += BITFIELD_BITS.size
+            nbytes = (nbits + 7) // 8
+            bf = bitarray.bitarray()
+            bf.frombytes(view[offset:offset + nbytes])
+            del bf[nbits:]
+            message['bitfield'][file] = bf
+            offset += nbytes
+
+    if type != "KeepAlive":
+        message['id'] = MESSAGE_IDS[type]
+    message['len'] = message_len(message)
+    return message
+
+
+def encode_message(message, codec=CODEC_JSON):
+    """
+    Encode a peer message with the codec negotiated for the connection, falling back to JSON for anything the binary
+    layout does not know about
+    """
+    if codec == CODEC_BINARY and isinstance(message, dict) and message.get('type') in MESSAGE_IDS:
+        return binary_encode(message)
+    return obj_encode(message)
+
+
+def decode_message(binary):
+    """
+    Decode a frame of either codec, binary frames are told apart from JSON ones by their magic byte
+    """
+    if binary[:1] == MAGIC:
+        return binary_decode(binary)
+    return obj_decode(binary)
+
+
+class Encoded(bytes):
+    """
+    A JSON object encoded already, e.g. put together from cached pieces, which servers send as it is
+    """
+
+    def with_field(self, key, value):
+        field = json.dumps(key).encode('utf-8') + b':' + obj_encode(value, indent=None)
+        body = self.lstrip()[1:]
+        return Encoded(b'{' + field + (b'' if body.lstrip().startswith(b'}') else b',') + body)
+
+
+def encode_response(response, request):
+    """
+    Encode the response of a server to a request, echoing the request id `rid` if the request carries one
+    """
+    rid = isinstance(request, dict) and 'rid' in request
+    if isinstance(response, Encoded):
+        return response.with_field('rid', request['rid']) if rid else response
+    if rid and isinstance(response, dict):
+        response = dict(response, rid=request['rid'])
+    return obj_encode(response)
@@ -1,42 +1,120 @@
 import socket
+import select
 import struct
 
 
 FILE_HEADER_SIZE = 8
+HEADER = struct.Struct('!1Q')
+RECV_BUFFER_SIZE = 1024 * 1024
+# the arena a connection starts with, enough for tracker requests and control messages
+INITIAL_BUFFER_SIZE = 16 * 1024
+# frames at least this large are sent without concatenating them to their header first
+SEND_COPY_LIMIT = 64 * 1024
+
+
 class rdt_socket(object):
-    def __init__(self, s : socket):
+    def __init__(self, s : socket, buffer_size=RECV_BUFFER_SIZE):
+        """
+        Length-prefixed framing over a stream socket
+        :param buffer_size: bytes the receive arena may grow to
+
+        Received data lands in an arena `databuf` through `recv_into`, and `[start, end)` is the part of it that has
+        not been consumed yet. The arena starts at `INITIAL_BUFFER_SIZE` and doubles, up to `buffer_size`, when a
+        frame does not fit, so a connection that only carries short requests never allocates more. A frame is
+        extracted from the arena with a single copy, while a frame larger than `buffer_size` is received straight
+        into its own buffer, so every body is copied at most once on its way to the caller, as a `bytearray` either
+        way.
+        """
         self.s = s
-        self.databuf = bytes()
+        self.buffer_size = buffer_size
+        self.databuf = bytearray(min(INITIAL_BUFFER_SIZE, buffer_size))
+        self.view = memoryview(self.databuf)
+        self.start = 0
+        self.end = 0
 
     def sendBytes(self, f : bytearray):
-        try:
-            l = len(f)
-            header = struct.pack('!1Q', l)
-            send_data = header + f
-            self.s.sendall(send_data)
-        except socket.error as e:
-            print(e)
-            print(e.filename)
-            
+        """
+        Send a frame, raising OSError if the connection fails so that the caller can give it up at once
+        """
+        l = len(f)
+        header = HEADER.pack(l)
+        if l < SEND_COPY_LIMIT:
+            self.s.sendall(header + f)
+        else:
+            self.s.sendall(header)
+            self.s.sendall(f)
+
+    def readable(self, timeout=None):
+        """
+        Whether `recvBytes` has data to work on, waiting up to `timeout` seconds for the socket
+        """
+        if self.end > self.start:
+            return True
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            poller.register(self.s, select.POLLIN)
+            return bool(poller.poll(None if timeout is None else int(timeout * 1000)))
+        return bool(select.select([self.s], [], [], timeout)[0])
+
+    def _fill(self):
+        """
+        Receive as much as fits behind the buffered data, compacting the arena first when its tail is full
+        """
+        if self.end == len(self.databuf):
+            pending = self.end - self.start
+            self.databuf[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+        n = self.s.recv_into(self.view[self.end:])
+        if n == 0:
+            raise ConnectionResetError('Connection closed by peer')
+        self.end += n
+
+    def _grow(self, size):
+        """
+        Move the buffered data to the head of an arena of at least `size` bytes
+        """
+        new_size = max(len(self.databuf), 1)
+        while new_size < size:
+            new_size *= 2
+        databuf = bytearray(min(new_size, self.buffer_size))
+        pending = self.end - self.start
+        databuf[:pending] = self.view[self.start:self.end]
+        self.databuf, self.view = databuf, memoryview(databuf)
+        self.start, self.end = 0, pending
+
+    def _recv_large(self, body_size):
+        body = bytearray(body_size)
+        body_view = memoryview(body)
+        got = self.end - self.start
+        body_view[:got] = self.view[self.start:self.end]
+        self.start = self.end = 0
+        while got < body_size:
+            n = self.s.recv_into(body_view[got:])
+            if n == 0:
+                raise ConnectionResetError('Connection closed by peer')
+            got += n
+        return body
+
     def recvBytes(self):
-        if len(self.databuf) >= FILE_HEADER_SIZE:
-            header = struct.unpack("!1Q", self.databuf[:FILE_HEADER_SIZE])
-            body_size = header[0]
-            if len(self.databuf) >= FILE_HEADER_SIZE + body_size:
-                body = self.databuf[FILE_HEADER_SIZE:FILE_HEADER_SIZE + body_size]
-                self.databuf = self.databuf[FILE_HEADER_SIZE+body_size:]
-                return body
-        while True:
-            data = self.s.recv(1024)
-            if data:
-                self.databuf += data
-                while True:
-                    if len(self.databuf) < FILE_HEADER_SIZE:
-                        break
-                    header = struct.unpack("!1Q", self.databuf[:FILE_HEADER_SIZE])
-                    body_size = header[0]
-                    if len(self.databuf) < FILE_HEADER_SIZE + body_size:
-                        break
-                    body = self.databuf[FILE_HEADER_SIZE:FILE_HEADER_SIZE + body_size]
-                    self.databuf = self.databuf[FILE_HEADER_SIZE+body_size:]
-                    return body
\ No newline at end of file
+        while self.end - self.start < FILE_HEADER_SIZE:
+            self._fill()
+        body_size, = HEADER.unpack_from(self.databuf, self.start)
+        self.start += FILE_HEADER_SIZE
+
+        if body_size > self.buffer_size - FILE_HEADER_SIZE:
+            return self._recv_large(body_size)
+        if body_size > len(self.databuf) - FILE_HEADER_SIZE:
+            self._grow(body_size + FILE_HEADER_SIZE)
+
+        while self.end - self.start < body_size:
+            if self.start + body_size > len(self.databuf):
+                # make room for the whole frame at the head of the arena
+                pending = self.end - self.start
+                self.databuf[:pending] = self.view[self.start:self.end]
+                self.start, self.end = 0, pending
+            self._fill()
+        body = self.databuf[self.start:self.start + body_size]
+        self.start += body_size
+        if self.start == self.end:
+            self.start = self.end = 0
+        return body
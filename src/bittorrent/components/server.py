@@ -1,18 +1,35 @@
 import os
+import time
 import threading
+import traceback
+import selectors
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from socket import *
 
 from .utils import *
 from .rdt_socket import rdt_socket
+from .codec import decode_message, encode_response
 
 
 class Server(threading.Thread):
-    def __init__(self, host="", port=7889, recv_fn=None):
+    def __init__(self, host="", port=7889, recv_fn=None, backlog=128, max_workers=16, timeout=10.0, keep_alive=60.0):
         """
         A server that listens to a port, receives files from clients, and calls recv_fn when a file is received
         :param host:
         :param port:
-        :param recv_fn:
+        :param recv_fn: called as recv_fn(file, connectionSocket), a None response leaves the connection to recv_fn,
+        an `Encoded` one is sent as it is
+        :param backlog: connections the kernel queues while every handler is busy
+        :param max_workers: requests handled at the same time
+        :param timeout: seconds a client gets to send a whole request
+        :param keep_alive: seconds an answered connection may stay idle before it is closed, 0 to close at once
+
+        The accept loop sleeps in a selector until a connection or a request arrives, or until `stop` wakes it up.
+        It stops accepting while every handler is busy, so a burst of clients waits in the listen backlog instead of
+        piling up in memory. An answered connection goes back to the selector rather than holding a handler, and a
+        request carrying a request id `rid` gets it echoed in its response, so clients can keep several requests in
+        flight on one connection.
         """
         super().__init__()
 
@@ -20,32 +37,134 @@ class Server(threading.Thread):
         self.port = port
         self.serverSocket = socket.socket(AF_INET, SOCK_STREAM)
         self.serverSocket.bind((host, self.port))
-        self.serverSocket.listen(1)
+        self.serverSocket.listen(backlog)
         self.serverSocket.setblocking(False)
         self.recv_fn = recv_fn
+        self.timeout = timeout
+        self.keep_alive = keep_alive
+        self.max_workers = max_workers
+        self.workers = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'Server-{port}')
+        self.busy_workers = 0
+        self.lock = threading.Lock()
+        self.accepting = True
+        # connections answered by a handler, waiting to be watched for their next request
+        self.rearmed = collections.deque()
+        # idle connections in the order of their deadlines, which is the order they became idle in
+        self.idle = {}
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.serverSocket, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
         self.running = False
-        # self.stop_flag = threading.Event()
 
     def run(self):
         self.running = True
-        # while not self.stop_flag.is_set():
         while self.running:
-            try:
-                connectionSocket, addr = self.serverSocket.accept()
-                rdt = rdt_socket(connectionSocket)
-                package = rdt.recvBytes()
-                file = obj_decode(package)
-                if self.recv_fn:
-                    response = self.recv_fn(file, connectionSocket)
-                    package_back = obj_encode(response)
-                    rdt.sendBytes(package_back)
-            except BlockingIOError:
-                pass
-            # except Exception as e:
-            #     print("Server get exception:", type(e).__name__)
-        
+            for key, _ in self.selector.select(self.next_deadline()):
+                if key.fileobj is self.wakeup_recv:
+                    self.wakeup_recv.recv(1024)
+                elif key.fileobj is self.serverSocket:
+                    try:
+                        connectionSocket, addr = self.serverSocket.accept()
+                    except BlockingIOError:
+                        continue
+                    self.dispatch(connectionSocket, rdt_socket(connectionSocket))
+                else:
+                    self.selector.unregister(key.fileobj)
+                    self.idle.pop(key.fileobj, None)
+                    self.dispatch(key.fileobj, key.data)
+            self.watch_rearmed()
+            self.close_idle()
+            self.update_accepting()
+
+        for connectionSocket in self.idle:
+            connectionSocket.close()
+        self.selector.close()
         self.serverSocket.close()
-                
+        self.workers.shutdown(wait=True)
+        while self.rearmed:
+            self.rearmed.popleft()[0].close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
+
+    def dispatch(self, connectionSocket, rdt):
+        with self.lock:
+            self.busy_workers += 1
+        self.workers.submit(self.handle, connectionSocket, rdt)
+
+    def update_accepting(self):
+        with self.lock:
+            accepting = self.busy_workers < self.max_workers
+        if accepting != self.accepting:
+            if accepting:
+                self.selector.register(self.serverSocket, selectors.EVENT_READ)
+            else:
+                self.selector.unregister(self.serverSocket)
+            self.accepting = accepting
+
+    def watch_rearmed(self):
+        while self.rearmed:
+            connectionSocket, rdt = self.rearmed.popleft()
+            if rdt.end > rdt.start:  # the next request is buffered already
+                self.dispatch(connectionSocket, rdt)
+                continue
+            self.selector.register(connectionSocket, selectors.EVENT_READ, rdt)
+            self.idle[connectionSocket] = time.monotonic() + self.keep_alive
+
+    def next_deadline(self):
+        for deadline in self.idle.values():
+            return max(0, deadline - time.monotonic())
+        return None
+
+    def close_idle(self):
+        now = time.monotonic()
+        while self.idle:
+            connectionSocket, deadline = next(iter(self.idle.items()))
+            if deadline > now:
+                break
+            self.idle.pop(connectionSocket)
+            self.selector.unregister(connectionSocket)
+            connectionSocket.close()
+
+    def handle(self, connectionSocket, rdt):
+        keep = False
+        handed_off = False
+        try:
+            connectionSocket.settimeout(self.timeout)
+            package = rdt.recvBytes()
+            file = decode_message(package)
+            if self.recv_fn:
+                # whoever takes the connection over reads it at its own pace
+                connectionSocket.settimeout(None)
+                response = self.recv_fn(file, connectionSocket)
+                # a handler that takes the connection over answers on its own
+                if response is None:
+                    handed_off = True
+                else:
+                    connectionSocket.settimeout(self.timeout)
+                    package_back = encode_response(response, file)
+                    rdt.sendBytes(package_back)
+                    keep = self.keep_alive > 0
+        except OSError:  # timeouts and connections the client dropped included
+            pass
+        except Exception:
+            traceback.print_exc()
+        finally:
+            if keep:
+                self.rearmed.append((connectionSocket, rdt))
+            elif not handed_off:
+                connectionSocket.close()
+            with self.lock:
+                self.busy_workers -= 1
+            self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.wakeup_send.send(b'\0')
+        except OSError:
+            pass
+
     def stop(self):
         if self.running:
             self.running = False
+            self.wakeup()
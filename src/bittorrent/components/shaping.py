@@ -0,0 +1,128 @@
+import time
+import weakref
+import threading
+
+
+UP = "up"
+DOWN = "down"
+
+
+class TokenBucket:
+    def __init__(self, rate=None, burst=None):
+        """
+        A token bucket in bytes
+        :param rate: bytes per second, None for no limit
+        :param burst: bytes that may pass at once after an idle spell, a quarter second of `rate` if not given
+
+        Traffic is charged a frame at a time after the frame is sent or received, which may leave the bucket in debt;
+        the caller then waits until the debt is paid off, so the cost is a few float operations per frame whatever
+        its size.
+        """
+        self.lock = threading.Lock()
+        self.rate = None
+        self.burst = None
+        self.tokens = 0.0
+        self.last = time.monotonic()
+        self.set_rate(rate, burst)
+        self.tokens = self.burst
+
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self.rate = rate if rate and rate > 0 else None
+            self.burst = burst if burst is not None else max(16 * 1024, (self.rate or 0) / 4)
+            self.tokens = min(self.tokens, self.burst)
+
+    def charge(self, size, now=None):
+        """
+        :return: seconds to wait before the next frame
+        """
+        if self.rate is None:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if self.rate is None:
+                return 0.0
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate) - size
+            self.last = now
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class Shaper:
+    def __init__(self, up=None, down=None, peer_up=None, peer_down=None):
+        """
+        Bandwidth limits of a peer, each in bytes per second, None for no limit
+        :param up: upload of all connections together
+        :param down: download of all connections together
+        :param peer_up: upload of each connection
+        :param peer_down: download of each connection
+
+        Every frame is charged to the bucket of its direction at three levels, the whole peer, the torrent of the
+        file it carries if any, and its connection, and the connection waits for the slowest of them. Per-torrent
+        limits are set with `set_limit` under the file name.
+        """
+        self.lock = threading.Lock()
+        self.buckets = {UP: TokenBucket(up), DOWN: TokenBucket(down)}
+        self.torrents = {}
+        self.peer_limits = {UP: peer_up, DOWN: peer_down}
+        self.connections = weakref.WeakSet()
+
+    def connection(self):
+        """
+        The shaper of a new connection, for `PeerClient` and `AsyncPeerConnection`
+        """
+        connection = ConnectionShaper(self)
+        with self.lock:
+            self.connections.add(connection)
+        return connection
+
+    def torrent(self, file):
+        buckets = self.torrents.get(file)
+        if buckets is None:
+            with self.lock:
+                buckets = self.torrents.setdefault(file, {UP: TokenBucket(), DOWN: TokenBucket()})
+        return buckets
+
+    def set_limit(self, scope, direction, rate):
+        """
+        :param scope: "global", "peer" for every connection, or the name of a file for its torrent
+        :param direction: "up" or "down"
+        :param rate: bytes per second, None or 0 to lift the limit
+        """
+        if direction not in (UP, DOWN):
+            raise ValueError(f'Invalid direction {direction}')
+        if scope == "global":
+            self.buckets[direction].set_rate(rate)
+        elif scope == "peer":
+            with self.lock:
+                self.peer_limits[direction] = rate
+                connections = list(self.connections)
+            for connection in connections:
+                connection.buckets[direction].set_rate(rate)
+        else:
+            self.torrent(scope)[direction].set_rate(rate)
+
+    def limits(self):
+        return {
+            'global': {d: b.rate for d, b in self.buckets.items()},
+            'peer': dict(self.peer_limits),
+            'torrents': {file: {d: b.rate for d, b in buckets.items()} for file, buckets in self.torrents.items()},
+        }
+
+
+class ConnectionShaper:
+    def __init__(self, shaper):
+        self.shaper = shaper
+        self.buckets = {UP: TokenBucket(shaper.peer_limits[UP]), DOWN: TokenBucket(shaper.peer_limits[DOWN])}
+
+    def charge(self, direction, size, message=None):
+        """
+        Charge a frame to every level
+        :param message: the decoded frame, whose `file` picks the torrent
+        :return: seconds to wait before the next frame in that direction
+        """
+        now = time.monotonic()
+        wait = max(self.shaper.buckets[direction].charge(size, now), self.buckets[direction].charge(size, now))
+        file = message.get('file') if isinstance(message, dict) else None
+        if file is not None:
+            wait = max(wait, self.shaper.torrent(file)[direction].charge(size, now))
+        return wait
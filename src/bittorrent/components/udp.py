@@ -0,0 +1,56 @@
+import threading
+import traceback
+from socket import *
+
+
+# the largest datagram taken in, well above any request of the UDP tracker protocol
+MAX_DATAGRAM = 2048
+
+
+class UdpServer(threading.Thread):
+    def __init__(self, host="", port=7889, recv_fn=None, tick=0.2):
+        """
+        A server of datagrams, for request/response protocols that fit in one datagram each way
+        :param host:
+        :param port:
+        :param recv_fn: called as recv_fn(data, address) for every datagram, the bytes it returns are sent back, None
+        sends nothing
+        :param tick: seconds between checks of `running` while no datagram comes in
+
+        There are no connections to accept or keep, so one thread serves every client.
+        """
+        super().__init__(daemon=True)
+
+        self.host = host
+        self.port = port
+        self.serverSocket = socket(AF_INET, SOCK_DGRAM)
+        self.serverSocket.bind((host, port))
+        self.serverSocket.settimeout(tick)
+        self.recv_fn = recv_fn
+        self.running = False
+
+    def run(self):
+        self.running = True
+        try:
+            while self.running:
+                try:
+                    data, address = self.serverSocket.recvfrom(MAX_DATAGRAM)
+                except timeout:
+                    continue
+                except OSError:  # e.g. an ICMP error for an earlier answer
+                    continue
+                try:
+                    response = self.recv_fn(data, address)
+                except Exception:
+                    traceback.print_exc()
+                    continue
+                if response is not None:
+                    try:
+                        self.serverSocket.sendto(response, address)
+                    except OSError:
+                        pass
+        finally:
+            self.serverSocket.close()
+
+    def stop(self):
+        self.running = False
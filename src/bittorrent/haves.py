@@ -0,0 +1,51 @@
+import time
+import threading
+
+
+class HaveCoalescer:
+    def __init__(self, batch=False, max_batch=512, max_delay=0.1):
+        """
+        Have notifications waiting to be sent to one peer, so that a fast download does not send a message per piece
+        :param batch: whether the peer understands HaveBatch, otherwise the pending pieces go out as single Haves
+        :param max_batch: pieces pending before they are sent at once
+        :param max_delay: seconds the oldest pending piece may wait
+
+        Any thread may `add` pieces; the connection calls `flush` every time it gets to send, e.g. on its tick.
+        """
+        self.batch = batch
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending = {}
+        self.count = 0
+        self.since = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def add(self, file, index):
+        with self.lock:
+            self.pending.setdefault(file, []).append(index)
+            self.count += 1
+            if self.since is None:
+                self.since = time.monotonic()
+
+    def due(self, now=None):
+        now = time.monotonic() if now is None else now
+        return self.count >= self.max_batch or (self.since is not None and now - self.since >= self.max_delay)
+
+    def flush(self, make_message, force=False):
+        """
+        :param make_message: builds a message as `Peer.make_message` does
+        :param force: send whatever is pending, due or not
+        :return: the messages to send, none if nothing is due
+        """
+        with self.lock:
+            if not self.count or not (force or self.due()):
+                return []
+            pending, self.pending, self.count, self.since = self.pending, {}, 0, None
+
+        if self.batch:
+            return [make_message("HaveBatch", file=file, indices=indices) for file, indices in pending.items()]
+        return [make_message("Have", file=file, index=index, have=True)
+                for file, indices in pending.items() for index in indices]
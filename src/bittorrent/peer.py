@@ -6,10 +6,16 @@ import struct
 import bitarray
 import random
 import threading
+import collections
 from socket import *
 
 from components import *
 from piece_manager import PieceManager
+from pipeline import RequestPipeline
+from haves import HaveCoalescer
+from choker import Choker, RateMeter
+from swarm import unpack_peers
+from udp_tracker import UdpTrackerClient
 from torrent import Torrent
 from utils import *
 
@@ -23,29 +29,64 @@ INIT_STATES = {
         "interested": False,
     },
     "peer_bitfield": None,
-    "piece_request": None,
+    "pipeline": None,
+    "codec": CODEC_JSON,
+    "duplex": False,
+    "blocks": False,
+    "packed": False,
+    "haves": None,
+    "done": None,
+    "cancel": None,
+    "unchoke": False,
+    "down": None,
+    "up": None,
 }
+# protocol extensions advertised in the Bitfield handshake, and to the tracker for the peers that connect to us
+EXTENSIONS = ["pipeline", "blocks", "packed_bitfield", "have_batch"]
 
 
 class Peer(threading.Thread):
-    def __init__(self, name, base_dir="sandbox/peer/1/", host="", port=7889, pieceManager=None):
+    def __init__(self, name, base_dir="sandbox/peer/1/", host="", port=7889, pieceManager=None, pipeline_depth=None,
+                 max_pipeline_depth=64, engine="thread", storage_mode="pread",
+                 cache_size=64*1024*1024, cache_policy="lru", verify="eager", endgame=16,
+                 upload_slots=4, choke_interval=10.0, optimistic_interval=30.0, upload_limit=None, download_limit=None,
+                 numwant=50, udp_tracker=True, log_level="info"):
         super().__init__()
 
         self.cmd_lock = threading.Lock()
         self.cmd_queue = []
         self.name = name
         self.base_dir = base_dir
-        self.log_lock = threading.Lock()
-        self.log = self.init_log(name, base_dir, self.log_lock)
+        self.logger = self.init_log(name, base_dir, log_level)
+        self.log = self.logger.log
         self.online = False
         self.host = host
         self.port = port
         self.tracker_host = None
         self.tracker_port = None
         self.trackerConnection = None
-        self.pieceManager = pieceManager if pieceManager else PieceManager(base_dir)
-        self.server = Server(host, port, self.connected)
+        self.udp_tracker = udp_tracker
+        self.udpTracker = None
+        self.torrent = None
+        self.info_hash = None
+        self.numwant = numwant
+        # set from the answers of the tracker, which tells how often to announce
+        self.announce_interval = None
+        self.min_interval = None
+        self.next_announce = None
+        self.pieceManager = pieceManager if pieceManager else PieceManager(
+            base_dir, piece_buffer_size=cache_size, storage_mode=storage_mode, cache_policy=cache_policy,
+            verify=verify, endgame=endgame)
+        self.pieceManager.add_listener(self.piece_done)
+        self.pieceManager.add_block_listener(self.block_done)
+        self.server_cls, self.client_cls, self.connection_cls = ENGINES[engine]
+        self.server = self.server_cls(host, port, self.connected)
         self.peerConnections = {}
+        self.pipeline_depth = pipeline_depth
+        self.max_pipeline_depth = max_pipeline_depth
+        self.choker = Choker(upload_slots, choke_interval, optimistic_interval)
+        # bytes per second, of the whole peer here, per torrent and per connection with the 'limit' command
+        self.shaper = Shaper(upload_limit, download_limit)
         self.running = False
         self.busy = True
 
@@ -62,18 +103,13 @@ class Peer(threading.Thread):
             return self.cmd_queue.pop(0)
 
     @staticmethod
-    def init_log(name, base_dir, lock):
+    def init_log(name, base_dir, level=INFO):
         log_dir = os.path.join(base_dir, '.logs')
         if not os.path.exists(log_dir):
             os.makedirs(log_dir)
         timestamp = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
         log_file = os.path.join(log_dir, f'{name}_{timestamp}.log')
-
-        def log(msg):
-            with lock:
-                log_fn(msg, log_file)
-
-        return log
+        return AsyncLogger(log_file, level=level)
 
     def run(self):
         self.running = True
@@ -87,6 +123,10 @@ class Peer(threading.Thread):
             self.busy = True
 
             try:
+                if self.online and self.choker.due():
+                    self.rechoke()
+                if self.online and self.next_announce is not None and time.monotonic() >= self.next_announce:
+                    self.reannounce()
                 cmd_line = self.get_cmd()
                 if cmd_line:
                     cmd, *args = cmd_line.split(' ')
@@ -103,6 +143,27 @@ class Peer(threading.Thread):
                             self.pieceManager.add_file(file)
                     elif cmd in ['remaining', 'r']:
                         self.log(f'[INFO] The remaining pieces of peer {self.name} is {self.pieceManager.required_pieces}')
+                    elif cmd in ['cache', 'c']:
+                        stats = self.pieceManager.cache_stats()
+                        if stats is None:
+                            self.log(f'[INFO] Peer {self.name} serves pieces from mmap, without the piece cache')
+                        else:
+                            self.log(f'[INFO] The piece cache of peer {self.name} is {stats}')
+                    elif cmd in ['stats', 's']:
+                        self.log(f'[INFO] The download stats of peer {self.name} are {self.pieceManager.stats()}')
+                    elif cmd in ['limit', 'lim']:
+                        # limit [global|peer|<file> up|down <KiB/s, 0 for none>]
+                        if args:
+                            try:
+                                scope, direction, rate = args
+                                rate = float(rate)
+                                if not 0 <= rate < float('inf'):
+                                    raise ValueError(f'Invalid rate {rate}')
+                                self.shaper.set_limit(scope, direction, int(rate * 1024))
+                            except ValueError:
+                                self.log('[ERROR] Usage: limit [global|peer|<file> up|down <KiB/s, 0 for none>]',
+                                         ERROR)
+                        self.log(f'[INFO] The bandwidth limits of peer {self.name} are {self.shaper.limits()}')
                     # elif cmd in ['directory', 'dir']:
                     #     for d in args:
                     #         self.pieceManager.add_directory(d)
@@ -140,27 +201,32 @@ class Peer(threading.Thread):
                     self.busy = False
                     time.sleep(0.01)
             except Exception as e:
-                self.log("[ERROR] Peer get exception:", type(e).__name__)
+                self.log(f'[ERROR] Peer get exception: {type(e).__name__}', ERROR)
                 self.busy = False
 
         self.cleanup()
         self.log(f'[STOP] Peer {self.name} stopped')
+        self.logger.close()
 
     def cleanup(self):
         self.busy = True
         if self.online:
             self.leave_network()
+        for connection in list(self.peerConnections.values()):
+            connection.stop()
+            connection.join()
         self.log('[STOP] Stopping server...')
         self.server.stop()
         self.server.join()
         self.log('[STOP] Server stopped')
+        self.pieceManager.close()
 
     def join_network(self, torrent_file):
         if self.online:
-            self.log(f'[WARN] Peer {self.name} is already online, if you want to join another network, please leave first')
+            self.log(f'[WARN] Peer {self.name} is already online, if you want to join another network, please leave first', WARN)
             return
         if not os.path.exists(os.path.join(self.base_dir, torrent_file)):
-            self.log(f'[ERROR] Torrent file {torrent_file} does not exist')
+            self.log(f'[ERROR] Torrent file {torrent_file} does not exist', ERROR)
             return
 
         torrent = Torrent()
@@ -168,17 +234,19 @@ class Peer(threading.Thread):
 
         self.tracker_host = torrent.announce
         self.tracker_port = torrent.port
+        self.torrent = torrent
+        self.info_hash = torrent.info_hash
 
         try:
-            connectRequest = self.make_request("started")
-            self.trackerConnection = Client(self.tracker_host, self.tracker_port)
-            self.trackerConnection.send_file(connectRequest, self.connect_all)
-            self.trackerConnection.start()
+            if not self.announce_udp("started"):
+                self.announce_tcp("started")
             self.online = True
         except Exception as e:
             self.trackerConnection = None
+            self.udpTracker = None
+            self.next_announce = None
 
-            self.log(f'[ERROR] Failed to connect to tracker: {e}')
+            self.log(f'[ERROR] Failed to connect to tracker: {e}', ERROR)
             return
 
         self.log(f'[JOIN] Peer {self.name} has joined the network with host {self.tracker_host} and port {self.tracker_port}')
@@ -190,26 +258,97 @@ class Peer(threading.Thread):
 
     def leave_network(self):
         if not self.online:
-            self.log(f'[WARN] Peer {self.name} attempted to leave the network, but it has not joined any network yet')
+            self.log(f'[WARN] Peer {self.name} attempted to leave the network, but it has not joined any network yet', WARN)
             return
         self.log(f'[LEAVE] Peer {self.name} is leaving the network...')
 
 
         try:
-            connectRequest = self.make_request("stopped")
-            self.trackerConnection.send_file(connectRequest)
-            # self.log(f'[LEAVE] Peer {self.name} is sending a leave request to the tracker')
-            while self.trackerConnection.busy:
-                time.sleep(0.01)
-            self.trackerConnection.stop()
-            self.trackerConnection.join()
-            self.trackerConnection = None
+            if self.udpTracker is not None:
+                # a tracker that stopped answering lets the peer expire instead
+                if self.announce_udp("stopped"):
+                    self.udpTracker.close()
+                    self.udpTracker = None
+            else:
+                connectRequest = self.make_request("stopped")
+                self.trackerConnection.send_file(connectRequest)
+                # self.log(f'[LEAVE] Peer {self.name} is sending a leave request to the tracker')
+                while self.trackerConnection.busy:
+                    time.sleep(0.01)
+                self.trackerConnection.stop()
+                self.trackerConnection.join()
+                self.trackerConnection = None
             self.online = False
+            self.next_announce = None
         except Exception as e:
-            self.log(f'[ERROR] Failed to communicate with tracker: {type(e).__name__}')
+            self.log(f'[ERROR] Failed to communicate with tracker: {type(e).__name__}', ERROR)
 
         self.log(f'[LEAVE] Peer {self.name} has left the network')
 
+    def announce_udp(self, event):
+        """
+        Announce over the UDP tracker protocol, connecting to the peers handed out when joining
+        :return: whether the tracker answered over UDP, if it did not it is announced to over TCP from then on
+
+        An error answer, e.g. for a connection id the tracker no longer takes after a restart, drops the id, so the
+        announce is tried once more with a fresh one before giving up on UDP.
+        """
+        if not self.udp_tracker:
+            return False
+        if self.udpTracker is None and event != "started":
+            return False
+        try:
+            if self.udpTracker is None:
+                self.udpTracker = UdpTrackerClient(self.tracker_host, self.tracker_port)
+            for attempt in range(2):
+                response = self.udpTracker.announce(self.info_hash, self.host, self.port, event, left=self.left(),
+                                                    numwant=self.numwant, peer_id=f'{self.host}:{self.port}'.encode())
+                if not response['error_code']:
+                    break
+                self.log(f'[WARN] Peer {self.name} got an error from the UDP tracker: {response["message"]}'
+                         f'{", trying again" if attempt == 0 else ", using TCP"}', WARN)
+        except OSError as e:
+            self.log(f'[INFO] Peer {self.name} got no UDP answer from the tracker ({type(e).__name__}), using TCP')
+            response = None
+        if response is None or response['error_code']:
+            if self.udpTracker is not None:
+                self.udpTracker.close()
+            self.udpTracker = None
+            return False
+        if event != "stopped":
+            self.connect_all(response, None)
+        return True
+
+    def reannounce(self):
+        """
+        Announce again before the tracker takes the peer to be gone, and connect to the new peers it hands out
+        """
+        # tried again after a min interval unless the answer comes and schedules the next one
+        self.next_announce = time.monotonic() + (self.min_interval or self.announce_interval)
+        if self.udpTracker is not None and self.announce_udp(None):
+            return
+        # a regular announce adds a peer the tracker does not know, where a second "started" would be refused
+        self.announce_tcp("")
+
+    def announce_tcp(self, event):
+        """
+        Announce over TCP on the tracker connection, which is opened the first time it is needed and kept
+        until the peer leaves
+        """
+        if self.trackerConnection is None:
+            self.trackerConnection = self.client_cls(self.tracker_host, self.tracker_port, log=self.log)
+            self.trackerConnection.start()
+        self.trackerConnection.send_file(self.make_request(event), self.connect_all)
+
+    def left(self):
+        # bytes of the torrent joined still to download, as the tracker counts seeders by it
+        if self.torrent is None:
+            return 0
+        bitfield = self.pieceManager.bitfield.get(self.torrent.info['name'])
+        if bitfield is None:
+            return self.torrent.info['length']
+        return min(self.torrent.info['length'], bitfield.count(0) * self.torrent.info['piece_length'])
+
     def stop(self):
         self.running = False
 
@@ -218,7 +357,7 @@ class Peer(threading.Thread):
             self.join_network(torrent_file)
 
         if not os.path.exists(os.path.join(self.base_dir, torrent_file)):
-            self.log(f'[ERROR] Torrent file {torrent_file} does not exist')
+            self.log(f'[ERROR] Torrent file {torrent_file} does not exist', ERROR)
             return
 
         self.log(f'[DOWN] Peer {self.name} is downloading with torrent {torrent_file}...')
@@ -234,13 +373,29 @@ class Peer(threading.Thread):
         if file['error_code'] != 0:
             raise Exception(f'Error code {file["error_code"]}: {file["message"]}')
 
+        if file.get('interval'):
+            self.announce_interval = file['interval']
+            self.min_interval = file.get('min_interval')
+            self.next_announce = time.monotonic() + self.announce_interval
+
         self.log(f'[INFO] Peer {self.name} is connecting to {file["num-of-peers"]} peers')
-        message = self.make_message("Bitfield")
-        for peer in file['peers'].values():
+        peers = file['peers']
+        if isinstance(peers, (bytes, bytearray)):
+            peers = unpack_peers(peers, file.get('peer_flags'))
+        # a re-announce hands out peers connected already, either way
+        connected = {(connection.host, connection.port) for connection in list(self.peerConnections.values())}
+        connected.add((self.host, self.port))
+        for peer in peers.values():
+            if peer['peer_id'] in self.peerConnections or (peer['ip'], peer['port']) in connected:
+                continue
+            # the handshake goes out before the peer tells what it understands, the tracker knows it already
+            message = self.make_message("Bitfield", packed="packed_bitfield" in peer.get('extensions', []))
             message['ip'] = self.host
             message['port'] = self.port
             message['peer_id'] = f'{self.name}:{self.port}'
-            connection = PeerClient(peer['peer_id'], peer['ip'], peer['port'], recv_fn=self.serve, states=copy.deepcopy(INIT_STATES))
+            connection = self.connection_cls(peer['peer_id'], peer['ip'], peer['port'], recv_fn=self.serve,
+                                             states=self.make_states(), close_fn=self.disconnected,
+                                             shaper=self.shaper.connection())
             connection.set_server(message)
             connection.start()
             self.peerConnections[peer['peer_id']] = connection
@@ -255,97 +410,276 @@ class Peer(threading.Thread):
         :param states:
         :param new:
         :return:
-        :file:
+        :messages: the messages to send back, may be empty
         :stop:
         """
-        if message.get('type') != "KeepAlive":
+        if message.get('type') != "KeepAlive" and self.logger.enabled(DEBUG):
             message4log = {k: v for k, v in message.items() if k not in ["piece"]}
-            self.log(f'[SERVE] Peer {self.name} received message {message4log} from {peer_id}')
+            self.log(f'[SERVE] Peer {self.name} received message {message4log} from {peer_id}', DEBUG)
 
         if not self.online:
             response = self.make_message("ServerClose")
-            self.peerConnections.pop(peer_id)
-            return response, True
+            self.peerConnections.pop(peer_id, None)
+            return [response], True
 
         # deal with the message
         type = message['type'] if 'type' in message else None
-        stop = False
+        pipeline = states['pipeline']
         if type == "Choke":
             states['recv']['choke'] = True
+            # a choking peer drops the requests it has not answered yet
+            self.give_back(pipeline.drop_all())
         elif type == "UnChoke":
             states['recv']['choke'] = False
         elif type == "Interested":
-            self.log(f'[INFO] Peer {self.name} received interested message from {peer_id}')
+            self.log(f'[DEBUG] Peer {self.name} received interested message from {peer_id}', DEBUG)
             states['send']['interested'] = True
+            states['unchoke'] = self.choker.request(peer_id)
         elif type == "UnInterested":
             states['send']['interested'] = False
+            states['unchoke'] = False
+            self.choker.release(peer_id)
         elif type == "Have":
-            states['peer_bitfield'][message['file']][message['index']] = message['have']
-            self.pieceManager.update_count(peer_id, message['file'], message['index'], message['have'])
+            bitfield = self.get_peer_bitfield(states, message['file'])
+            if bitfield is not None and bitfield[message['index']] != bool(message['have']):
+                bitfield[message['index']] = message['have']
+                self.pieceManager.update_count(peer_id, message['file'], message['index'], message['have'])
+        elif type == "HaveBatch":
+            bitfield = self.get_peer_bitfield(states, message['file'])
+            for index in message['indices'] if bitfield is not None else ():
+                if not bitfield[index]:
+                    bitfield[index] = True
+                    self.pieceManager.update_count(peer_id, message['file'], index, True)
         elif type == "Bitfield":
-            states['peer_bitfield'] = {k: bitarray.bitarray(bf) for k, bf in message['bitfield'].items()}
+            states['peer_bitfield'] = {k: unpack_bitfield(bf) for k, bf in message['bitfield'].items()}
+            states['codec'] = choose_codec(message.get('codecs'))
+            states['duplex'] = "pipeline" in message.get('extensions', [])
+            states['blocks'] = "blocks" in message.get('extensions', [])
+            states['packed'] = "packed_bitfield" in message.get('extensions', [])
+            states['haves'].batch = "have_batch" in message.get('extensions', [])
+            if not states['duplex']:
+                pipeline.limit(1)
             self.pieceManager.update_count_from_bitfield(peer_id, states['peer_bitfield'])
         elif type == "Request":
             pass
+        elif type == "Cancel":
+            connection = self.peerConnections.get(peer_id)
+            if connection is not None:
+                key = (message['file'], message['index'], message['begin'])
+                connection.discard(lambda m: m.get('type') == "Piece" and (m['file'], m['index'], m.get('begin')) == key)
+        elif type == "Piece" and 'begin' in message:
+            file, index, begin = message['file'], message['index'], message['begin']
+            pipeline.complete((file, index, begin), len(message['piece']))
+            states['down'].add(len(message['piece']))
+            written = self.pieceManager.write_block(file, index, begin, message['piece'])
+            if written is False:
+                self.log(f'[ERROR] Peer {self.name} failed to write piece {index} of file {file}', ERROR)
         elif type == "Piece":
-            if states['piece_request'] is None or message['file'] != states['piece_request']['file'] or message['index'] != states['piece_request']['index']:
-                pass
-            if not self.pieceManager.write_piece(message['file'], message['index'], message['piece']):
-                self.log(f'[ERROR] Peer {self.name} failed to write piece {message["index"]} of file {message["file"]}')
-                self.pieceManager.require(states['piece_request']['file'], states['piece_request']['index'])
-            states['piece_request'] = None
+            file, index = message['file'], message['index']
+            requested = pipeline.complete((file, index), len(message['piece']))
+            states['down'].add(len(message['piece']))
+            if not requested and self.pieceManager.bitfield[file][index]:
+                pass  # a late answer to a request given up on, and fetched elsewhere meanwhile
+            elif not self.pieceManager.write_piece(file, index, message['piece']):
+                self.log(f'[ERROR] Peer {self.name} failed to write piece {index} of file {file}', ERROR)
+                if requested:
+                    self.pieceManager.require(file, index)
+            elif not requested:
+                self.pieceManager.require_not(file, index)
         elif type == "ServerClose":
-            self.peerConnections.pop(peer_id)
+            self.peerConnections.pop(peer_id, None)
         elif message['len'] == 0: # keep alive
             pass
         else:
             raise Exception(f'Invalid message type {type}')
 
         # make response
-        response = self.make_message("KeepAlive")
+        messages = []
         if type == "Bitfield" and new:
-            response = self.make_message("Bitfield")
+            messages.append(self.make_message("Bitfield", packed=states['packed']))
         elif type == "ServerClose":
-            response = self.make_message("ServerClose")
-            stop = True
-        elif type == "UnInterested":
-            states['send']['choke'] = True
-            response = self.make_message("Choke")
-        elif type == "Interested":
-            states['send']['choke'] = False
-            response = self.make_message("UnChoke")
+            return [self.make_message("ServerClose")], True
         elif type == "Request" and not states['send']['choke'] and states['send']['interested']:
             piece = self.pieceManager.read_piece(message['file'], message['index'])
-            response = self.make_message("Piece", file=message['file'], index=message['index'], piece=piece)
-        elif not states['recv']['choke'] and states['recv']['interested']:  # peer unchoke, my interested
-            if states['piece_request'] is None:
-                states['piece_request'] = self.pieceManager.get_piece_request(states['peer_bitfield'])
-            if states['piece_request'] is not None:
-                self.log(f'[INFO] Peer {self.name} is requesting piece {states["piece_request"]} from {peer_id}')
-                response = self.make_message("Request", file=states['piece_request']['file'], index=states['piece_request']['index'])
+            if 'begin' not in message:
+                messages.append(self.make_message("Piece", file=message['file'], index=message['index'], piece=piece))
+                states['up'].add(len(piece) if piece is not None else 0)
+            elif piece is not None and 0 <= message['begin'] < message['begin'] + message['length'] <= len(piece):
+                block = piece[message['begin']:message['begin'] + message['length']]
+                messages.append(self.make_message("Piece", file=message['file'], index=message['index'],
+                                                  begin=message['begin'], piece=block))
+                states['up'].add(len(block))
+
+        messages += self.update_choke(states)
+        messages += self.catch_up(peer_id, states)
+        messages += self.make_requests(peer_id, states)
+        if states['peer_bitfield'] is not None:
+            messages += states['haves'].flush(self.make_message)
+        return messages, False
+
+    def rechoke(self):
+        """
+        A round of the choker: rank the interested peers by how fast they upload to us, or once there is nothing left
+        to download by how fast we upload to them, and let each connection know whether it is unchoked now
+        """
+        seeding = self.pieceManager.seeding
+        connections = list(self.peerConnections.items())
+        peers = {}
+        for peer_id, connection in connections:
+            states = connection.states
+            if states['send']['interested'] and states['down'] is not None:
+                peers[peer_id] = (states['up'] if seeding else states['down']).rate()
+        unchoked = self.choker.rechoke(peers)
+        for peer_id, connection in connections:
+            connection.states['unchoke'] = peer_id in unchoked
+
+    def update_choke(self, states):
+        """
+        Choke or unchoke the peer as the choker last decided, on the connection's own thread
+        """
+        if states['unchoke'] != states['send']['choke']:
+            return []
+        states['send']['choke'] = not states['unchoke']
+        return [self.make_message("UnChoke" if states['unchoke'] else "Choke")]
+
+    def get_peer_bitfield(self, states, file):
+        """
+        The bitfield of a peer for a file, an empty one if the peer started it after the handshake
+        :return: None for a file we do not know
+        """
+        bitfield = states['peer_bitfield'].get(file)
+        if bitfield is None and file in self.pieceManager.bitfield:
+            bitfield = bitarray.bitarray(len(self.pieceManager.bitfield[file]))
+            bitfield.setall(False)
+            states['peer_bitfield'][file] = bitfield
+        return bitfield
+
+    def piece_done(self, file, index):
+        """
+        Pass a piece that just came in on to every connection, each of them deals with it in `catch_up`
+        """
+        for connection in list(self.peerConnections.values()):
+            connection.states['done'].append((file, index))
+
+    def block_done(self, file, index, begin):
+        """
+        Pass an endgame block that came in first on to every connection, those that still ask for it cancel it in
+        `catch_up`, which a duplex connection also runs on its idle tick
+        """
+        for connection in list(self.peerConnections.values()):
+            connection.states['cancel'].append((file, index, begin))
+
+    def catch_up(self, peer_id, states):
+        """
+        Cancel the blocks that came in through other peers, announce the pieces completed since the last message to
+        the peer, cancel what is still asked of it for them, and lose interest in it if it has nothing else we need
+        """
+        if states['peer_bitfield'] is None or not (states['done'] or states['cancel']):
+            return []
+
+        messages = []
+        pipeline = states['pipeline']
+        while states['cancel']:
+            key = states['cancel'].popleft()
+            if key in pipeline:
+                pipeline.drop(lambda k: k == key)
+                messages.append(self.make_message("Cancel", file=key[0], index=key[1], begin=key[2],
+                                                  length=self.pieceManager.block_length(*key)))
+        while states['done']:
+            file, index = states['done'].popleft()
+            if not self.pieceManager.peer_has(states['peer_bitfield'], file, index):
+                states['haves'].add(file, index)
+            for key in pipeline.drop(lambda key: key[:2] == (file, index)):
+                # a whole piece answered late is ignored anyway, a block can still be taken off the peer's queue
+                if len(key) == 3:
+                    messages.append(self.make_message("Cancel", file=file, index=index, begin=key[2],
+                                                      length=self.pieceManager.block_length(*key)))
+        if states['recv']['interested'] and states['recv']['choke'] and not len(pipeline) \
+                and not self.pieceManager.is_interesting(states['peer_bitfield']):
+            states['recv']['interested'] = False
+            messages.append(self.make_message("UnInterested"))
+        return messages
+
+    def make_requests(self, peer_id, states):
+        """
+        Keep the request pipeline of a connection full, and the interest in the peer up to date
+        """
+        if states['peer_bitfield'] is None:
+            return []
+
+        messages = []
+        pipeline = states['pipeline']
+        if not states['recv']['choke'] and states['recv']['interested']:  # peer unchoke, my interested
+            if states['blocks']:
+                for block_request in self.pieceManager.get_block_requests(states['peer_bitfield'], pipeline.free, pending=pipeline):
+                    pipeline.add((block_request['file'], block_request['index'], block_request['begin']))
+                    if self.logger.enabled(DEBUG):
+                        self.log(f'[DEBUG] Peer {self.name} is requesting block {block_request} from {peer_id}', DEBUG)
+                    messages.append(self.make_message("Request", **block_request))
             else:
+                while pipeline.free:
+                    piece_request = self.pieceManager.get_piece_request(states['peer_bitfield'], pending=pipeline)
+                    if piece_request is None:
+                        break
+                    pipeline.add((piece_request['file'], piece_request['index']))
+                    if self.logger.enabled(DEBUG):
+                        self.log(f'[DEBUG] Peer {self.name} is requesting piece {piece_request} from {peer_id}', DEBUG)
+                    messages.append(self.make_message("Request", file=piece_request['file'], index=piece_request['index']))
+            if not len(pipeline):
                 states['recv']['interested'] = False
-                response = self.make_message("UnInterested")
+                messages.append(self.make_message("UnInterested"))
         elif states['recv']['choke'] and not states['recv']['interested']:  # peer choke, my uninterested
-            if states['piece_request'] is not None:
-                self.pieceManager.require(states['piece_request']['file'], states['piece_request']['index'])
-            states['piece_request'] = self.pieceManager.get_piece_request(states['peer_bitfield'])
-            if states['piece_request'] is not None:
+            if self.pieceManager.is_interesting(states['peer_bitfield']):
                 states['recv']['interested'] = True
-                response = self.make_message("Interested")
+                messages.append(self.make_message("Interested"))
+
+        return messages
 
-        return response, stop
+    def make_states(self):
+        states = copy.deepcopy(INIT_STATES)
+        states['pipeline'] = RequestPipeline(depth=self.pipeline_depth, max_depth=self.max_pipeline_depth)
+        states['haves'] = HaveCoalescer()
+        states['done'] = collections.deque()
+        states['cancel'] = collections.deque()
+        states['down'] = RateMeter()
+        states['up'] = RateMeter()
+        return states
 
     def connected(self, message, connectionSocket):
         self.log(f'[INFO] Peer {self.name} is connected by {message["peer_id"]}')
-        connection = PeerClient(message['peer_id'], message['ip'], message['port'], recv_fn=self.serve, states=copy.deepcopy(INIT_STATES))
-        response, _ = self.serve(message['peer_id'], message, connectionSocket, states=connection.states, new=True)
-        self.log(f'[INFO] Peer {self.name} sent message {response} to {message["peer_id"]}')
-        connection.set_server(response, socket=connectionSocket)
+        connection = self.connection_cls(message['peer_id'], message['ip'], message['port'], recv_fn=self.serve,
+                                         states=self.make_states(), close_fn=self.disconnected,
+                                         shaper=self.shaper.connection())
+        messages, _ = self.serve(message['peer_id'], message, connectionSocket, states=connection.states, new=True)
+        self.log(f'[DEBUG] Peer {self.name} sent message {messages[0]} to {message["peer_id"]}', DEBUG)
+        # the connection answers the handshake itself, the rest of the messages follow it
+        connection.set_server(messages[0], socket=connectionSocket)
+        for m in messages[1:]:
+            connection.send(m)
         connection.start()
         self.peerConnections[message['peer_id']] = connection
 
-        return response
+        return None
+
+    def give_back(self, keys):
+        """
+        Make requests that will not be answered available again, whole pieces as well as blocks
+        """
+        for key in keys:
+            if len(key) == 3:
+                self.pieceManager.release_block(*key)
+            else:
+                self.pieceManager.require(*key)
+
+    def disconnected(self, peer_id, states):
+        self.choker.release(peer_id)
+        self.give_back(states['pipeline'].drop_all())
+        if states['peer_bitfield'] is not None:
+            self.pieceManager.update_count_from_bitfield(peer_id, states['peer_bitfield'], have=False)
+        connection = self.peerConnections.get(peer_id)
+        if connection is not None and connection.states is states:
+            self.peerConnections.pop(peer_id)
+        self.log(f'[INFO] Peer {self.name} disconnected from {peer_id}')
 
     def make_request(self, event="started"):
         request = {
@@ -353,6 +687,11 @@ class Peer(threading.Thread):
             'ip': self.host,
             'peer_id': f"{self.host}:{self.port}",
             'event': event,
+            'info_hash': self.info_hash,
+            'numwant': self.numwant,
+            'compact': True,
+            'left': self.left(),
+            'extensions': EXTENSIONS,
         }
 
         return request
@@ -380,21 +719,41 @@ class Peer(threading.Thread):
             message['have'] = kwargs['have']
             message['file'] = kwargs['file']
             message['index'] = kwargs['index']
+        elif type == "HaveBatch":
+            message['len'] = 5 + 4 * len(kwargs['indices'])
+            message['id'] = 12
+            message['file'] = kwargs['file']
+            message['indices'] = kwargs['indices']
         elif type == "Bitfield":
             message['len'] = 1 + len(self.pieceManager.bitfield)
             message['id'] = 5
-            message['bitfield'] = {k: bf.tolist() for k, bf in self.pieceManager.bitfield.items()}
+            pack = pack_bitfield if kwargs.get('packed') else bitarray.bitarray.tolist
+            message['bitfield'] = {k: pack(bf) for k, bf in self.pieceManager.bitfield.items()}
+            message['codecs'] = SUPPORTED_CODECS
+            message['extensions'] = EXTENSIONS
         elif type == "Request":
             message['len'] = 13
             message['id'] = 6
             message['file'] = kwargs['file']
             message['index'] = kwargs['index']
+            if 'begin' in kwargs:  # a block rather than the whole piece
+                message['begin'] = kwargs['begin']
+                message['length'] = kwargs['length']
         elif type == "Piece":
             message['len'] = 9 + len(kwargs['piece'])
             message['id'] = 7
             message['file'] = kwargs['file']
             message['index'] = kwargs['index']
+            if 'begin' in kwargs:
+                message['begin'] = kwargs['begin']
             message['piece'] = kwargs['piece']
+        elif type == "Cancel":
+            message['len'] = 13
+            message['id'] = 9
+            message['file'] = kwargs['file']
+            message['index'] = kwargs['index']
+            message['begin'] = kwargs['begin']
+            message['length'] = kwargs['length']
         elif type == "KeepAlive":
             message['len'] = 0
         elif type == "ServerClose":
@@ -414,9 +773,28 @@ if __name__ == '__main__':
     parser.add_argument('-D', '--dir', type=str, default='.', help='Directory to store files')
     parser.add_argument('-H', '--host', type=str, default='', help='Host of the peer')
     parser.add_argument('-P', '--port', type=int, default=0, help='Port of the peer')
+    parser.add_argument('--pipeline-depth', type=int, default=None, help='Outstanding requests per peer, adaptive if not given')
+    parser.add_argument('--max-pipeline-depth', type=int, default=64, help='Upper bound of the adaptive pipeline depth')
+    parser.add_argument('--engine', type=str, default='thread', choices=list(ENGINES), help='Networking engine')
+    parser.add_argument('--storage', type=str, default='pread', choices=['pread', 'mmap'], help='How pieces are read from disk')
+    parser.add_argument('--cache-size', type=int, default=64, help='Megabytes of pieces cached in memory')
+    parser.add_argument('--verify', type=str, default='eager', choices=['eager', 'lazy'], help='Hash changed files before starting, or in the background')
+    parser.add_argument('--cache-policy', type=str, default='lru', choices=['lru', '2q'], help='Eviction policy of the piece cache')
+    parser.add_argument('--endgame', type=int, default=16, help='Missing pieces of a file at which the outstanding ones are asked from every peer, 0 to disable')
+    parser.add_argument('--upload-slots', type=int, default=4, help='Peers unchoked at once, one of them optimistically')
+    parser.add_argument('--no-udp-tracker', action='store_true', help='Announce over TCP only')
+    parser.add_argument('--upload-limit', type=int, default=0, help='KiB/s the peer uploads at most, 0 for no limit')
+    parser.add_argument('--download-limit', type=int, default=0, help='KiB/s the peer downloads at most, 0 for no limit')
+    parser.add_argument('--log-level', type=str, default='info', choices=list(LOG_LEVELS), help='Least level of the messages logged')
     args = parser.parse_args()
 
-    peer = Peer(args.name, args.dir, args.host, args.port)
+    peer = Peer(args.name, args.dir, args.host, args.port, pipeline_depth=args.pipeline_depth,
+                max_pipeline_depth=args.max_pipeline_depth, engine=args.engine, storage_mode=args.storage,
+                cache_size=args.cache_size * 1024 * 1024, cache_policy=args.cache_policy, verify=args.verify,
+                endgame=args.endgame, upload_slots=args.upload_slots,
+                upload_limit=args.upload_limit * 1024 if args.upload_limit else None,
+                download_limit=args.download_limit * 1024 if args.download_limit else None,
+                udp_tracker=not args.no_udp_tracker, log_level=args.log_level)
     peer.start()
 
     while True:
@@ -0,0 +1,243 @@
+import random
+import bisect
+import bitarray
+import numpy as np
+
+
+# required pieces a pick walks past for every one the peer has before it looks the peer's pieces up instead
+MAX_BLIND_SCAN = 64
+# added to the availability of pieces nobody is known to have, so that they sort after every other
+NOBODY = 1 << 40
+
+
+def bitfield_to_array(bitfield):
+    """
+    A bitarray as a NumPy boolean vector of the same length
+    """
+    endian = bitfield.endian() if callable(bitfield.endian) else bitfield.endian  # a method before bitarray 3
+    bits = np.unpackbits(np.frombuffer(bitfield.tobytes(), dtype=np.uint8), count=len(bitfield), bitorder=endian)
+    return bits.view(bool)
+
+
+class PiecePicker:
+    def __init__(self, sample=10):
+        """
+        The pieces still required, ordered by how many peers have them, for rarest-first downloading
+        :param sample: a request picks at random among this many of the rarest pieces the peer has
+
+        `availability` maps each file to a NumPy vector of the number of peers that have each of its pieces, so the
+        bitfield of a peer that connects or leaves is added or subtracted in one vectorized operation. A required
+        piece sits in `buckets[count][file]`, a set of piece indices, where count is its availability, and `levels`
+        is the sorted list of the counts that have a non-empty bucket. Requiring a piece, dropping it or changing its
+        availability moves it between two buckets in O(1), plus O(log n) when a level appears or disappears, and a
+        whole bitfield moves the required pieces it covers with one set operation per level.
+
+        `wanted` mirrors the required pieces as one bitarray per file, so which of them a peer has is a single AND
+        over its bitfield. A pick walks the buckets from the rarest level up and only looks at pieces that are rarer
+        than the ones it returns, which is quick when the peer has a fair share of them. When it keeps missing, the
+        peer has few, and walking on would pass over most required pieces; the pick takes the AND instead and the
+        availability of the pieces it leaves from the NumPy vectors, a vectorized pass over the file rather than a
+        Python loop over the required pieces.
+        """
+        self.sample = sample
+        self.availability = {}
+        self.wanted = {}
+        self.buckets = {}
+        self.levels = []
+        # pieces taken out of each bucket set since it was last rebuilt, see `_compact`
+        self.removed = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key):
+        file, index = key
+        return file in self.wanted and index < len(self.wanted[file]) and self.wanted[file][index]
+
+    def __iter__(self):
+        # rarest first
+        for count in self.levels:
+            for file, indices in self.buckets[count].items():
+                for index in indices:
+                    yield file, index
+
+    def add_file(self, file, length):
+        """
+        Make room for `length` pieces of a file, keeping what is known about it already
+        """
+        if file not in self.availability:
+            self.availability[file] = np.zeros(length, dtype=np.int32)
+            self.wanted[file] = bitarray.bitarray(length)
+            self.wanted[file].setall(False)
+        elif length > len(self.availability[file]):
+            extra = length - len(self.availability[file])
+            self.availability[file] = np.concatenate([self.availability[file], np.zeros(extra, dtype=np.int32)])
+            self.wanted[file].extend(bitarray.bitarray('0') * extra)
+
+    def _bucket(self, count):
+        bucket = self.buckets.get(count)
+        if bucket is None:
+            bucket = self.buckets[count] = {}
+            bisect.insort(self.levels, count)
+        return bucket
+
+    def _compact(self, file, count, removed):
+        """
+        Drop an empty bucket set, or rebuild one that lost more pieces than it holds: a set never shrinks on its own,
+        and a pick iterating it would walk over the slots of every piece taken out of it before
+        """
+        bucket = self.buckets[count]
+        indices = bucket[file]
+        if not indices:
+            del bucket[file]
+            self.removed.pop((count, file), None)
+            if not bucket:
+                del self.buckets[count]
+                del self.levels[bisect.bisect_left(self.levels, count)]
+            return
+        removed += self.removed.get((count, file), 0)
+        if removed > len(indices) + MAX_BLIND_SCAN:
+            bucket[file] = set(indices)
+            removed = 0
+        self.removed[(count, file)] = removed
+
+    def _bucket_add(self, file, index, count):
+        self._bucket(count).setdefault(file, set()).add(index)
+
+    def _bucket_remove(self, file, index, count):
+        self.buckets[count][file].discard(index)
+        self._compact(file, count, 1)
+
+    def require(self, file, index):
+        """
+        :return: whether the piece was not required already
+        """
+        self.add_file(file, index + 1)
+        if self.wanted[file][index]:
+            return False
+        self.wanted[file][index] = True
+        self._bucket_add(file, index, int(self.availability[file][index]))
+        self.size += 1
+        return True
+
+    def require_not(self, file, index):
+        """
+        :return: whether the piece was required
+        """
+        if (file, index) not in self:
+            return False
+        self.wanted[file][index] = False
+        self._bucket_remove(file, index, int(self.availability[file][index]))
+        self.size -= 1
+        return True
+
+    def update(self, file, index, delta):
+        """
+        Change the availability of a piece, e.g. by 1 when a peer announces it has the piece
+        """
+        self.add_file(file, index + 1)
+        count = int(self.availability[file][index])
+        self.availability[file][index] = count + delta
+        if self.wanted[file][index]:
+            self._bucket_remove(file, index, count)
+            self._bucket_add(file, index, count + delta)
+
+    def update_bitfield(self, file, bitfield, delta):
+        """
+        Change the availability of every piece set in a bitfield at once, by 1 when a peer connects and by -1 when
+        it leaves
+        """
+        self.add_file(file, len(bitfield))
+        bits = bitfield_to_array(bitfield)
+        counts = self.availability[file][:len(bits)]
+        wanted = self.wanted[file][:len(bitfield)]
+        if wanted.any():
+            # group the required pieces by their availability, each group moves between two buckets
+            moved = np.flatnonzero(bits & bitfield_to_array(wanted))
+            old = counts[moved]
+            order = np.argsort(old, kind='stable')
+            moved, old = moved[order], old[order]
+            levels, starts = np.unique(old, return_index=True)
+            for count, indices in zip(levels.tolist(), np.split(moved, starts[1:])):
+                indices = indices.tolist()
+                self.buckets[count][file].difference_update(indices)
+                self._compact(file, count, len(indices))
+                self._bucket(count + delta).setdefault(file, set()).update(indices)
+        counts += bits.astype(counts.dtype) * delta
+
+    def is_interesting(self, peer_bitfield):
+        """
+        Whether the peer has any piece still required
+        """
+        for file, bitfield in peer_bitfield.items():
+            wanted = self.wanted.get(file)
+            if wanted is None:
+                continue
+            n = min(len(wanted), len(bitfield))
+            if n == len(wanted) == len(bitfield):
+                if wanted.any() and (wanted & bitfield).any():
+                    return True
+            elif (wanted[:n] & bitfield[:n]).any():
+                return True
+        return False
+
+    def pick(self, peer_bitfield):
+        """
+        Take one of the rarest required pieces the peer has off the required pieces
+        :return: (file, index), or None if the peer has none of them
+        """
+        candidates = self._walk(peer_bitfield)
+        if candidates is None:
+            candidates = self._look_up(peer_bitfield)
+        if not candidates:
+            return None
+
+        file, index = random.choice(candidates)
+        self.require_not(file, index)
+        return file, index
+
+    def _walk(self, peer_bitfield):
+        """
+        The first `sample` pieces the peer has in the buckets, rarest first
+        :return: None once it walked past more than `MAX_BLIND_SCAN` pieces the peer misses for every one it has
+        """
+        candidates = []
+        misses = 0
+        start = bisect.bisect_left(self.levels, 1)
+        # pieces nobody is known to have come last, a peer only has them if its announcement was missed
+        for count in self.levels[start:] + self.levels[:start]:
+            for file, indices in self.buckets[count].items():
+                bitfield = peer_bitfield.get(file)
+                if bitfield is None:
+                    continue
+                for index in indices:
+                    if index < len(bitfield) and bitfield[index]:
+                        candidates.append((file, index))
+                        if len(candidates) == self.sample:
+                            return candidates
+                    else:
+                        misses += 1
+                        if misses > MAX_BLIND_SCAN * (len(candidates) + 1):
+                            return None
+        return candidates
+
+    def _look_up(self, peer_bitfield):
+        """
+        The `sample` rarest of the required pieces the peer has, found from its bitfield rather than the buckets
+        """
+        ranked = []
+        for file, bitfield in peer_bitfield.items():
+            wanted = self.wanted.get(file)
+            if wanted is None:
+                continue
+            n = min(len(wanted), len(bitfield))
+            indices = np.flatnonzero(bitfield_to_array(wanted[:n] & bitfield[:n]))
+            counts = self.availability[file][indices].astype(np.int64)
+            counts[counts < 1] += NOBODY
+            if len(indices) > self.sample:
+                rarest = np.argpartition(counts, self.sample - 1)[:self.sample]
+                indices, counts = indices[rarest], counts[rarest]
+            ranked.extend(zip(counts.tolist(), [file] * len(indices), indices.tolist()))
+        ranked.sort(key=lambda r: r[0])
+        return [(file, index) for _, file, index in ranked[:self.sample]]
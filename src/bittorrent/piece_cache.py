@@ -0,0 +1,117 @@
+import threading
+import collections
+
+
+class PieceCache:
+    def __init__(self, capacity=64*1024*1024, policy="lru", in_ratio=0.25, ghost_ratio=0.5):
+        """
+        Pieces kept in memory, bounded by their total size in bytes
+        :param capacity: bytes the cached pieces may take up
+        :param policy: "lru", or "2q" to keep a scan over many pieces from flushing the frequently read ones
+        :param in_ratio: share of the capacity that new pieces get under "2q"
+        :param ghost_ratio: keys of evicted new pieces remembered under "2q", relative to the pieces that fit
+
+        With "lru" every piece lives in `hot`, least recently used first. With "2q" a piece read for the first time
+        goes into the FIFO `new` instead; when it falls out of `new` only its key is remembered in `ghosts`, and a
+        piece read again while its key is remembered is promoted into `hot`. A single pass over a file therefore only
+        ever cycles through `new`.
+
+        All methods may be called from any thread. `hits`, `misses` and `evictions` count since the cache was made.
+        """
+        if policy not in ("lru", "2q"):
+            raise ValueError(f'Invalid cache policy {policy}')
+        self.capacity = capacity
+        self.policy = policy
+        self.in_capacity = int(capacity * in_ratio) if policy == "2q" else 0
+        self.ghost_ratio = ghost_ratio
+        self.hot = collections.OrderedDict()
+        self.new = collections.OrderedDict()
+        self.ghosts = collections.OrderedDict()
+        self.hot_size = 0
+        self.new_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.hot) + len(self.new)
+
+    def __contains__(self, key):
+        return key in self.hot or key in self.new
+
+    @property
+    def size(self):
+        return self.hot_size + self.new_size
+
+    def get(self, key):
+        with self.lock:
+            if key in self.hot:
+                self.hot.move_to_end(key)
+                self.hits += 1
+                return self.hot[key]
+            if key in self.new:  # FIFO, a second read within `new` does not promote it
+                self.hits += 1
+                return self.new[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, piece):
+        size = len(piece)
+        if size > self.capacity:
+            return
+        with self.lock:
+            self._remove(key)
+            if self.policy == "lru" or self.ghosts.pop(key, None) is not None:
+                self.hot[key] = piece
+                self.hot_size += size
+            else:
+                self.new[key] = piece
+                self.new_size += size
+            self._evict()
+
+    def discard(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.hot.clear()
+            self.new.clear()
+            self.ghosts.clear()
+            self.hot_size = self.new_size = 0
+
+    def _remove(self, key):
+        if key in self.hot:
+            self.hot_size -= len(self.hot.pop(key))
+        elif key in self.new:
+            self.new_size -= len(self.new.pop(key))
+
+    def _evict(self):
+        while self.hot_size + self.new_size > self.capacity:
+            # `new` gives up its oldest piece while it holds more than its share, or when `hot` is empty
+            if self.new and (self.new_size > self.in_capacity or not self.hot):
+                key, piece = self.new.popitem(last=False)
+                self.new_size -= len(piece)
+                self.ghosts[key] = True
+                max_ghosts = max(1, int(self.ghost_ratio * len(self)))
+                while len(self.ghosts) > max_ghosts:
+                    self.ghosts.popitem(last=False)
+            else:
+                _, piece = self.hot.popitem(last=False)
+                self.hot_size -= len(piece)
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'policy': self.policy,
+                'capacity': self.capacity,
+                'size': self.hot_size + self.new_size,
+                'pieces': len(self.hot) + len(self.new),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
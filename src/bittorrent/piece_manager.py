@@ -1,4 +1,5 @@
 import os
+import time
 import random
 import collections
 import bisect
@@ -8,15 +9,33 @@ import threading
 
 from utils import *
 from torrent import *
+from storage import FileStorage, MmapFileStorage, PART_SUFFIX
+from piece_cache import PieceCache
+from picker import PiecePicker
+from resume import ResumeData
+from blocks import PartialPiece, BLOCK_SIZE
+
+STORAGE_MODES = {
+    "pread": FileStorage,
+    "mmap": MmapFileStorage,
+}
 
 
 class PieceManager:
-    def __init__(self, base_dir="", piece_len=4096, piece_buffer_size=1024*1024):
+    def __init__(self, base_dir="", piece_len=4096, piece_buffer_size=64*1024*1024, storage_mode="pread",
+                 cache_policy="lru", verify="eager", endgame=16):
         """
         A piece manager that manages the pieces of files
         :param base_dir:
         :param piece_len:
-        :param piece_buffer_size:
+        :param piece_buffer_size: bytes of pieces kept in memory
+        :param storage_mode: "pread" reads pieces with positional I/O, "mmap" serves them as memoryviews of mapped
+        files, which the page cache keeps, so they bypass `piece_buffer`
+        :param cache_policy: eviction policy of `piece_buffer`, "lru" or the scan resistant "2q"
+        :param verify: "eager" hashes the files without a valid resume record before returning, "lazy" leaves it to a
+        background thread and adds each file once it is hashed
+        :param endgame: pieces missing from a file, all of them asked for already, at or below which the file is in
+        endgame mode, 0 to never enter it
 
 
         The piece manager does not manage any files or directories at initialization.
@@ -24,14 +43,29 @@ class PieceManager:
         Each file takes an item in the dict `bitfield`. The key is the file name appended with the md5 hash sum of the
         file, and the value is the bitarray bitfield of the file.
 
-        For memory-performance balance, LRU or a certain other strategy is used. Pieces in memory are stored in a
-        dictionary `piece_buffer`, while pieces on disk are stored in a folder [base_dir]/.pieces.
+        For memory-performance balance, pieces in memory are kept in `piece_buffer`, a `PieceCache` bounded in bytes
+        that evicts by LRU or 2Q and is written through when a piece arrives, while pieces on disk are written in
+        place into the file itself through its `FileStorage` in `storage`. Pieces of an older layout, one file each in
+        [base_dir]/.pieces, are migrated.
+
+        What is on disk is recorded in `resume`, so a restart only hashes the files that changed since; downloads left
+        unfinished pick up where they stopped. Records are saved when a file is added or completed and on `close`.
+
+        To facilitate rarest-first downloading, the pieces required by the client are kept by `picker`, a
+        `PiecePicker` that also tracks how many peers have each piece (`count`). When a piece is required to be
+        downloaded, it is added to the picker. When a piece is (ready to be) downloaded, it will be removed then.
 
-        To facilitate rarest-first downloading, the piece manager maintains a dictionary `count` that maps each piece
-        to the number of peers that have that piece.
+        Peers that speak the block protocol download a piece in blocks, several peers may share one piece. A piece
+        taken off the picker for them becomes a `PartialPiece` in `partial` until all its blocks are in and it is
+        verified as a whole; `open_pieces` holds the ones with blocks nobody has been asked for yet, which are handed
+        out before any new piece is started.
 
-        `required_pieces` is a list of pieces that are required by the client. When a piece is required to be
-        downloaded, it is added to `required_pieces`. When a piece is (ready to be) downloaded, it will be removed then.
+        In endgame mode the pieces and blocks still outstanding are asked for again from every peer that has them, so
+        that a slow peer cannot hold up the end of a download; the first copy to arrive wins and the peers are told to
+        cancel the others. `tail` keeps how long each file took from entering endgame to completion.
+
+        Whoever needs to know when a piece is in, e.g. to tell the peers, registers with `add_listener`, and with
+        `add_block_listener` to know when a block still asked of other peers in endgame mode is in.
 
         Since multiple threads would operate piece manager, `lock` shall be used on modification.
         """
@@ -40,144 +74,452 @@ class PieceManager:
         self.piece_len = piece_len
         self.bitfield = {}
         self.torrents = {}
-        self.count = {}
+        self.storage = {}
+        self.storage_mode = storage_mode
+        self.storage_cls = STORAGE_MODES[storage_mode]
+        self.picker = PiecePicker()
+        self.partial = {}
+        self.open_pieces = collections.OrderedDict()
+        self.count = self.picker.availability
         self.piece_buffer_size = piece_buffer_size
-        self.piece_buffer = collections.OrderedDict()
+        self.piece_buffer = PieceCache(piece_buffer_size, cache_policy)
         # self.hashes = {}
-        self.required_pieces = []
-        self.required_pieces_count = []
         self.lock = threading.Lock()
+        # pieces that passed their hash check and are being written
+        self.writing = set()
+        self.resume = ResumeData(base_dir)
+        self.verify = verify
+        self.verifier = None
+        self.closing = False
+        self.listeners = []
+        self.block_listeners = []
+        self.endgame_threshold = endgame
+        self.endgame = {}
+        self.tail = {}
 
         self.init()
 
     def init(self):
-        if not os.path.exists(self.pieces_folder):
-            os.mkdir(self.pieces_folder)
-
-        for item in os.listdir(self.base_dir):
-            if item.startswith('.'):
+        changed = []
+        for item in sorted(os.listdir(self.base_dir)):
+            if item.startswith('.') or item.endswith(PART_SUFFIX):
                 continue
             # if os.path.isdir(os.path.join(self.base_dir, item)):
             #     self.add_directory(item)
             # else:
-            self.add_file(file=item, have=True)
+            record = self.resume.load(item)
+            if record is not None and record['complete'] and self.resume.fresh(record, os.path.join(self.base_dir, item)):
+                self.add_file(file=item, have=True)
+            else:
+                changed.append(item)
+
+        # downloads that were left unfinished
+        for file in self.resume.files():
+            record = self.resume.load(file)
+            if record is None or file in self.torrents or file in changed:
+                continue
+            if not record['complete'] and os.path.exists(os.path.join(self.base_dir, file + PART_SUFFIX)):
+                self.add_file(torrent=self.make_torrent(record))
+            elif not os.path.exists(os.path.join(self.base_dir, file)):
+                self.resume.remove(file)
+
+        if self.verify == "lazy" and changed:
+            self.verifier = threading.Thread(target=self.add_files, args=(changed,), daemon=True)
+            self.verifier.start()
+        else:
+            self.add_files(changed)
+
+    def add_files(self, files):
+        for file in files:
+            if self.closing:
+                return
+            self.add_file(file=file, have=True)
+
+    @staticmethod
+    def make_torrent(record):
+        torrent = Torrent()
+        torrent.torrent = record['torrent']
+        torrent.piece_len = torrent.info['piece_length']
+        return torrent
 
     def add_file(self, file=None, torrent=None, have=False):
-        if have:
-            torrent = Torrent(self.piece_len)
-            torrent.make_torrent(file, os.path.join(self.base_dir, file), self.base_dir)
-        else: # not have
+        if not have:
             file = torrent.info['name']
-
-        if file in self.torrents:
-            self.torrents[file].info['pieces'] = torrent.info['pieces']
+            if file in self.torrents:
+                self.torrents[file].info['pieces'] = torrent.info['pieces']
+                return
+        elif file in self.torrents:
             return
-        
-        self.torrents[file] = torrent
-        self.bitfield[file] = bitarray.bitarray(len(torrent.info['pieces']))
-        self.bitfield[file].setall(have)
-        if file not in self.count:
-            self.count[file] = [0] * len(torrent.info['pieces'])
-        else:
-            self.count[file] += [0] * (len(torrent.info['pieces']) - len(self.count[file]))
+
+        path = os.path.join(self.base_dir, file)
+        record = self.resume.load(file)
+        if record is not None and not have and record['torrent']['info']['pieces'] != torrent.info['pieces']:
+            record = None  # a different torrent under the same name
+        bitfield = None
+
         if have:
-            with open(os.path.join(self.base_dir, file), 'rb') as f:
-                index = 0
-                while True:
-                    piece = f.read(self.piece_len)
-                    if not piece:
-                        break
-                    self.write_piece(file, index, piece, archive_check=False)
-                    index += 1
-        else:  # not have, download it
+            if record is not None and record['complete']:
+                torrent = self.make_torrent(record)
+                if self.resume.fresh(record, path):
+                    bitfield = self.resume.bitfield(record)
+                elif self.check_file(torrent, path).all():
+                    bitfield = self.resume.bitfield(record)  # touched, not changed
+            if bitfield is None:
+                torrent = Torrent(piece_len=self.piece_len)
+                torrent.make_torrent(file, path, self.base_dir)
+                bitfield = bitarray.bitarray(len(torrent.info['pieces']))
+                bitfield.setall(True)
+        elif record is not None and not record['complete']:
+            # the data file must be looked at before the storage opens, which may grow it
+            if self.resume.fresh(record, path + PART_SUFFIX):
+                bitfield = self.resume.bitfield(record)
+            elif os.path.exists(path + PART_SUFFIX):
+                bitfield = self.check_file(torrent, path + PART_SUFFIX)
+
+        if bitfield is None:
+            bitfield = bitarray.bitarray(len(torrent.info['pieces']))
+            bitfield.setall(False)
+
+        storage = self.storage_cls(path, torrent.info['length'], torrent.info['piece_length'], complete=have)
+        with self.lock:
+            self.picker.add_file(file, len(torrent.info['pieces']))
+            # replaced rather than updated, so that a thread iterating them meanwhile is not disturbed
+            self.storage = {**self.storage, file: storage}
+            self.torrents = {**self.torrents, file: torrent}
+            self.bitfield = {**self.bitfield, file: bitfield}
+        self.migrate_pieces(file)
+        if not have:  # download what is missing
             for index in range(len(torrent.info['pieces'])):
-                self.require(file, index)
+                if not self.bitfield[file][index]:
+                    self.require(file, index)
+            if self.bitfield[file].all():
+                self.complete_file(file)
+                return
+        self.save_resume(file)
+
+    def check_file(self, torrent, path):
+        """
+        Hash a data file against the pieces of its torrent
+        :return: the bitfield of the pieces that match
+        """
+        bitfield = bitarray.bitarray(len(torrent.info['pieces']))
+        bitfield.setall(False)
+        try:
+            _, bit_map = torrent.compare_file(path)
+        except Exception:  # missing, or not of the size of the torrent
+            return bitfield
+        for index, ok in enumerate(bit_map):
+            bitfield[index] = ok
+        return bitfield
+
+    def save_resume(self, file):
+        if file not in self.storage:
+            return
+        storage = self.storage[file]
+        self.resume.save(file, self.torrents[file], self.bitfield[file], storage.complete, storage.current_path)
+
+    def migrate_pieces(self, file):
+        """
+        Move the pieces of a file out of the per-piece files of the older [base_dir]/.pieces layout
+        """
+        if not os.path.isdir(self.pieces_folder):
+            return
+        for index in range(len(self.bitfield[file])):
+            legacy = os.path.join(self.pieces_folder, file + "." + str(index))
+            if not os.path.exists(legacy):
+                continue
+            if not self.bitfield[file][index]:
+                with open(legacy, 'rb') as f:
+                    self.write_piece(file, index, f.read(), archive_check=False)
+            os.remove(legacy)
+        if not os.listdir(self.pieces_folder):
+            os.rmdir(self.pieces_folder)
 
     def add_directory(self, directory):
         pass
 
-    def update_count(self, peer_id, file, index, have):
-        if file not in self.count:
-            self.count[file] = [0] * (index + 1)
-        if index >= len(self.count[file]):
-            self.count[file] += [0] * (index - len(self.count[file]) + 1)
+    @property
+    def seeding(self):
+        # nothing left to download
+        return all(bitfield.all() for bitfield in self.bitfield.values())
 
-        self.count[file][index] += 1 if have else -1
-        if (file, index) in self.required_pieces:
-            self.require(file, index)
+    @property
+    def required_pieces(self):
+        # rarest first, then the ones under way
+        with self.lock:
+            return list(self.picker) + list(self.partial)
 
-    def update_count_from_bitfield(self, peer_id, peer_bitfield):
-        for file, bitfield in peer_bitfield.items():
-            for index, have in enumerate(bitfield):
-                self.update_count(peer_id, file, index, have)
+    def update_count(self, peer_id, file, index, have):
+        with self.lock:
+            self.picker.update(file, index, 1 if have else -1)
+
+    def update_count_from_bitfield(self, peer_id, peer_bitfield, have=True):
+        # a bitfield only tells what the peer has, a missing piece is no news
+        with self.lock:
+            for file, bitfield in peer_bitfield.items():
+                self.picker.update_bitfield(file, bitfield, 1 if have else -1)
 
     def read_piece(self, file, index):
         if file not in self.bitfield or not self.bitfield[file][index]:
             return None
-        if (file, index) in self.piece_buffer:
-            self.piece_buffer.move_to_end((file, index))
-            return self.piece_buffer[(file, index)]
-        
-        with open(os.path.join(self.pieces_folder, file + "." + str(index)), 'rb') as f:
-            piece = f.read()
-            self.piece_buffer[(file, index)] = piece
-            if len(self.piece_buffer) > self.piece_buffer_size:
-                self.piece_buffer.popitem(last=False)
-            return piece
+        if self.storage_mode == "mmap":
+            return self.storage[file].read_piece(index)
+        piece = self.piece_buffer.get((file, index))
+        if piece is None:
+            piece = self.storage[file].read_piece(index)
+            self.piece_buffer.put((file, index), piece)
+        return piece
 
     def write_piece(self, file, index, piece, archive_check=True):
+        if self.bitfield[file][index]:  # a duplicate from endgame mode
+            return True
         if not self.torrents[file].compare_piece(index, piece):
             return False
 
-        with open(os.path.join(self.pieces_folder, file + "." + str(index)), 'wb') as f:
-            f.write(piece)
-        self.bitfield[file][index] = True
-        
+        with self.lock:
+            # two copies may pass the hash check at once in endgame mode, only the first is written and announced
+            if self.bitfield[file][index] or (file, index) in self.writing:
+                return True
+            self.writing.add((file, index))
+        try:
+            self.storage[file].write_piece(index, piece)
+            if self.storage_mode != "mmap":
+                self.piece_buffer.put((file, index), bytes(piece))
+            with self.lock:
+                self.bitfield[file][index] = True
+                # given back meanwhile by a connection whose request for it was still out
+                self.picker.require_not(file, index)
+        finally:
+            with self.lock:
+                self.writing.discard((file, index))
+        for listener in self.listeners:
+            listener(file, index)
+
         if archive_check and self.bitfield[file].all():
-            self.archive_file(file)
+            self.complete_file(file)
 
         return True
     
-    def archive_file(self, file):
-        if file not in self.torrents:
+    def add_listener(self, listener):
+        """
+        :param listener: called as listener(file, index) by the thread that wrote a piece, once it is verified and
+        written, so it should only hand the news on
+        """
+        self.listeners.append(listener)
+
+    def add_block_listener(self, listener):
+        """
+        :param listener: called as listener(file, index, begin) by the thread that took in a block that other
+        requests are still out for, so that they can be cancelled at once rather than when the piece is done
+        """
+        self.block_listeners.append(listener)
+
+    def complete_file(self, file):
+        if file not in self.storage:
             return
-        with open(os.path.join(self.base_dir, file), 'wb') as f:
-            for index in range(len(self.bitfield[file])):
-                piece = self.read_piece(file, index)
-                f.write(piece)
+        if not self.storage[file].finalize():
+            return
+        self.save_resume(file)
+        with self.lock:
+            start = self.endgame.pop(file, None)
+            if start is not None:
+                self.tail[file] = time.monotonic() - start
+
+    def close(self):
+        self.closing = True
+        if self.verifier is not None:
+            self.verifier.join()
+        for file in self.storage:
+            self.save_resume(file)
+        for storage in self.storage.values():
+            storage.close()
 
     def require(self, file, index):
         with self.lock:
-            if (file, index) in self.required_pieces:
-                idx = self.required_pieces.index((file, index))
-                self.required_pieces.pop(idx)
-                self.required_pieces_count.pop(idx)
-            insert(self.required_pieces, self.required_pieces_count, (file, index), self.count[file][index])
+            self.require_missing(file, index)
+
+    def require_missing(self, file, index):
+        # require a piece again unless another peer delivered it meanwhile, e.g. in endgame mode; call with `lock` held
+        bitfield = self.bitfield.get(file)
+        if bitfield is None or not bitfield[index]:
+            self.picker.require(file, index)
 
     def require_not(self, file, index):
         with self.lock:
-            idx = self.required_pieces.index((file, index))
-            self.required_pieces.pop(idx)
-            self.required_pieces_count.pop(idx)
+            self.picker.require_not(file, index)
+
+    def is_interesting(self, peer_bitfield):
+        # whether the peer has any piece we still require
+        with self.lock:
+            if self.picker.is_interesting(peer_bitfield):
+                return True
+            if any(self.peer_has(peer_bitfield, file, index) for file, index in self.open_pieces):
+                return True
+            return any(self.peer_has(peer_bitfield, file, index) for file, index in self.endgame_pieces())
+
+    @staticmethod
+    def peer_has(peer_bitfield, file, index):
+        bitfield = peer_bitfield.get(file)
+        return bitfield is not None and index < len(bitfield) and bitfield[index]
+
+    def in_endgame(self, file):
+        """
+        Whether the file is in endgame mode, or due to enter it: every piece missing from it has been asked for, and
+        there are few enough of them to ask every peer. Call with `lock` held.
+        """
+        if file in self.endgame:
+            return True
+        bitfield = self.bitfield.get(file)
+        if not self.endgame_threshold or bitfield is None or self.picker.wanted[file].any():
+            return False
+        return 0 < len(bitfield) - bitfield.count() <= self.endgame_threshold
+
+    def enter_endgame(self, file):
+        """
+        Enter endgame mode if the file is due to, timing its tail from then on; the paths that hand out requests do,
+        the ones that only look, like interest checks, use `in_endgame`. Call with `lock` held.
+        :return: whether the file is in endgame mode
+        """
+        if file not in self.endgame and self.in_endgame(file):
+            self.endgame[file] = time.monotonic()
+        return file in self.endgame
+
+    def endgame_pieces(self, enter=False):
+        # the pieces missing from the files in endgame mode, entering it with `enter`, call with `lock` held
+        endgame = self.enter_endgame if enter else self.in_endgame
+        for file, bitfield in self.bitfield.items():
+            if endgame(file):
+                for index in bitfield.search(0):
+                    yield file, index
+
+    def get_piece_request(self, peer_bitfield, pending=()):
+        """
+        Find the rarest piece for current peer, or in endgame mode one under way that it was not asked for yet
+        :param pending: the keys of the requests outstanding on the peer's connection
+        """
+        with self.lock:
+            picked = self.picker.pick(peer_bitfield)
+            if picked is not None:
+                return {'file': picked[0], 'index': picked[1]}
+            for file, index in self.endgame_pieces(enter=True):
+                if (file, index) not in pending and (file, index) not in self.partial \
+                        and self.peer_has(peer_bitfield, file, index):
+                    return {'file': file, 'index': index}
+            return None
 
-    def get_piece_request(self, peer_bitfield):
-        # find the rarest piece for current peer
-        pieces = []
+    def get_block_requests(self, peer_bitfield, count, pending=()):
+        """
+        Blocks to ask a peer for, those of pieces under way first, then those of the rarest pieces it has, and in
+        endgame mode the outstanding blocks it was not asked for yet
+        :param pending: the keys of the requests outstanding on the peer's connection
+        :return: up to `count` requests, as dicts of file, index, begin and length
+        """
+        requests = []
         with self.lock:
-            for idx, (file, index) in enumerate(self.required_pieces):
-                if peer_bitfield[file][index]:
-                    pieces += [(idx, (file, index))]
-                    if len(pieces) == 10:
+            for file, index in list(self.open_pieces):
+                if len(requests) == count:
+                    return requests
+                if self.peer_has(peer_bitfield, file, index):
+                    self.assign_blocks(file, index, count - len(requests), requests)
+            while len(requests) < count:
+                picked = self.picker.pick(peer_bitfield)
+                if picked is None:
+                    break
+                file, index = picked
+                self.partial[picked] = PartialPiece(self.storage[file].piece_range(index)[1])
+                self.open_pieces[picked] = None
+                self.assign_blocks(file, index, count - len(requests), requests)
+            # the blocks just asked for are not pending yet, and must not be asked of the same peer twice
+            asked = {(request['file'], request['index'], request['begin']) for request in requests}
+            for (file, index), part in self.partial.items():
+                if len(requests) == count:
+                    break
+                if not self.peer_has(peer_bitfield, file, index) or not self.enter_endgame(file):
+                    continue
+                for block in range(part.blocks):
+                    begin, length = part.block_range(block)
+                    if part.received[block] or (file, index, begin) in pending or (file, index, begin) in asked:
+                        continue
+                    part.requested[block] += 1
+                    requests.append({'file': file, 'index': index, 'begin': begin, 'length': length})
+                    if len(requests) == count:
                         break
-            
-            if len(pieces):
-                piece_request = {}
-                idx, (piece_request['file'], piece_request['index']) = random.choice(pieces)
+        return requests
 
-                self.required_pieces.pop(idx)
-                self.required_pieces_count.pop(idx)
-            else:
-                piece_request = None
-            
-            return piece_request
+    def assign_blocks(self, file, index, count, requests):
+        part = self.partial[(file, index)]
+        for block in part.open_blocks()[:count]:
+            part.requested[block] += 1
+            begin, length = part.block_range(block)
+            requests.append({'file': file, 'index': index, 'begin': begin, 'length': length})
+        if not part.open:
+            self.open_pieces.pop((file, index), None)
+
+    def write_block(self, file, index, begin, block):
+        """
+        Put a received block into its partial piece, and write the piece once all its blocks are in
+        :return: True when the block completes a piece that passes its hash check, False when it completes one that
+        fails it, which is required again then, None otherwise
+        """
+        with self.lock:
+            part = self.partial.get((file, index))
+            if part is None:
+                return None
+            n = part.block_of(begin, len(block))
+            if n is None:
+                return None
+            part.requested[n] = max(0, part.requested[n] - 1)
+            if not part.add(n, block):
+                return None
+            duplicated = part.requested[n] > 0
+            done = part.done
+            if done:
+                del self.partial[(file, index)]
+                self.open_pieces.pop((file, index), None)
+
+        if duplicated:
+            for listener in self.block_listeners:
+                listener(file, index, begin)
+        if not done:
+            return None
 
+        if self.write_piece(file, index, part.data):
+            return True
+        self.require(file, index)
+        return False
+
+    def stats(self):
+        with self.lock:
+            return {
+                'remaining': {file: len(bf) - bf.count() for file, bf in self.bitfield.items()},
+                'endgame': list(self.endgame),
+                'tail': dict(self.tail),
+                'cache': self.cache_stats(),
+            }
+
+    def cache_stats(self):
+        """
+        The stats of `piece_buffer`, None in mmap mode, where pieces bypass it and the page cache serves them
+        """
+        return None if self.storage_mode == "mmap" else self.piece_buffer.stats()
+
+    def block_length(self, file, index, begin):
+        _, size = self.storage[file].piece_range(index)
+        return min(BLOCK_SIZE, size - begin)
+
+    def release_block(self, file, index, begin):
+        """
+        Give up a request for a block, so that the block can be asked for again
+        """
+        with self.lock:
+            part = self.partial.get((file, index))
+            if part is None or not 0 <= begin < part.size:
+                return
+            n = begin // part.block_size
+            part.requested[n] = max(0, part.requested[n] - 1)
+            if part.idle:  # back to the rarest-first order
+                del self.partial[(file, index)]
+                self.open_pieces.pop((file, index), None)
+                self.require_missing(file, index)
+            elif part.open:
+                self.open_pieces[(file, index)] = None
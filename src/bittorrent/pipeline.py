@@ -0,0 +1,119 @@
+import math
+import time
+import collections
+
+
+class RequestPipeline:
+    def __init__(self, depth=None, min_depth=1, max_depth=64, gain=2.0, window=0.25):
+        """
+        Outstanding piece requests of one peer connection
+        :param depth: a fixed queue depth, or None to adapt it to the measured bandwidth-delay product
+        :param min_depth:
+        :param max_depth:
+        :param gain: headroom over the bandwidth-delay product, so a pipeline limited by its own depth keeps growing
+        :param window: seconds of arrivals that make up one bandwidth sample
+
+        Requests are keyed by (file, index) and may be answered in any order. The delay is the smallest request
+        latency seen, which follows a longer route only through requests sent with none of ours outstanding, so it
+        approximates the round trip time without the queueing the pipeline itself adds, and the bandwidth is an EWMA
+        of the delivery rate over short windows.
+        """
+        self.outstanding = collections.OrderedDict()
+        self.fixed = depth is not None
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.depth = depth if self.fixed else min(max(4, min_depth), max_depth)
+        self.gain = gain
+        self.window = window
+        self.rtt = None
+        self.rate = None
+        self.avg_size = None
+        self.window_start = None
+        self.window_bytes = 0
+
+    def __len__(self):
+        return len(self.outstanding)
+
+    def __contains__(self, key):
+        return key in self.outstanding
+
+    @property
+    def free(self):
+        return max(0, self.depth - len(self.outstanding))
+
+    def limit(self, max_depth):
+        """
+        Cap the depth, e.g. at 1 for a peer that answers in lockstep
+        """
+        self.max_depth = max_depth
+        self.min_depth = min(self.min_depth, max_depth)
+        self.depth = min(self.depth, max_depth)
+
+    def add(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        # with the requests ahead of it, which the peer answers first
+        self.outstanding[key] = (now, len(self.outstanding))
+        if self.window_start is None:
+            self.window_start = now
+
+    def complete(self, key, size, now=None):
+        """
+        Record the arrival of a requested piece
+        :return: whether the piece was outstanding on this pipeline
+        """
+        now = time.monotonic() if now is None else now
+        entry = self.outstanding.pop(key, None)
+        if entry is None:
+            return False
+
+        sent, ahead = entry
+        latency = now - sent
+        # take any lower sample at once, and drift slowly towards a higher one only if nothing of ours was ahead of
+        # it; behind other requests the latency holds the queueing the pipeline adds itself, and the delay would grow
+        # with the depth and the depth with the delay
+        if self.rtt is None or latency < self.rtt:
+            self.rtt = latency
+        elif not ahead:
+            self.rtt += (latency - self.rtt) / 16
+        self.avg_size = size if self.avg_size is None else self.avg_size + (size - self.avg_size) / 8
+
+        self.window_bytes += size
+        elapsed = now - self.window_start
+        if elapsed >= self.window:
+            sample = self.window_bytes / elapsed
+            self.rate = sample if self.rate is None else self.rate + (sample - self.rate) / 4
+            self.window_start = now if self.outstanding else None
+            self.window_bytes = 0
+            self.adapt()
+
+        return True
+
+    def adapt(self):
+        if self.fixed or self.rate is None or not self.avg_size:
+            return
+        bdp = self.rate * self.rtt / self.avg_size
+        self.depth = min(max(math.ceil(bdp * self.gain) + 1, self.min_depth), self.max_depth)
+
+    def drop(self, match):
+        """
+        Forget the outstanding requests `match` is true for, e.g. those of a piece that came in through another peer
+        :return: the keys that were dropped
+        """
+        keys = [key for key in self.outstanding if match(key)]
+        for key in keys:
+            del self.outstanding[key]
+        if not self.outstanding:
+            self.window_start = None
+            self.window_bytes = 0
+        return keys
+
+    def drop_all(self):
+        """
+        Forget every outstanding request, e.g. when the peer chokes us or the connection ends
+        :return: the keys that were outstanding
+        """
+        keys = list(self.outstanding)
+        self.outstanding.clear()
+        self.window_start = None
+        self.window_bytes = 0
+        return keys
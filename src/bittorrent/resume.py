@@ -0,0 +1,83 @@
+import os
+import json
+import base64
+import bitarray
+
+
+RESUME_DIR = '.resume'
+RESUME_VERSION = 1
+
+
+def fingerprint(path):
+    """
+    What tells whether a file changed since it was last looked at, without reading it
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class ResumeData:
+    def __init__(self, base_dir):
+        """
+        Fast-resume records, one per file in [base_dir]/.resume/[file].json
+        :param base_dir:
+
+        A record holds the torrent of the file (and with it the piece hashes), the bitfield of the pieces on disk,
+        whether the file is complete, and the fingerprint (size and mtime) of its data file as it was when the record
+        was saved. While the fingerprint still matches, the bitfield is trusted and the file is not hashed again.
+        """
+        self.folder = os.path.join(base_dir, RESUME_DIR)
+
+    def path(self, file):
+        return os.path.join(self.folder, file + '.json')
+
+    def files(self):
+        if not os.path.isdir(self.folder):
+            return []
+        return sorted(item[:-len('.json')] for item in os.listdir(self.folder) if item.endswith('.json'))
+
+    def load(self, file):
+        try:
+            with open(self.path(file), 'r') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(record, dict) or record.get('version') != RESUME_VERSION:
+            return None
+        return record
+
+    def save(self, file, torrent, bitfield, complete, data_path):
+        record = {
+            'version': RESUME_VERSION,
+            'torrent': torrent.torrent,
+            'bitfield': base64.b64encode(bitfield.tobytes()).decode('ascii'),
+            'complete': complete,
+            'fingerprint': fingerprint(data_path),
+        }
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        # a crash halfway through leaves the previous record, never a torn one
+        tmp = self.path(file) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp, self.path(file))
+
+    def remove(self, file):
+        try:
+            os.remove(self.path(file))
+        except OSError:
+            pass
+
+    @staticmethod
+    def fresh(record, data_path):
+        return record['fingerprint'] is not None and record['fingerprint'] == fingerprint(data_path)
+
+    @staticmethod
+    def bitfield(record):
+        bitfield = bitarray.bitarray()
+        bitfield.frombytes(base64.b64decode(record['bitfield']))
+        del bitfield[len(record['torrent']['info']['pieces']):]
+        return bitfield
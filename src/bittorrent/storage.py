@@ -0,0 +1,164 @@
+import os
+import mmap
+import threading
+
+
+PART_SUFFIX = '.part'
+OPEN_FLAGS = getattr(os, 'O_BINARY', 0)
+
+
+class FileStorage:
+    def __init__(self, path, length, piece_len, complete=False):
+        """
+        The data of one file, stored in place at its final size
+        :param path: where the complete file lives
+        :param length:
+        :param piece_len:
+        :param complete: whether `path` already holds the whole file
+
+        A file being downloaded is kept at `path` + '.part', preallocated to its full length (with fallocate where
+        the platform has it, as a sparse file otherwise), and every verified piece is written at its own offset with
+        positional I/O. Once all pieces are there the file is renamed to `path`, so there is nothing to assemble.
+        """
+        self.path = path
+        self.length = length
+        self.piece_len = piece_len
+        self.complete = complete
+        self.lock = threading.Lock()
+        self.fd = None
+        self.open()
+
+    @property
+    def current_path(self):
+        return self.path if self.complete else self.path + PART_SUFFIX
+
+    def open(self):
+        if self.complete:
+            self.fd = os.open(self.path, os.O_RDONLY | OPEN_FLAGS)
+            return
+        self.fd = os.open(self.current_path, os.O_RDWR | os.O_CREAT | OPEN_FLAGS, 0o644)
+        if os.fstat(self.fd).st_size < self.length:
+            self.preallocate()
+
+    def preallocate(self):
+        try:
+            os.posix_fallocate(self.fd, 0, self.length)
+        except (AttributeError, OSError):
+            # no fallocate here, or not on this file system: a sparse file of the right size will do
+            os.ftruncate(self.fd, self.length)
+
+    def piece_range(self, index):
+        offset = index * self.piece_len
+        return offset, max(0, min(self.piece_len, self.length - offset))
+
+    def read_piece(self, index):
+        offset, size = self.piece_range(index)
+        return self.pread(size, offset)
+
+    def write_piece(self, index, piece):
+        offset, _ = self.piece_range(index)
+        self.pwrite(piece, offset)
+
+    def pread(self, size, offset):
+        if hasattr(os, 'pread'):
+            return os.pread(self.fd, size, offset)
+        with self.lock:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            return os.read(self.fd, size)
+
+    def pwrite(self, data, offset):
+        view = memoryview(data)
+        while len(view):
+            if hasattr(os, 'pwrite'):
+                n = os.pwrite(self.fd, view, offset)
+            else:
+                with self.lock:
+                    os.lseek(self.fd, offset, os.SEEK_SET)
+                    n = os.write(self.fd, view)
+            view = view[n:]
+            offset += n
+
+    def finalize(self):
+        """
+        Move the completed download to its final name, the open descriptor stays valid across the rename
+        :return: whether this call moved it, the threads that write the last pieces may all get here
+        """
+        with self.lock:
+            if self.complete:
+                return False
+            os.fsync(self.fd)
+            os.replace(self.current_path, self.path)
+            self.complete = True
+            return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class MmapFileStorage(FileStorage):
+    def __init__(self, path, length, piece_len, complete=False, readahead=8):
+        """
+        A `FileStorage` that serves reads from a shared memory map of the file
+        :param readahead: pieces the kernel is asked to page in ahead of a sequential run of reads
+
+        `read_piece` returns a memoryview into the map, without a system call or a copy. Writes still go through
+        the descriptor, which the page cache keeps coherent with the map. When the file outgrows the map, or is
+        reopened, a new map replaces it; the old one stays alive until no view into it is left and is closed then.
+        """
+        self.readahead = readahead
+        self.map = None
+        self.retired = []
+        self.last_index = None
+        super().__init__(path, length, piece_len, complete)
+
+    def open(self):
+        super().open()
+        self.remap()
+
+    def remap(self):
+        with self.lock:
+            size = os.fstat(self.fd).st_size
+            if self.map is not None and len(self.map) == size:
+                return
+            if self.map is not None:
+                self.retired.append(self.map)
+            self.map = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ) if size else None
+            self.release_retired()
+
+    def release_retired(self):
+        alive = []
+        for old in self.retired:
+            try:
+                old.close()
+            except BufferError:  # a view handed out earlier still points into it
+                alive.append(old)
+        self.retired = alive
+
+    def read_piece(self, index):
+        offset, size = self.piece_range(index)
+        if self.map is None or offset + size > len(self.map):
+            self.remap()
+            if self.map is None:
+                return b''
+        if self.last_index is not None and index == self.last_index + 1:
+            self.advise(offset + size, self.readahead * self.piece_len)
+        self.last_index = index
+        return memoryview(self.map)[offset:offset + size]
+
+    def advise(self, offset, length):
+        if not hasattr(self.map, 'madvise') or not hasattr(mmap, 'MADV_WILLNEED'):
+            return
+        start = offset - offset % mmap.PAGESIZE
+        length = min(offset + length, len(self.map)) - start
+        if length > 0:
+            self.map.madvise(mmap.MADV_WILLNEED, start, length)
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.retired.append(self.map)
+                self.map = None
+            self.release_retired()
+        super().close()
@@ -0,0 +1,222 @@
+import json
+import base64
+import random
+import socket
+import struct
+import threading
+
+from utils import MyEncoder
+
+# an IPv4 peer in a compact peer list: address and port, both in network byte order
+COMPACT_PEER = struct.Struct('!4sH')
+# the protocol extensions a compact peer list carries, a bit each in a byte per peer sent along as `peer_flags`
+PEER_FLAGS = ["pipeline", "blocks", "packed_bitfield", "have_batch"]
+
+
+class CacheStats:
+    def __init__(self):
+        """
+        Hits and misses of the encoded peers of every swarm of a tracker
+        """
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, hits, misses):
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+class EncodedPeer:
+    __slots__ = ('peer_id', 'json', 'compact', 'compact64', 'flags')
+
+    def __init__(self, peer):
+        """
+        A peer as it goes into announce responses: its `"peer_id":{...}` member of a JSON peer dict, and its entry
+        of a compact peer list, raw and in base64, None if it has no IPv4 address, with its extension flags in hex.
+        A compact entry is 6 bytes, a multiple of 3, so the base64 of a list is the base64 of its entries put
+        together, as the hex of the flags is of theirs.
+        """
+        self.peer_id = peer['peer_id']
+        self.json = (json.dumps(self.peer_id) + ':' + json.dumps(peer, cls=MyEncoder, sort_keys=True,
+                                                                  separators=(',', ':'))).encode('utf-8')
+        self.compact = pack_peer(peer)
+        self.compact64 = base64.b64encode(self.compact) if self.compact is not None else None
+        self.flags = b'%02x' % pack_flags(peer.get('extensions', ()))
+
+
+class Swarm:
+    def __init__(self, info_hash="", stats=None):
+        """
+        The peers of one torrent on the tracker
+        :param info_hash: "" for the swarm of peers that announce without one
+        :param stats: the `CacheStats` to count the encoded peers handed out in
+
+        Peers are kept in a list next to a dict of their positions in it, a peer that leaves is swapped with the last
+        one, so joining, leaving and drawing a random sample of k peers all take O(1) per peer whatever the size.
+        Peers that announced nothing `left` to download are counted as `seeders`, `completed` counts the downloads
+        announced as finished.
+
+        Every peer has its `EncodedPeer` next to it in `encoded`, made the first time the peer is sampled and dropped
+        only when the peer leaves or announces something new about itself, so announces are answered by putting
+        encoded bytes together rather than encoding the peers again.
+        """
+        self.info_hash = info_hash
+        self.stats = stats
+        self.ids = []
+        self.index = {}
+        self.peers = {}
+        self.encoded = []
+        self.seeders = 0
+        self.completed = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, peer_id):
+        return peer_id in self.index
+
+    def get(self, peer_id):
+        return self.peers.get(peer_id)
+
+    @property
+    def leechers(self):
+        return len(self.ids) - self.seeders
+
+    def add(self, peer):
+        peer_id = peer['peer_id']
+        if peer_id not in self.index:
+            self.index[peer_id] = len(self.ids)
+            self.ids.append(peer_id)
+            self.encoded.append(None)
+        else:
+            old = self.peers[peer_id]
+            self.seeders -= old.get('left') == 0
+            if old != peer:
+                self.encoded[self.index[peer_id]] = None
+        self.seeders += peer.get('left') == 0
+        self.peers[peer_id] = peer
+
+    def remove(self, peer_id):
+        position = self.index.pop(peer_id, None)
+        if position is None:
+            return None
+        last = self.ids.pop()
+        encoded = self.encoded.pop()
+        if last != peer_id:
+            self.ids[position] = last
+            self.index[last] = position
+            self.encoded[position] = encoded
+        peer = self.peers.pop(peer_id)
+        self.seeders -= peer.get('left') == 0
+        return peer
+
+    def sample_positions(self, numwant, exclude=None):
+        n = len(self.ids)
+        skip = self.index.get(exclude)
+        k = min(numwant, n - (skip is not None))
+        if k <= 0:
+            return []
+        positions = random.sample(range(n), min(n, k + (skip is not None)))
+        if skip is not None:
+            positions = [position for position in positions if position != skip]
+        return positions[:k]
+
+    def sample(self, numwant, exclude=None):
+        """
+        :param numwant: peers wanted, all of them if there are not as many
+        :param exclude: the peer_id of the one asking, which it never gets back
+        :return: the peers drawn, in random order
+        """
+        return [self.peers[self.ids[position]] for position in self.sample_positions(numwant, exclude)]
+
+    def sample_encoded(self, numwant, exclude=None):
+        """
+        Like `sample`, with the peers as `EncodedPeer`s
+        """
+        peers = []
+        misses = 0
+        for position in self.sample_positions(numwant, exclude):
+            encoded = self.encoded[position]
+            if encoded is None:
+                encoded = self.encoded[position] = EncodedPeer(self.peers[self.ids[position]])
+                misses += 1
+            peers.append(encoded)
+        if self.stats is not None:
+            self.stats.add(len(peers) - misses, misses)
+        return peers
+
+
+def pack_peer(peer):
+    try:
+        return COMPACT_PEER.pack(socket.inet_aton(peer['ip']), peer['port'])
+    except (OSError, KeyError, struct.error):
+        return None
+
+
+def pack_peers(peers, skip=False):
+    """
+    A compact peer list, 6 bytes for each peer
+    :param skip: leave out the peers without an IPv4 address to pack, rather than give up
+    :return: None if a peer has no IPv4 address to pack, then the peers have to go as dicts
+    """
+    packed = []
+    for peer in peers:
+        package = pack_peer(peer)
+        if package is None and not skip:
+            return None
+        if package is not None:
+            packed.append(package)
+    return b''.join(packed)
+
+
+def pack_flags(extensions):
+    return sum(1 << bit for bit, extension in enumerate(PEER_FLAGS) if extension in extensions)
+
+
+def unpack_flags(flags):
+    return [extension for bit, extension in enumerate(PEER_FLAGS) if flags >> bit & 1]
+
+
+def encode_peers(peers, compact=False):
+    """
+    The JSON members of the peer list of an announce response from `EncodedPeer`s: `peers` as a compact list if
+    asked for and every peer has an IPv4 address, as `pack_peers` decides, with the extensions of the peers in
+    `peer_flags`, or `peers` as a dict keyed by peer_id otherwise
+
+    Tracker answers are JSON objects spliced together from these cached pieces, rather than messages of the binary
+    codec, so a compact peer takes 10 bytes rather than the 6 of BEP 23: 8 characters of base64, which stays whole
+    per peer as 6 bytes are two groups of 3, and 2 hex characters of flags. A peer as a dict takes 70 to 130.
+    """
+    if compact and all(peer.compact is not None for peer in peers):
+        return b'"peers":"BYTES' + b''.join(peer.compact64 for peer in peers) + \
+            b'","peer_flags":"' + b''.join(peer.flags for peer in peers) + b'"'
+    return b'"peers":{' + b','.join(peer.json for peer in peers) + b'}'
+
+
+def unpack_peers(packed, flags=None):
+    """
+    The peers of a compact peer list, as dicts keyed by peer_id the way the tracker keeps them, peers name themselves
+    by their address and port
+    :param flags: the `peer_flags` in hex that came with the list, if any
+    """
+    flags = bytes.fromhex(flags) if flags else b''
+    peers = {}
+    for i, offset in enumerate(range(0, len(packed) - COMPACT_PEER.size + 1, COMPACT_PEER.size)):
+        address, port = COMPACT_PEER.unpack_from(packed, offset)
+        ip = socket.inet_ntoa(address)
+        peer = {'ip': ip, 'port': port, 'peer_id': f'{ip}:{port}'}
+        if i < len(flags):
+            peer['extensions'] = unpack_flags(flags[i])
+        peers[peer['peer_id']] = peer
+    return peers
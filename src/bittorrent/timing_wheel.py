@@ -0,0 +1,63 @@
+import math
+
+
+class TimingWheel:
+    def __init__(self, span, tick=1.0, now=0.0):
+        """
+        Deadlines of keys, rounded up to ticks and hashed into a ring of slots by tick
+        :param span: seconds ahead the deadlines usually are, the ring is made long enough for them
+        :param tick: seconds a slot stands for
+        :param now: the time to start from, on the clock `advance` is given
+
+        A deadline is kept in the slot of its tick, with the tick itself, so that one further ahead than the ring is
+        long waits a turn of the ring or more. Scheduling, moving and cancelling a key are O(1), and `advance` only
+        visits the slots of the ticks that passed, whose keys are all due unless they are more than `span` ahead,
+        so it costs O(expired) plus the ticks passed, never a scan of every key.
+        """
+        self.tick = tick
+        self.slots = max(1, math.ceil(span / tick) + 1)
+        self.wheel = [{} for _ in range(self.slots)]
+        self.where = {}
+        self.current = self.to_tick(now)
+
+    def __len__(self):
+        return len(self.where)
+
+    def __contains__(self, key):
+        return key in self.where
+
+    def to_tick(self, t):
+        return math.ceil(t / self.tick)
+
+    def schedule(self, key, deadline):
+        """
+        Set the deadline of a key, moving it if it has one already
+        """
+        self.cancel(key)
+        tick = max(self.to_tick(deadline), self.current)
+        slot = tick % self.slots
+        self.wheel[slot][key] = tick
+        self.where[key] = slot
+
+    def cancel(self, key):
+        slot = self.where.pop(key, None)
+        if slot is not None:
+            del self.wheel[slot][key]
+
+    def advance(self, now):
+        """
+        :return: the keys whose deadlines are not after `now`, which are no longer scheduled then
+        """
+        target = math.floor(now / self.tick)
+        if target < self.current:
+            return []
+        expired = []
+        for tick in range(self.current, self.current + min(target - self.current + 1, self.slots)):
+            slot = self.wheel[tick % self.slots]
+            due = [key for key, deadline in slot.items() if deadline <= target]
+            for key in due:
+                del slot[key]
+                del self.where[key]
+            expired += due
+        self.current = target + 1
+        return expired
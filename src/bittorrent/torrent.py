@@ -3,8 +3,92 @@ import os
 import json
 import hashlib
 import socket
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from utils import *
 
+
+# bytes read and hashed as one task by the parallel hashing engine, rounded down to whole pieces
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+HASH_WORKERS = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+
+
+def hash_buffer(buffer, size, piece_len):
+    view = memoryview(buffer)[:size]
+    return [hashlib.sha1(view[offset:offset + piece_len]).digest() for offset in range(0, size, piece_len)]
+
+
+def read_chunk(f, buffer):
+    # fill the buffer unless the file ends first, a short read would shift the pieces after it
+    view = memoryview(buffer)
+    size = 0
+    while size < len(buffer):
+        n = f.readinto(view[size:])
+        if not n:
+            break
+        size += n
+    return size
+
+
+def hash_range(file_name, offset, size, piece_len):
+    # run by a worker process, which reads its own range of the file
+    with open(file_name, 'rb') as f:
+        f.seek(offset)
+        return hash_buffer(f.read(size), size, piece_len)
+
+
+def hash_file(file_name, piece_len, workers=None, mode="thread", chunk_size=HASH_CHUNK_SIZE):
+    """
+    The SHA1 digests of the pieces of a file, in order
+    :param file_name:
+    :param piece_len:
+    :param workers: hashing threads or processes, one per usable core if None
+    :param mode: "thread" reads chunks of the file in this thread and hashes them on a thread pool, hashlib releases
+    the GIL on large buffers; "process" lets each worker process read and hash its own chunks
+    :param chunk_size: bytes per task
+
+    In "thread" mode each in-flight chunk has its own buffer, read into with `readinto` while the chunks before it are
+    hashed, and refilled once its digests are in, so at most 2 * workers chunks are in memory.
+    """
+    workers = workers or HASH_WORKERS
+    size = os.path.getsize(file_name)
+    chunk_size = max(piece_len, chunk_size - chunk_size % piece_len)
+    digests = []
+    if workers == 1 or size <= chunk_size:
+        buffer = bytearray(min(chunk_size, max(size, piece_len)))
+        with open(file_name, 'rb', buffering=0) as f:
+            while True:
+                n = read_chunk(f, buffer)
+                if not n:
+                    return digests
+                digests += hash_buffer(buffer, n, piece_len)
+
+    if mode == "process":
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            tasks = [pool.submit(hash_range, file_name, offset, min(chunk_size, size - offset), piece_len)
+                     for offset in range(0, size, chunk_size)]
+            for task in tasks:
+                digests += task.result()
+        return digests
+
+    buffers = collections.deque(bytearray(chunk_size) for _ in range(2 * workers))
+    in_flight = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool, open(file_name, 'rb', buffering=0) as f:
+        while True:
+            if not buffers:
+                task, buffer = in_flight.popleft()
+                digests += task.result()
+                buffers.append(buffer)
+            buffer = buffers.popleft()
+            n = read_chunk(f, buffer)
+            if not n:
+                break
+            in_flight.append((pool.submit(hash_buffer, buffer, n, piece_len), buffer))
+        for task, _ in in_flight:
+            digests += task.result()
+    return digests
+
+
 class Torrent:
     def __init__(self, announce=None, port=None, piece_len=4096):
         self.torrent = {
@@ -53,17 +137,18 @@ class Torrent:
     def info(self, info):
         self.torrent['info'] = info
 
-    def make_torrent(self, file, file_name, file_dir, ):
+    @property
+    def info_hash(self):
+        # names the torrent to the tracker, a digest of `info` so that any copy of the torrent file agrees on it
+        return hashlib.sha1(json.dumps(self.info, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+    def make_torrent(self, file, file_name, file_dir, workers=None, mode="thread"):
         self.info['name'] = os.path.basename(file_name)
         self.info['length'] = os.path.getsize(file_name)
         # hash the file into pieces
-        with open(file_name, 'rb') as f:
-            while True:
-                piece = f.read(self.piece_len)
-                if not piece:
-                    break
-                # need to convert to string, otherwise not JSON serializable
-                self.info['pieces'].append(str(hashlib.sha1(piece).digest()))
+        for digest in hash_file(file_name, self.piece_len, workers, mode):
+            # need to convert to string, otherwise not JSON serializable
+            self.info['pieces'].append(str(digest))
     
     def write_torrent(self, dir=None, announce=None, port=None, comment=None):
         # record the torrent file information
@@ -85,7 +170,7 @@ class Torrent:
             torrent = json.load(f)
         self.torrent = torrent
     
-    def compare_file(self, download_file):
+    def compare_file(self, download_file, workers=None, mode="thread"):
         # torrent_file = self.read_torrent(torrent_file_name)
         piece_length = self.info['piece_length']
         
@@ -97,17 +182,11 @@ class Torrent:
         piece_num = len(self.info['pieces'])
         bit_map = [0] * piece_num # 0 means not checked(or check failure), 1 means check success
         valid = True
-        piece_index = 0
-        with open(download_file, 'rb') as f:
-            while True:
-                piece = f.read(piece_length)
-                if not piece:
-                    break
-                if str(hashlib.sha1(piece).digest()) == self.info['pieces'][piece_index]:
-                    bit_map[piece_index] = 1
-                else:
-                    valid = False
-                piece_index += 1
+        for piece_index, digest in enumerate(hash_file(download_file, piece_length, workers, mode)):
+            if str(digest) == self.info['pieces'][piece_index]:
+                bit_map[piece_index] = 1
+            else:
+                valid = False
         return valid, bit_map
     
     def compare_piece(self, index, piece):
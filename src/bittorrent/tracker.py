@@ -6,22 +6,63 @@ from socket import *
 
 from components import *
 from utils import *
+from swarm import Swarm, CacheStats, encode_peers
+from timing_wheel import TimingWheel
+from udp_tracker import HEADER, CONNECT_RESPONSE, ANNOUNCE, ANNOUNCE_RESPONSE, SCRAPE_ENTRY, RESPONSE_HEADER, \
+    PROTOCOL_ID, ACTION_CONNECT, ACTION_ANNOUNCE, ACTION_SCRAPE, EVENTS, MAX_SCRAPE, ConnectionIds, \
+    pack_error, unpack_info_hash
 
 
 class Tracker(threading.Thread):
-    def __init__(self, name, base_dir="sandbox/tracker/", host="", port=7889):
+    def __init__(self, name, base_dir="sandbox/tracker/", host="", port=7889, engine="thread", backlog=128,
+                 max_workers=16, numwant=50, max_numwant=200, udp=True, interval=1800,
+                 min_interval=900, peer_timeout=None, log_level="info"):
+        """
+        A tracker that keeps a `Swarm` of peers for every info-hash announced
+        :param numwant: peers handed out to an announce that does not say how many it wants
+        :param max_numwant: peers handed out to an announce at most
+        :param udp: also serve the UDP tracker protocol of BEP 15, on the same port number
+        :param interval: seconds peers are told to wait between announces
+        :param min_interval: seconds peers are told to wait at least between announces
+        :param peer_timeout: seconds after its last announce a peer is dropped, an interval and a min interval if not
+        given
+        :param log_level: the least level logged, every announce is logged at "debug"
+
+        Announces are answered with a random sample of the swarm, packed 6 bytes a peer when the peer asks for a
+        compact list and every peer sampled has an IPv4 address, with a byte of extension flags each in `peer_flags`,
+        as dicts keyed by peer_id otherwise. UDP announces
+        share the swarms, a peer announced over UDP is known by the address and port it announced.
+
+        Peers are handed out encoded already, from the `EncodedPeer`s the swarms keep, and TCP announces are answered
+        with an `Encoded` response put together around them, so a storm of announces does not encode the same peers
+        over and over; the `stats` command reports how often they were found encoded.
+
+        Peers that do not announce again within `peer_timeout` are taken to be gone. Their deadlines are kept in a
+        `TimingWheel`, which the tracker advances every loop, so dropping them costs what was dropped.
+        """
         super().__init__()
 
         self.cmd_lock = threading.Lock()
         self.cmd_queue = []
         self.name = name
         self.dir = base_dir
-        self.log_lock = threading.Lock()
-        self.log = self.init_log(name, base_dir, self.log_lock)
+        self.logger = self.init_log(name, base_dir, log_level)
+        self.log = self.logger.log
         self.host = host
         self.port = port
-        self.peers = {}
-        self.server = Server(host, port, self.respond)
+        self.swarms = {}
+        self.lock = threading.Lock()
+        self.numwant = numwant
+        self.max_numwant = max_numwant
+        self.cache_stats = CacheStats()
+        self.interval = interval
+        self.min_interval = min_interval
+        self.peer_timeout = peer_timeout if peer_timeout is not None else interval + min_interval
+        self.expiry = TimingWheel(self.peer_timeout, tick=max(0.01, min(1.0, self.peer_timeout / 64)),
+                                  now=time.monotonic())
+        self.server = ENGINES[engine][0](host, port, self.respond, backlog=backlog, max_workers=max_workers)
+        self.udp_server = UdpServer(host, port, self.respond_udp) if udp else None
+        self.connection_ids = ConnectionIds()
         self.running = False
         self.busy = True
         self.log(f'[INIT] Tracker {self.name} is initialized')
@@ -37,18 +78,13 @@ class Tracker(threading.Thread):
             return self.cmd_queue.pop(0)
 
     @staticmethod
-    def init_log(name, base_dir, lock):
+    def init_log(name, base_dir, level=INFO):
         log_dir = os.path.join(base_dir, '.logs')
         if not os.path.exists(log_dir):
             os.makedirs(log_dir)
         timestamp = datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
         log_file = os.path.join(log_dir, f'{name}_{timestamp}.log')
-
-        def log(msg):
-            with lock:
-                log_fn(msg, log_file)
-
-        return log
+        return AsyncLogger(log_file, level=level)
     
     def stop(self):
         if self.running:
@@ -58,6 +94,8 @@ class Tracker(threading.Thread):
         self.running = True
 
         self.server.start()
+        if self.udp_server is not None:
+            self.udp_server.start()
 
         self.log(f'[START] Tracker {self.name} is running on {self.host}:{self.port}')
 
@@ -66,86 +104,233 @@ class Tracker(threading.Thread):
             self.busy = True
 
             try:
+                self.expire()
                 cmd_line = self.get_cmd()
                 if cmd_line:
                     cmd, *args = cmd_line.split()
                     if cmd in ['quit', 'q']:
                         self.stop()
                         break
+                    elif cmd in ['stats', 's']:
+                        self.log(f'[INFO] The peer list cache of tracker {self.name} is {self.cache_stats.stats()}')
                     self.busy = False
                 else:
                     self.busy = False
                     time.sleep(0.01)
             except Exception as e:
-                self.log("[ERROR] Tracker get exception:", type(e).__name__)
+                self.log(f'[ERROR] Tracker get exception: {type(e).__name__}', ERROR)
                 self.busy = False
 
         self.cleanup()
         self.log(f'[STOP] Tracker {self.name} stopped')
+        self.logger.close()
 
     def cleanup(self):
         self.busy = True
         self.log('[STOP] Stopping server...')
         self.server.stop()
         self.server.join()
+        if self.udp_server is not None:
+            self.udp_server.stop()
+            self.udp_server.join()
         self.log('[STOP] Server stopped')
     
+    def sample_peers(self, info_hash, numwant, exclude):
+        """
+        Peers for an announce, from the swarm of its info-hash, topped up with peers that announce without one and
+        may be in any torrent, as in the single network the tracker used to keep; those get peers of every swarm.
+        Call with `lock` held.
+        :return: the peers as `EncodedPeer`s
+        """
+        order = [info_hash, ""] if info_hash else self.swarms
+        peers = []
+        for key in order:
+            swarm = self.swarms.get(key)
+            if swarm is not None and len(peers) < numwant:
+                peers += swarm.sample_encoded(numwant - len(peers), exclude=exclude)
+        return peers
+
+    def add_peer(self, info_hash, peer):
+        # call with `lock` held, an announce sets the deadline of the next one
+        swarm = self.swarms.get(info_hash)
+        if swarm is None:
+            swarm = self.swarms[info_hash] = Swarm(info_hash, self.cache_stats)
+        swarm.add(peer)
+        self.expiry.schedule((info_hash, peer['peer_id']), time.monotonic() + self.peer_timeout)
+        return swarm
+
+    def remove_peer(self, info_hash, peer_id):
+        # call with `lock` held
+        self.expiry.cancel((info_hash, peer_id))
+        swarm = self.swarms.get(info_hash)
+        if swarm is None or swarm.remove(peer_id) is None:
+            return False
+        if not len(swarm):
+            del self.swarms[info_hash]
+        return True
+
+    def expire(self):
+        """
+        Drop the peers that missed their announce
+        """
+        with self.lock:
+            expired = self.expiry.advance(time.monotonic())
+            for info_hash, peer_id in expired:
+                self.remove_peer(info_hash, peer_id)
+        for info_hash, peer_id in expired:
+            self.log(f'Peer {peer_id} expired from "{info_hash}" without announcing again!')
+
+    def respond_udp(self, data, address):
+        """
+        Answer a datagram of the UDP tracker protocol
+        :return: the datagram to send back, None for one that is not worth an answer
+
+        Announces are taken the way `respond` takes them, a "started" from a peer in the swarm already is refused.
+        The answer keeps to the BEP 15 layout, which has no room for the `peer_flags` a TCP answer carries, so a peer
+        that learns of others over UDP does not know their extensions and greets them with a plain bitfield.
+        """
+        if len(data) < HEADER.size:
+            return None
+        connection_id, action, transaction_id = HEADER.unpack_from(data)
+        if action == ACTION_CONNECT:
+            if connection_id != PROTOCOL_ID:
+                return None
+            return CONNECT_RESPONSE.pack(ACTION_CONNECT, transaction_id, self.connection_ids.issue(address))
+        if not self.connection_ids.valid(connection_id, address):
+            return pack_error(transaction_id, 'Invalid connection id')
+
+        if action == ACTION_ANNOUNCE:
+            if len(data) < HEADER.size + ANNOUNCE.size:
+                return pack_error(transaction_id, 'Truncated announce')
+            raw_hash, _, _, left, _, event, ip, _, numwant, port = ANNOUNCE.unpack_from(data, HEADER.size)
+            event = EVENTS.get(event)
+            ip = inet_ntoa(ip.to_bytes(4, 'big')) if ip else address[0]
+            info_hash, peer_id = unpack_info_hash(raw_hash), f'{ip}:{port}'
+            if self.logger.enabled(DEBUG):
+                self.log(f'[REQUEST] Received UDP announce of {peer_id} for "{info_hash}", event {event}', DEBUG)
+            numwant = self.numwant if numwant < 0 else min(numwant, self.max_numwant)
+            with self.lock:
+                if event == 'stopped':
+                    self.remove_peer(info_hash, peer_id)
+                    peers = []
+                else:
+                    swarm = self.swarms.get(info_hash)
+                    old = swarm.get(peer_id) if swarm is not None else None
+                    if event == 'started' and old is not None:
+                        self.log(f'Peer {peer_id} requested to join the network, but it is already in the network!', WARN)
+                        return pack_error(transaction_id, 'You\'re already in the network!')
+                    peer = {'ip': ip, 'port': port, 'peer_id': peer_id, 'left': left}
+                    if old is not None and 'extensions' in old:
+                        peer['extensions'] = old['extensions']
+                    swarm = self.add_peer(info_hash, peer)
+                    if event == 'completed':
+                        swarm.completed += 1
+                    peers = self.sample_peers(info_hash, numwant, peer_id)
+                swarm = self.swarms.get(info_hash)
+                leechers, seeders = (swarm.leechers, swarm.seeders) if swarm is not None else (0, 0)
+            return ANNOUNCE_RESPONSE.pack(ACTION_ANNOUNCE, transaction_id, self.interval, leechers, seeders) + \
+                b''.join(peer.compact for peer in peers if peer.compact is not None)
+
+        if action == ACTION_SCRAPE:
+            raw_hashes = data[HEADER.size:HEADER.size + 20 * MAX_SCRAPE]
+            entries = []
+            with self.lock:
+                for offset in range(0, len(raw_hashes) - 19, 20):
+                    swarm = self.swarms.get(unpack_info_hash(raw_hashes[offset:offset + 20]))
+                    if swarm is None:
+                        entries.append(SCRAPE_ENTRY.pack(0, 0, 0))
+                    else:
+                        entries.append(SCRAPE_ENTRY.pack(swarm.seeders, swarm.completed, swarm.leechers))
+            return RESPONSE_HEADER.pack(ACTION_SCRAPE, transaction_id) + b''.join(entries)
+
+        return pack_error(transaction_id, f'Invalid action {action}')
+
     def respond(self, request, connectionSocket):
-        self.log(f'[REQUEST] Received request: {request}')
+        if self.logger.enabled(DEBUG):
+            self.log(f'[REQUEST] Received request: {request}', DEBUG)
 
         response = {
             'error_code': 0,
             'message': None,
-            'num-of-peers': len(self.peers),
-            'peers': self.peers.copy()
+            'num-of-peers': None,
+            'peers': None
         }
 
         event = request['event']
-        if event == 'started':
-            if request['peer_id'] not in self.peers:
-                peer = {
-                    'ip': request['ip'],
-                    'port': request['port'],
-                    'peer_id': request['peer_id']
-                }
-                self.peers[request['peer_id']] = peer
-
-                response['message'] = 'You\'ve joined! Welcome to the P2P network!'
-
-                self.log(f'Peer {request["peer_id"]} joined the network!')
-            else:
-                response['error_code'] = 1
-                response['message'] = 'You\'re already in the network!'
-                response['num-of-peers'] = None
-                response['peers'] = None
-
-                self.log(f'Peer {request["peer_id"]} requested to join the network, but it is already in the network!')
-
-        elif event == 'stopped':
-            if request['peer_id'] in self.peers:
-                self.peers.pop(request['peer_id'])
+        info_hash = request.get('info_hash') or ""
+        peer_id = request['peer_id']
+        with self.lock:
+            swarm = self.swarms.get(info_hash)
+            if event == 'started':
+                if swarm is None or peer_id not in swarm:
+                    peer = {
+                        'ip': request['ip'],
+                        'port': request['port'],
+                        'peer_id': peer_id
+                    }
+                    if request.get('extensions'):
+                        # passed on so that peers joining later can shape their handshake for this one
+                        peer['extensions'] = request['extensions']
+                    if request.get('left') is not None:
+                        peer['left'] = request['left']
+                    swarm = self.add_peer(info_hash, peer)
+
+                    response['message'] = 'You\'ve joined! Welcome to the P2P network!'
+
+                    self.log(f'Peer {peer_id} joined the network!')
+                else:
+                    response['error_code'] = 1
+                    response['message'] = 'You\'re already in the network!'
+
+                    self.log(f'Peer {peer_id} requested to join the network, but it is already in the network!', WARN)
+
+            elif event in ('', 'completed'):
+                # a regular announce keeps the peer, and adds it again if it expired meanwhile
+                peer = swarm.get(peer_id) if swarm is not None else None
+                if peer is None:
+                    peer = {
+                        'ip': request['ip'],
+                        'port': request['port'],
+                        'peer_id': peer_id
+                    }
+                    if request.get('extensions'):
+                        peer['extensions'] = request['extensions']
+                if request.get('left') is not None:
+                    peer = dict(peer, left=request['left'])
+                swarm = self.add_peer(info_hash, peer)
+                if event == 'completed':
+                    swarm.completed += 1
+
+            elif event == 'stopped':
+                if self.remove_peer(info_hash, peer_id):
+                    response['message'] = 'You\'ve left! Goodbye!'
+
+                    self.log(f'Peer {peer_id} left the network!')
+                else:
+                    response['error_code'] = 1
+                    response['message'] = 'You\'re not in the network!'
 
-                response['message'] = 'You\'ve left! Goodbye!'
+                    self.log(f'Peer {peer_id} requested to leave the network, but it is not in the network!', WARN)
 
-                self.log(f'Peer {request["peer_id"]} left the network!')
             else:
                 response['error_code'] = 1
-                response['message'] = 'You\'re not in the network!'
-                response['num-of-peers'] = None
-                response['peers'] = None
+                response['message'] = f'Invalid request event "{event}"!'
 
-                self.log(f'Peer {request["peer_id"]} requested to leave the network, but it is not in the network!')
+                self.log(f'Peer {peer_id} requested with invalid request event "{event}"!', WARN)
 
-        else:
-            response['error_code'] = 1
-            response['message'] = f'Invalid request event "{event}"!'
-            response['num-of-peers'] = None
-            response['peers'] = None
+            if response['error_code'] == 0:
+                numwant = self.numwant if request.get('numwant') is None else int(request['numwant'])
+                peers = self.sample_peers(info_hash, min(max(0, numwant), self.max_numwant), peer_id)
 
-            self.log(f'Peer {request["peer_id"]} requested with invalid request event "{event}"!')
-        
-        return response
+        if response['error_code'] == 0:
+            del response['peers']
+            response['interval'] = self.interval
+            response['min_interval'] = self.min_interval
+            response['num-of-peers'] = len(peers)
+            head = obj_encode(response, indent=None)
+            return Encoded(head[:-1] + b',' + encode_peers(peers, request.get('compact')) + b'}')
 
+        return response
 
 if __name__ == '__main__':
     import argparse
@@ -155,9 +340,20 @@ if __name__ == '__main__':
     parser.add_argument('-D', '--dir', type=str, default='sandbox/tracker/', help='Base directory of the tracker')
     parser.add_argument('-H', '--host', type=str, default='', help='Host of the tracker')
     parser.add_argument('-P', '--port', type=int, default=7889, help='Port of the tracker')
+    parser.add_argument('--engine', type=str, default='thread', choices=list(ENGINES), help='Networking engine')
+    parser.add_argument('--backlog', type=int, default=128, help='Listen backlog of the tracker')
+    parser.add_argument('--workers', type=int, default=16, help='Announces handled at the same time')
+    parser.add_argument('--numwant', type=int, default=50, help='Peers handed out to an announce by default')
+    parser.add_argument('--interval', type=int, default=1800, help='Seconds between the announces of a peer')
+    parser.add_argument('--min-interval', type=int, default=900, help='Seconds at least between the announces of a peer')
+    parser.add_argument('--no-udp', action='store_true', help='Serve announces over TCP only')
+    parser.add_argument('--max-numwant', type=int, default=200, help='Peers handed out to an announce at most')
+    parser.add_argument('--log-level', type=str, default='info', choices=list(LOG_LEVELS), help='Least level of the messages logged')
     args = parser.parse_args()
 
-    tracker = Tracker(args.name, args.dir, args.host, args.port)
+    tracker = Tracker(args.name, args.dir, args.host, args.port, engine=args.engine, backlog=args.backlog,
+                      max_workers=args.workers, numwant=args.numwant, max_numwant=args.max_numwant, udp=not args.no_udp,
+                      interval=args.interval, min_interval=args.min_interval, log_level=args.log_level)
     tracker.start()
 
     while True:
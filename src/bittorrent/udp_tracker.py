@@ -0,0 +1,158 @@
+# the UDP tracker protocol of BEP 15: a connection id handshake, then binary announces and scrapes, one datagram each
+import os
+import time
+import random
+import socket
+import struct
+import hashlib
+
+PROTOCOL_ID = 0x41727101980
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_SCRAPE = 2
+ACTION_ERROR = 3
+EVENTS = {0: None, 1: "completed", 2: "started", 3: "stopped"}
+EVENT_IDS = {v: k for k, v in EVENTS.items()}
+
+HEADER = struct.Struct('!qii')  # connection id, action, transaction id
+CONNECT_RESPONSE = struct.Struct('!iiq')  # action, transaction id, connection id
+# info hash, peer id, downloaded, left, uploaded, event, IPv4 address, key, numwant, port
+ANNOUNCE = struct.Struct('!20s20sqqqiIIiH')
+ANNOUNCE_RESPONSE = struct.Struct('!iiiii')  # action, transaction id, interval, leechers, seeders
+SCRAPE_ENTRY = struct.Struct('!iii')  # seeders, completed, leechers
+RESPONSE_HEADER = struct.Struct('!ii')  # action, transaction id
+MAX_SCRAPE = 74  # info hashes in one scrape, as many as fit in a datagram
+
+
+def pack_info_hash(info_hash):
+    # the hex info hash of a `Torrent`, or zeros for the swarm of peers that announce without one
+    return bytes.fromhex(info_hash) if info_hash else bytes(20)
+
+
+def unpack_info_hash(raw):
+    return "" if raw == bytes(20) else raw.hex()
+
+
+def pack_error(transaction_id, message):
+    return RESPONSE_HEADER.pack(ACTION_ERROR, transaction_id) + message.encode('utf-8')
+
+
+class ConnectionIds:
+    def __init__(self, lifetime=60):
+        """
+        Connection ids of the UDP tracker protocol, a keyed hash of the client address and the current period of
+        `lifetime` seconds, so that the tracker keeps no state for them; an id is good for one to two periods
+        """
+        self.lifetime = lifetime
+        self.secret = os.urandom(16)
+
+    def make(self, address, period):
+        digest = hashlib.blake2b(f'{address[0]}:{address[1]}:{period}'.encode('utf-8'), key=self.secret,
+                                 digest_size=8).digest()
+        return struct.unpack('!q', digest)[0]
+
+    def issue(self, address, now=None):
+        now = time.time() if now is None else now
+        return self.make(address, int(now // self.lifetime))
+
+    def valid(self, connection_id, address, now=None):
+        now = time.time() if now is None else now
+        period = int(now // self.lifetime)
+        return connection_id in (self.make(address, period), self.make(address, period - 1))
+
+
+class UdpTrackerClient:
+    def __init__(self, host, port, timeout=0.5, retries=1, lifetime=60):
+        """
+        The peer side of the UDP tracker protocol
+        :param host:
+        :param port:
+        :param timeout: seconds to wait for the first answer, doubled on every retry
+        :param retries: requests sent again before the tracker is taken to have no UDP endpoint
+        :param lifetime: seconds a connection id is used for
+
+        Calls raise OSError (socket.timeout included) when the tracker does not answer.
+        """
+        self.address = (host, port)
+        self.timeout = timeout
+        self.retries = retries
+        self.lifetime = lifetime
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # connected, so that a host with nothing on the port refuses at once rather than after the timeouts
+        self.socket.connect(self.address)
+        self.connection_id = None
+        self.connected_at = 0.0
+
+    def request(self, package, transaction_id):
+        timeout = self.timeout
+        for attempt in range(self.retries + 1):
+            self.socket.settimeout(timeout)
+            self.socket.send(package)
+            deadline = time.monotonic() + timeout
+            try:
+                while True:
+                    data = self.socket.recv(65536)
+                    if len(data) >= RESPONSE_HEADER.size and RESPONSE_HEADER.unpack_from(data)[1] == transaction_id:
+                        return data
+                    self.socket.settimeout(max(0.001, deadline - time.monotonic()))
+            except socket.timeout:
+                if attempt == self.retries:
+                    raise
+            timeout *= 2
+
+    def connect(self):
+        if self.connection_id is not None and time.monotonic() - self.connected_at < self.lifetime:
+            return self.connection_id
+        transaction_id = random.getrandbits(31)
+        data = self.request(HEADER.pack(PROTOCOL_ID, ACTION_CONNECT, transaction_id), transaction_id)
+        action, _, connection_id = CONNECT_RESPONSE.unpack_from(data)
+        if action != ACTION_CONNECT:
+            raise ConnectionError(data[RESPONSE_HEADER.size:].decode('utf-8', 'replace'))
+        self.connection_id, self.connected_at = connection_id, time.monotonic()
+        return connection_id
+
+    def announce(self, info_hash, ip, port, event=None, left=0, numwant=-1, peer_id=b'', downloaded=0, uploaded=0):
+        """
+        :param ip: the IPv4 address to be listed under, None for the one the datagram comes from
+        :return: the answer in the form of the TCP tracker, with the peers as a compact list
+        """
+        transaction_id = random.getrandbits(31)
+        try:
+            address, = struct.unpack('!I', socket.inet_aton(ip)) if ip else (0,)
+        except OSError:
+            address = 0
+        package = HEADER.pack(self.connect(), ACTION_ANNOUNCE, transaction_id) + ANNOUNCE.pack(
+            pack_info_hash(info_hash), peer_id[:20].ljust(20, b'\0'), downloaded, left, uploaded, EVENT_IDS[event],
+            address, 0, numwant, port)
+        data = self.request(package, transaction_id)
+        action, _ = RESPONSE_HEADER.unpack_from(data)
+        if action != ACTION_ANNOUNCE:
+            self.connection_id = None
+            return {'error_code': 1, 'message': data[RESPONSE_HEADER.size:].decode('utf-8', 'replace'),
+                    'num-of-peers': None, 'peers': None}
+        _, _, interval, leechers, seeders = ANNOUNCE_RESPONSE.unpack_from(data)
+        peers = data[ANNOUNCE_RESPONSE.size:]
+        return {'error_code': 0, 'message': None, 'num-of-peers': len(peers) // 6, 'peers': peers,
+                'interval': interval, 'leechers': leechers, 'seeders': seeders}
+
+    def scrape(self, info_hashes):
+        """
+        :return: a dict of info hash to its seeders, completed downloads and leechers
+        """
+        info_hashes = list(info_hashes)[:MAX_SCRAPE]
+        transaction_id = random.getrandbits(31)
+        package = HEADER.pack(self.connect(), ACTION_SCRAPE, transaction_id)
+        package += b''.join(pack_info_hash(info_hash) for info_hash in info_hashes)
+        data = self.request(package, transaction_id)
+        action, _ = RESPONSE_HEADER.unpack_from(data)
+        if action != ACTION_SCRAPE:
+            self.connection_id = None
+            raise ConnectionError(data[RESPONSE_HEADER.size:].decode('utf-8', 'replace'))
+        stats = {}
+        for i, info_hash in enumerate(info_hashes):
+            seeders, completed, leechers = SCRAPE_ENTRY.unpack_from(data, RESPONSE_HEADER.size + i * SCRAPE_ENTRY.size)
+            stats[info_hash] = {'seeders': seeders, 'completed': completed, 'leechers': leechers}
+        return stats
+
+    def close(self):
+        self.socket.close()
@@ -1,5 +1,10 @@
 from collections.abc import Callable
+import os
+import sys
 import json
+import queue
+import atexit
+import threading
 import base64
 from struct import pack, unpack
 import socket
@@ -9,7 +14,7 @@ from typing import Any
 
 class MyEncoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, bytes):
+        if isinstance(obj, (bytes, bytearray, memoryview)):
             return "BYTES" + base64.b64encode(obj).decode('utf-8')
         return json.JSONEncoder.default(self, obj)
     
@@ -28,8 +33,8 @@ class MyDecoder(json.JSONDecoder):
         return dct
 
 
-def obj_encode(obj):
-    return json.dumps(obj, cls=MyEncoder, indent=4, sort_keys=True, separators=(',', ':')).encode('utf-8')
+def obj_encode(obj, indent=4):
+    return json.dumps(obj, cls=MyEncoder, indent=indent, sort_keys=True, separators=(',', ':')).encode('utf-8')
 
 
 def obj_decode(binary):
@@ -45,11 +50,144 @@ def obj2json(obj):
     return json.dumps(obj, cls=MyEncoder, indent=4, sort_keys=True)
 
 
-def log_fn(msg, log_file=None):
+DEBUG = 10
+INFO = 20
+WARN = 30
+ERROR = 40
+LOG_LEVELS = {'debug': DEBUG, 'info': INFO, 'warn': WARN, 'error': ERROR}
+
+
+def console_log(msg, level=INFO):
+    # the log of components that are not given one
     print(msg)
-    if log_file:
-        with open(log_file, 'a') as f:
-            f.write(msg + '\n')
+
+
+class AsyncLogger:
+    def __init__(self, log_file=None, level=INFO, console_level=INFO, max_bytes=64 * 1024 * 1024, backups=3,
+                 max_queue=65536):
+        """
+        A log written by a thread of its own, so that logging costs the threads that log a queue put
+        :param log_file: None to log to the console only
+        :param level: messages below it are dropped at once, a name of `LOG_LEVELS` or a number
+        :param console_level: messages printed as well, None for none; the writer thread prints them, never the caller
+        :param max_bytes: size at which the file is rotated to `log_file`.1, and so on up to `backups`, 0 never to
+        rotate
+        :param max_queue: messages waiting for the writer at most, further ones are dropped and counted in `dropped`
+
+        The file is kept open and written a batch at a time, everything queued meanwhile, then flushed. Build messages
+        that cost something to put together only if `enabled` says they are wanted. A batch that fails to be written,
+        e.g. on a full disk, is reported on stderr and counted in `errors`, and the writer goes on with the next one,
+        reopening the file if it has to; the number of messages dropped meanwhile is logged once there is room.
+        """
+        self.level = LOG_LEVELS.get(level, level)
+        self.console_level = LOG_LEVELS.get(console_level, console_level)
+        self.log_file = log_file
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = None
+        self.size = 0
+        self.queue = queue.Queue(max_queue)
+        self.dropped = 0
+        self.reported = 0
+        self.errors = 0
+        self.closed = False
+        if log_file:
+            self.open()
+        self.writer = threading.Thread(target=self.write_loop, name='AsyncLogger', daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, msg, level=INFO):
+        if level >= self.level and not self.closed:
+            try:
+                self.queue.put_nowait((level, msg))
+            except queue.Full:
+                self.dropped += 1  # a count that may miss a drop or two when threads race, it is only reported
+
+    __call__ = log
+
+    def open(self):
+        # binary, so that `size` counts what lands on disk rather than characters
+        self.file = open(self.log_file, 'ab')
+        self.size = self.file.tell()
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.log_file}.{i}'):
+                os.replace(f'{self.log_file}.{i}', f'{self.log_file}.{i + 1}')
+        if self.backups > 0:
+            os.replace(self.log_file, f'{self.log_file}.1')
+        else:
+            os.remove(self.log_file)
+        self.open()
+
+    def write_loop(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            if self.dropped != self.reported:
+                dropped, self.reported = self.dropped - self.reported, self.dropped
+                batch.append((WARN, f'[WARN] The log dropped {dropped} messages, it was written slower than it grew'))
+            try:
+                self.write_batch(batch)
+            except Exception as e:
+                self.errors += 1
+                print(f'[ERROR] Failed to write {len(batch)} log messages to {self.log_file}: {e!r}', file=sys.stderr)
+                self.recover()
+            if stop:
+                if self.file is not None:
+                    self.file.close()
+                return
+
+    def write_batch(self, batch):
+        for record in batch:
+            if record is None:
+                continue
+            level, msg = record
+            if self.console_level is not None and level >= self.console_level:
+                print(msg)
+            if self.file is not None:
+                line = (msg + '\n').encode('utf-8', 'replace')
+                self.file.write(line)
+                self.size += len(line)
+                if self.max_bytes and self.size >= self.max_bytes:
+                    self.rotate()
+        if self.file is not None:
+            self.file.flush()
+        sys.stdout.flush()
+
+    def recover(self):
+        # a rotation may have failed half way, with the file closed; go on with console output alone if it cannot
+        # be opened again
+        if self.log_file and (self.file is None or self.file.closed):
+            try:
+                self.open()
+            except OSError:
+                self.file = None
+
+    def close(self):
+        """
+        Write out what is queued and stop the writer thread
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.queue.put(None, timeout=5.0)
+        except queue.Full:  # a writer that cannot keep up is not waited for
+            pass
+        else:
+            self.writer.join(5.0)
+        atexit.unregister(self.close)
 
 
 def insert(seq, keys, item, key):
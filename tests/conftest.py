@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules import each other flat, the way the scripts in src/bittorrent run
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'bittorrent'))
@@ -0,0 +1,59 @@
+import math
+import random
+
+from choker import Choker, RateMeter
+
+
+def test_rate_meter_decays_over_its_window():
+    meter = RateMeter(window=10.0)
+    meter.last = 0.0
+    meter.add(1000, now=0.0)
+    assert meter.rate(now=0.0) == 100.0
+    assert math.isclose(meter.rate(now=10.0), 100.0 / math.e)
+    meter.add(1000, now=10.0)
+    assert math.isclose(meter.rate(now=10.0), 100.0 / math.e + 100.0)
+
+
+def test_slots_go_to_the_best_and_one_rotates():
+    random.seed(1)
+    choker = Choker(slots=3, interval=10.0, optimistic_interval=30.0)
+    peers = {'a': 500, 'b': 400, 'c': 30, 'd': 20, 'e': 10}
+    unchoked = choker.rechoke(peers, now=0.0)
+    assert {'a', 'b'} <= unchoked and len(unchoked) == 3
+    assert choker.optimistic in ('c', 'd', 'e')
+    assert not choker.due(now=9.9) and choker.due(now=10.0)
+
+    # the optimistic unchoke lasts its interval across rounds
+    assert choker.rechoke(peers, now=10.0) == unchoked
+    assert choker.rechoke(peers, now=20.0) == unchoked
+
+    # then moves on, over time to every peer outside the regular slots
+    seen = set()
+    for n in range(3, 40):
+        unchoked = choker.rechoke(peers, now=n * 30.0)
+        assert {'a', 'b'} <= unchoked and len(unchoked) == 3
+        seen.add(choker.optimistic)
+    assert seen == {'c', 'd', 'e'}
+
+
+def test_an_optimistic_peer_that_ranks_high_frees_the_slot():
+    choker = Choker(slots=2)
+    choker.rechoke({'a': 10, 'b': 5, 'c': 1}, now=0.0)
+    choker.optimistic = 'c'
+    # c now uploads best, it takes a regular slot and the optimistic one goes to another peer
+    assert choker.rechoke({'a': 1, 'b': 5, 'c': 10}, now=1.0) == {'c', choker.optimistic}
+    assert choker.optimistic in ('a', 'b')
+
+
+def test_free_slots_are_taken_at_once_and_released():
+    choker = Choker(slots=2)
+    choker.next_round = 100.0
+    assert choker.request('a') and choker.request('b')
+    assert not choker.request('c')
+    assert not choker.due(now=50.0)
+    choker.release('a')
+    # the slot is handed out in the next round, which comes early
+    assert choker.due(now=50.0)
+    assert choker.request('c')
+    unchoked = choker.rechoke({'b': 1, 'c': 2, 'd': 3}, now=50.0)
+    assert unchoked == {'d', choker.optimistic} and choker.optimistic in ('b', 'c')
@@ -0,0 +1,125 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from components.client import Client, ConnectionPool, idempotent
+from components.rdt_socket import rdt_socket
+from utils import obj_encode, obj_decode
+
+
+class FakeTracker:
+    """
+    A server that answers requests with their rid, or drops the connection on requests `drop` is true for
+    """
+
+    def __init__(self, drop=lambda request: False):
+        self.socket = socket.create_server(('127.0.0.1', 0))
+        self.port = self.socket.getsockname()[1]
+        self.drop = drop
+        self.received = []
+        self.connections = []
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            try:
+                connection, _ = self.socket.accept()
+            except OSError:
+                return
+            self.connections.append(connection)
+            threading.Thread(target=self.serve, args=(connection,), daemon=True).start()
+
+    def serve(self, connection):
+        rdt = rdt_socket(connection)
+        try:
+            while True:
+                request = obj_decode(rdt.recvBytes())
+                self.received.append(request)
+                if self.drop(request):
+                    connection.close()
+                    return
+                rdt.sendBytes(obj_encode({'rid': request['rid'], 'ok': True}))
+        except OSError:
+            connection.close()
+
+    def close(self):
+        self.socket.close()
+        for connection in self.connections:
+            connection.close()
+
+
+def run(client, files):
+    responses = []
+    client.start()
+    for file in files:
+        client.send_file(file, lambda response, _: responses.append(response))
+    deadline = time.monotonic() + 10
+    while client.busy and time.monotonic() < deadline:
+        time.sleep(0.01)
+    client.stop()
+    client.join()
+    return responses
+
+
+def test_idempotent():
+    assert idempotent({'event': ''}) and idempotent({'event': None}) and idempotent({})
+    assert not idempotent({'event': 'stopped'}) and not idempotent({'event': 'started'})
+
+
+@pytest.mark.parametrize('event, sent', [('stopped', 1), ('completed', 1), ('', 3)])
+def test_lost_responses_are_retried_only_when_idempotent(event, sent):
+    tracker = FakeTracker(drop=lambda request: True)
+    logged = []
+    client = Client('127.0.0.1', tracker.port, retries=2, backoff=0.01, pool=ConnectionPool(),
+                    log=lambda msg, level=None: logged.append(msg))
+    assert run(client, [{'event': event}]) == []
+    assert len(tracker.received) == sent
+    assert len(logged) == 1 and logged[0].startswith('[ERROR] Request to')
+    tracker.close()
+
+
+def test_dead_connection_is_retried_at_once():
+    tracker = FakeTracker()
+    pool = ConnectionPool()
+    pool.acquire('127.0.0.1', tracker.port)
+    dead = pool.get('127.0.0.1', tracker.port)
+
+    def send(frame):
+        raise BrokenPipeError(32, 'Broken pipe')
+
+    # a connection whose failure the reader has not noticed yet
+    dead.rdt.sendBytes = send
+    client = Client('127.0.0.1', tracker.port, timeout=10.0, backoff=0.01, pool=pool)
+    start = time.monotonic()
+    assert [response['ok'] for response in run(client, [{'event': 'stopped'}])] == [True]
+    assert time.monotonic() - start < 2
+    assert not dead.alive and pool.connections[('127.0.0.1', tracker.port)] is not dead
+    pool.release('127.0.0.1', tracker.port)
+    tracker.close()
+
+
+def test_connections_are_closed_when_the_last_client_stops():
+    tracker = FakeTracker()
+    pool = ConnectionPool()
+    first = Client('127.0.0.1', tracker.port, pool=pool)
+    second = Client('127.0.0.1', tracker.port, pool=pool)
+    second.start()
+    assert run(first, [{'event': 'started'}]) != []
+    connection = pool.connections[('127.0.0.1', tracker.port)]
+    assert connection.alive
+    second.stop()
+    second.join()
+    assert pool.connections == {} and not connection.alive
+    connection.reader.join(5)
+    assert not connection.reader.is_alive()
+    tracker.close()
+
+
+def test_send_errors_propagate():
+    a, b = socket.socketpair()
+    b.close()
+    with pytest.raises(OSError):
+        rdt_socket(a).sendBytes(b'request')
+    a.close()
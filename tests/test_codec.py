@@ -0,0 +1,100 @@
+import random
+
+import bitarray
+import pytest
+
+from components.codec import pack_bitfield, unpack_bitfield, binary_encode, binary_decode, encode_message, \
+    decode_message, message_len, CODEC_BINARY, CODEC_JSON
+
+
+def bits(s):
+    return bitarray.bitarray(s)
+
+
+@pytest.mark.parametrize('bf, enc', [
+    (bits(''), 'none'),
+    (bits('0' * 77), 'none'),
+    (bits('1' * 77), 'all'),
+    (bits('1' * 300 + '0' * 700 + '1' * 5), 'rle'),
+    (bits('10' * 50 + '1'), 'raw'),
+])
+def test_bitfield_round_trip(bf, enc):
+    packed = pack_bitfield(bf)
+    assert packed['enc'] == enc
+    assert unpack_bitfield(packed) == bf
+
+
+def test_bitfield_round_trip_random():
+    rng = random.Random(1)
+    for _ in range(200):
+        n = rng.randrange(1, 2000)
+        density = rng.choice([0.001, 0.1, 0.5, 0.99])
+        bf = bitarray.bitarray([rng.random() < density for _ in range(n)])
+        assert unpack_bitfield(pack_bitfield(bf)) == bf
+
+
+def test_bitfield_long_runs():
+    # runs longer than a varint byte holds
+    bf = bits('0' * 100000 + '1' * 20000 + '0')
+    packed = pack_bitfield(bf)
+    assert packed['enc'] == 'rle'
+    assert unpack_bitfield(packed) == bf
+
+
+def test_unpack_bitfield_plain_forms():
+    assert unpack_bitfield([1, 0, 1]) == bits('101')
+    bf = bits('0110')
+    assert unpack_bitfield(bf) is bf
+    with pytest.raises(ValueError):
+        unpack_bitfield({'enc': 'zip', 'n': 3})
+
+
+MESSAGES = [
+    {'type': 'Choke'},
+    {'type': 'UnChoke'},
+    {'type': 'Interested'},
+    {'type': 'UnInterested'},
+    {'type': 'KeepAlive'},
+    {'type': 'ServerClose'},
+    {'type': 'Have', 'file': 'data.bin', 'index': 7, 'have': True},
+    {'type': 'Have', 'file': 'données.bin', 'index': 2 ** 32 - 1, 'have': False},
+    {'type': 'HaveBatch', 'file': 'data.bin', 'indices': [0, 3, 99999]},
+    {'type': 'HaveBatch', 'file': 'data.bin', 'indices': []},
+    {'type': 'Request', 'file': 'data.bin', 'index': 3},
+    {'type': 'Request', 'file': 'data.bin', 'index': 3, 'begin': 16384, 'length': 16384},
+    {'type': 'Cancel', 'file': 'data.bin', 'index': 3, 'begin': 0, 'length': 1024},
+    {'type': 'Piece', 'file': 'data.bin', 'index': 5, 'piece': bytes(range(256)) * 4},
+    {'type': 'Piece', 'file': 'data.bin', 'index': 5, 'begin': 4096, 'piece': b'\xb7\x00' * 100},
+    {'type': 'Piece', 'file': 'empty', 'index': 0, 'piece': b''},
+    {'type': 'Bitfield', 'bitfield': {'a': bits('1011001'), 'b': bits('1' * 64), 'c': bits('')}},
+    {'type': 'Request', 'file': 'data.bin', 'index': 1, 'rid': 12, 'extra': {'nested': [1, 2]}},
+]
+
+
+@pytest.mark.parametrize('message', MESSAGES, ids=lambda m: m['type'])
+def test_binary_round_trip(message):
+    decoded = binary_decode(binary_encode(message))
+    for key, value in message.items():
+        assert decoded[key] == value
+    assert decoded['len'] == message_len(message)
+    assert set(decoded) - set(message) <= {'len', 'id'}
+
+
+def test_bitfield_message_takes_packed_bitfields():
+    bf = bits('1' * 40 + '0' * 40)
+    decoded = binary_decode(binary_encode({'type': 'Bitfield', 'bitfield': {'a': pack_bitfield(bf)}}))
+    assert decoded['bitfield'] == {'a': bf}
+
+
+def test_decode_message_tells_codecs_apart():
+    message = {'type': 'Have', 'file': 'data.bin', 'index': 1, 'have': True, 'id': 4, 'len': 6}
+    assert decode_message(encode_message(message, CODEC_BINARY)) == message
+    assert decode_message(encode_message(message, CODEC_JSON)) == message
+    # anything the binary layout does not know goes as JSON
+    handshake = {'type': 'Handshake', 'codecs': [CODEC_BINARY]}
+    assert decode_message(encode_message(handshake, CODEC_BINARY)) == handshake
+
+
+def test_binary_decode_rejects_unknown_ids():
+    with pytest.raises(ValueError):
+        binary_decode(b'\xb7\x63\x00\x00\x00\x00')
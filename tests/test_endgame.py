@@ -0,0 +1,112 @@
+import os
+import types
+
+import bitarray
+import pytest
+
+from piece_manager import PieceManager
+from blocks import BLOCK_SIZE
+from peer import Peer
+
+PIECE_LEN = 4 * BLOCK_SIZE
+FILE = 'data.bin'
+
+
+@pytest.fixture
+def leecher(tmp_path):
+    os.makedirs(f'{tmp_path}/seeder')
+    os.makedirs(f'{tmp_path}/leecher')
+    data = os.urandom(2 * PIECE_LEN)
+    with open(f'{tmp_path}/seeder/{FILE}', 'wb') as f:
+        f.write(data)
+    seeder = PieceManager(f'{tmp_path}/seeder/', piece_len=PIECE_LEN)
+    pieces = PieceManager(f'{tmp_path}/leecher/', piece_len=PIECE_LEN, endgame=16)
+    pieces.add_file(torrent=seeder.torrents[FILE])
+    seeder.close()
+    peer = Peer('leecher', f'{tmp_path}/leecher/', '127.0.0.1', 0, pieceManager=pieces, pipeline_depth=64)
+    peer.online = True
+    yield peer, data
+    peer.server.serverSocket.close()
+    peer.logger.close()
+    pieces.close()
+
+
+def everything(n):
+    bitfield = bitarray.bitarray(n)
+    bitfield.setall(True)
+    return {FILE: bitfield}
+
+
+def connect(peer, peer_id):
+    states = peer.make_states()
+    states['peer_bitfield'] = everything(2)
+    states['blocks'] = states['duplex'] = True
+    states['recv']['choke'] = False
+    states['recv']['interested'] = True
+    peer.pieceManager.update_count_from_bitfield(peer_id, states['peer_bitfield'])
+    peer.peerConnections[peer_id] = types.SimpleNamespace(states=states)
+    return states
+
+
+def keys(messages, type):
+    return {(m['file'], m['index'], m['begin']) for m in messages if m['type'] == type}
+
+
+def test_interest_checks_do_not_enter_endgame(leecher):
+    peer, _ = leecher
+    pieces = peer.pieceManager
+    # every piece is asked for, as whole pieces, so the file is due for endgame mode
+    for index in range(2):
+        pieces.require_not(FILE, index)
+    assert pieces.is_interesting(everything(2))
+    with pieces.lock:
+        assert pieces.in_endgame(FILE)
+    assert pieces.endgame == {}
+    # only handing out requests enters it
+    assert pieces.get_piece_request(everything(2)) == {'file': FILE, 'index': 0}
+    assert list(pieces.endgame) == [FILE]
+
+
+def test_no_duplicates_within_one_batch(leecher):
+    peer, _ = leecher
+    requests = peer.pieceManager.get_block_requests(everything(2), 64)
+    assert len(requests) == 8
+    assert len({(r['file'], r['index'], r['begin']) for r in requests}) == 8
+    assert list(peer.pieceManager.endgame) == [FILE]
+
+
+def test_duplicate_requests_and_cancelled_losers(leecher):
+    peer, data = leecher
+    a = connect(peer, 'a')
+    b = connect(peer, 'b')
+    every_block = {(FILE, index, begin) for index in range(2) for begin in range(0, PIECE_LEN, BLOCK_SIZE)}
+
+    requests = [m for m in peer.make_requests('a', a) if m['type'] == "Request"]
+    assert len(requests) == 8 and keys(requests, "Request") == every_block
+    # b has nothing left to be asked for but the blocks already out to a, which it is asked for as well
+    assert keys(peer.make_requests('b', b), "Request") == every_block
+    assert list(peer.pieceManager.endgame) == [FILE]
+
+    # the first copy of a block wins, the request for it still out to b is cancelled
+    winner = (FILE, 0, BLOCK_SIZE)
+    peer.serve('a', {'type': "Piece", 'file': FILE, 'index': 0, 'begin': BLOCK_SIZE,
+                     'piece': data[BLOCK_SIZE:2 * BLOCK_SIZE]}, None, a)
+    assert winner not in a['pipeline']
+    messages = peer.catch_up('b', b)
+    assert keys(messages, "Cancel") == {winner}
+    assert [m['length'] for m in messages if m['type'] == "Cancel"] == [BLOCK_SIZE]
+    assert winner not in b['pipeline'] and len(b['pipeline']) == 7
+
+    # the copy b sends anyway is dropped
+    peer.serve('b', {'type': "Piece", 'file': FILE, 'index': 0, 'begin': BLOCK_SIZE,
+                     'piece': data[BLOCK_SIZE:2 * BLOCK_SIZE]}, None, b)
+    assert not peer.pieceManager.bitfield[FILE][0]
+
+    # b completes piece 1, the rest of it is cancelled on a
+    for begin in range(0, PIECE_LEN, BLOCK_SIZE):
+        peer.serve('b', {'type': "Piece", 'file': FILE, 'index': 1, 'begin': begin,
+                         'piece': data[PIECE_LEN + begin:PIECE_LEN + begin + BLOCK_SIZE]}, None, b)
+    assert peer.pieceManager.bitfield[FILE][1]
+    assert keys(peer.catch_up('a', a), "Cancel") == {(FILE, 1, begin) for begin in range(0, PIECE_LEN, BLOCK_SIZE)}
+    assert {key for key in a['pipeline'].outstanding} == {(FILE, 0, begin) for begin in (0, 2 * BLOCK_SIZE,
+                                                                                          3 * BLOCK_SIZE)}
@@ -0,0 +1,56 @@
+import os
+import threading
+
+from utils import AsyncLogger, INFO, DEBUG
+
+
+def test_rotation_counts_encoded_bytes(tmp_path):
+    path = f'{tmp_path}/peer.log'
+    logger = AsyncLogger(path, console_level=None, max_bytes=100, backups=2)
+    # 31 characters a line, but 61 bytes
+    for _ in range(2):
+        logger.log('é' * 30)
+    logger.close()
+    assert os.path.getsize(f'{path}.1') == 122
+    assert os.path.getsize(path) == 0
+
+
+def test_rotation_keeps_its_backups(tmp_path):
+    path = f'{tmp_path}/peer.log'
+    logger = AsyncLogger(path, console_level=None, max_bytes=10, backups=2)
+    for i in range(5):
+        logger.log(f'message {i}')
+    logger.close()
+    assert sorted(os.listdir(tmp_path)) == ['peer.log', 'peer.log.1', 'peer.log.2']
+    with open(f'{path}.1') as f:
+        assert f.read() == 'message 4\n'
+    with open(f'{path}.2') as f:
+        assert f.read() == 'message 3\n'
+
+
+def test_drops_are_counted_and_reported(tmp_path):
+    path = f'{tmp_path}/peer.log'
+    logger = AsyncLogger(path, console_level=None, max_queue=2)
+    writing, go_on = threading.Event(), threading.Event()
+    write_batch = logger.write_batch
+
+    def held_write_batch(batch):
+        writing.set()
+        go_on.wait(5.0)
+        write_batch(batch)
+
+    logger.write_batch = held_write_batch
+    logger.log('first')
+    assert writing.wait(5.0)
+    for i in range(5):
+        logger.log(f'queued {i}')
+    logger.log('filtered', DEBUG)
+    assert logger.dropped == 3
+    go_on.set()
+    logger.close()
+    logger.log('after close', INFO)
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert lines == ['first', 'queued 0', 'queued 1',
+                     '[WARN] The log dropped 3 messages, it was written slower than it grew']
+    assert logger.reported == 3
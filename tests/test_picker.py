@@ -0,0 +1,183 @@
+import random
+
+import bitarray
+import pytest
+
+from picker import PiecePicker, NOBODY
+
+
+def bits(s):
+    return bitarray.bitarray(s)
+
+
+def rarity(picker, file, index):
+    count = int(picker.availability[file][index])
+    return count if count >= 1 else count + NOBODY
+
+
+def brute_force(picker, peer_bitfield):
+    # the availability of every required piece the peer has, rarest first
+    return sorted(rarity(picker, file, index) for file, bitfield in peer_bitfield.items()
+                  for index in range(len(bitfield)) if bitfield[index] and (file, index) in picker)
+
+
+def test_require_and_require_not_bookkeeping():
+    picker = PiecePicker()
+    picker.add_file('a', 8)
+    assert picker.require('a', 3)
+    assert not picker.require('a', 3)
+    assert picker.require('a', 5)
+    # requiring a piece past the end grows the file
+    assert picker.require('b', 2)
+    assert len(picker) == 3
+    assert ('a', 3) in picker and ('b', 2) in picker and ('a', 4) not in picker
+    assert sorted(picker) == [('a', 3), ('a', 5), ('b', 2)]
+    assert picker.wanted['a'] == bits('00010100')
+
+    assert picker.require_not('a', 3)
+    assert not picker.require_not('a', 3)
+    assert not picker.require_not('c', 0)
+    assert len(picker) == 2 and ('a', 3) not in picker
+    assert picker.require_not('a', 5) and picker.require_not('b', 2)
+    assert len(picker) == 0 and list(picker) == []
+    assert picker.levels == [] and picker.buckets == {}
+
+
+def test_update_moves_required_pieces_between_levels():
+    picker = PiecePicker()
+    picker.add_file('a', 4)
+    for index in range(4):
+        picker.require('a', index)
+    picker.update('a', 1, 2)
+    picker.update('a', 2, 1)
+    assert picker.levels == [0, 1, 2]
+    assert picker.buckets[2] == {'a': {1}}
+    picker.update('a', 1, -2)
+    assert picker.levels == [0, 1]
+    # pieces not required keep their availability only
+    picker.require_not('a', 3)
+    picker.update('a', 3, 5)
+    assert int(picker.availability['a'][3]) == 5 and picker.levels == [0, 1]
+
+
+def test_pick_rarest_first():
+    picker = PiecePicker(sample=1)
+    picker.add_file('a', 6)
+    for index, count in enumerate([3, 1, 2, 0, 5, 1]):
+        picker.update('a', index, count)
+        picker.require('a', index)
+    everything = {'a': bits('111111')}
+    # pieces nobody is known to have come last
+    order = [picker.pick(everything) for _ in range(6)]
+    assert [int(picker.availability['a'][index]) for _, index in order] == [1, 1, 2, 3, 5, 0]
+    assert picker.pick(everything) is None
+    assert len(picker) == 0
+
+
+def test_pick_only_what_the_peer_has():
+    picker = PiecePicker(sample=10)
+    picker.add_file('a', 4)
+    for index in range(4):
+        picker.require('a', index)
+    assert picker.pick({'a': bits('0100')}) == ('a', 1)
+    assert picker.pick({'a': bits('0100')}) is None
+    assert picker.pick({'b': bits('1111')}) is None
+    # a bitfield shorter than the file
+    assert picker.pick({'a': bits('001')}) == ('a', 2)
+
+
+@pytest.mark.parametrize('density', [0.001, 0.01, 0.2, 1.0])
+def test_pick_against_brute_force(density):
+    rng = random.Random(int(density * 1000))
+    for trial in range(30):
+        picker = PiecePicker(sample=rng.choice([1, 3, 10]))
+        lengths = {file: rng.randint(1, 600) for file in 'abc'}
+        for file, n in lengths.items():
+            picker.add_file(file, n)
+            for _ in range(rng.randint(0, 4)):
+                picker.update_bitfield(file, bitarray.bitarray([rng.random() < 0.5 for _ in range(n)]), 1)
+            for index in range(n):
+                if rng.random() < 0.7:
+                    picker.require(file, index)
+        for _ in range(10):
+            peer = {file: bitarray.bitarray([rng.random() < density for _ in range(n - rng.randint(0, 3))])
+                    for file, n in lengths.items()}
+            expected = brute_force(picker, peer)
+            picked = picker.pick(peer)
+            if not expected:
+                assert picked is None
+                continue
+            # one of the `sample` rarest, taken off the required pieces
+            assert rarity(picker, *picked) <= expected[:picker.sample][-1]
+            assert picked not in picker and peer[picked[0]][picked[1]]
+
+
+def test_sparse_peer_is_looked_up(monkeypatch):
+    picker = PiecePicker(sample=1)
+    n = 10000
+    picker.add_file('a', n)
+    for index in range(n):
+        picker.require('a', index)
+        picker.update('a', index, 1 + index % 7)
+    peer = bitarray.bitarray(n)
+    peer.setall(False)
+    for index in (9991, 9994, 9996):
+        peer[index] = True
+    looked_up = []
+    look_up = PiecePicker._look_up
+    monkeypatch.setattr(PiecePicker, '_look_up', lambda self, bitfield: looked_up.append(1) or look_up(self, bitfield))
+    # the rarest level alone holds far more than MAX_BLIND_SCAN pieces the peer misses
+    assert picker.pick({'a': peer}) == ('a', 9996)
+    assert looked_up
+    assert picker.pick({'a': peer}) == ('a', 9991)
+    assert picker.pick({'a': peer}) == ('a', 9994)
+    assert picker.pick({'a': peer}) is None
+
+
+def check_buckets(picker):
+    for count in picker.levels:
+        for file, indices in picker.buckets[count].items():
+            assert indices
+            for index in indices:
+                assert int(picker.availability[file][index]) == count and picker.wanted[file][index]
+    assert sum(len(indices) for count in picker.levels for indices in picker.buckets[count].values()) == len(picker)
+
+
+def test_update_bitfield_join_and_leave():
+    rng = random.Random(5)
+    n = 1000
+    picker = PiecePicker()
+    picker.add_file('a', n)
+    for index in range(0, n, 3):
+        picker.require('a', index)
+    peers = [bitarray.bitarray([rng.random() < 0.5 for _ in range(n)]) for _ in range(6)]
+    expected = [0] * n
+    for bitfield in peers:
+        picker.update_bitfield('a', bitfield, 1)
+        for index in bitfield.search(1):
+            expected[index] += 1
+        assert picker.availability['a'].tolist() == expected
+        check_buckets(picker)
+    for bitfield in peers[::2]:
+        picker.update_bitfield('a', bitfield, -1)
+        for index in bitfield.search(1):
+            expected[index] -= 1
+        assert picker.availability['a'].tolist() == expected
+        check_buckets(picker)
+    for bitfield in peers[1::2]:
+        picker.update_bitfield('a', bitfield, -1)
+    assert not picker.availability['a'].any()
+    assert picker.levels == [0]
+    check_buckets(picker)
+
+
+def test_update_bitfield_grows_the_file():
+    picker = PiecePicker()
+    picker.add_file('a', 2)
+    picker.require('a', 1)
+    picker.update_bitfield('a', bits('01011'), 1)
+    assert picker.availability['a'].tolist() == [0, 1, 0, 1, 1]
+    assert picker.buckets[1] == {'a': {1}}
+    picker.require('a', 4)
+    assert picker.buckets[1] == {'a': {1, 4}}
+    check_buckets(picker)
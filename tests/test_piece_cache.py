@@ -0,0 +1,58 @@
+import pytest
+
+from piece_cache import PieceCache
+
+PIECE = b'x' * 100
+
+
+def test_lru_is_bounded_in_bytes():
+    cache = PieceCache(capacity=300)
+    for key in range(3):
+        cache.put(key, PIECE)
+    assert cache.get(0) == PIECE  # 1 is the least recently used now
+    cache.put(3, PIECE)
+    assert 1 not in cache and {0, 2, 3} <= set(cache.hot)
+    assert cache.size == 300 and cache.evictions == 1
+    # a piece that can never fit is not cached, rather than flushing everything
+    cache.put(4, b'y' * 301)
+    assert 4 not in cache and len(cache) == 3
+
+
+def test_2q_keeps_pieces_read_again_through_a_scan():
+    cache = PieceCache(capacity=1000, policy="2q")
+    # the first reads only go into `new`, a read again after falling out of it promotes into `hot`
+    for key in range(10):
+        cache.put(key, PIECE)
+    for key in range(10, 15):
+        cache.put(key, PIECE)
+    assert list(cache.ghosts) == [0, 1, 2, 3, 4]
+    for key in range(3):
+        cache.put(key, PIECE)
+    assert list(cache.hot) == [0, 1, 2]
+
+    # a pass over many pieces read once cycles through `new` and leaves `hot` alone
+    for key in range(100, 200):
+        cache.put(key, PIECE)
+    assert list(cache.hot) == [0, 1, 2]
+    assert cache.size <= 1000
+    assert len(cache.ghosts) <= max(1, len(cache) // 2)
+    assert all(cache.get(key) == PIECE for key in range(3))
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (3, 0)
+    # 5 to make room for pieces 10 to 14, 3 for the promoted ones and one for each piece of the pass
+    assert stats['evictions'] == 5 + 3 + 100
+
+
+def test_lru_flushes_everything_on_a_scan():
+    cache = PieceCache(capacity=1000, policy="lru")
+    for key in range(3):
+        cache.put(key, PIECE)
+    for key in range(100, 200):
+        cache.put(key, PIECE)
+    assert not any(key in cache for key in range(3))
+    assert cache.get(0) is None and cache.stats()['hit_rate'] == 0.0
+
+
+def test_invalid_policy():
+    with pytest.raises(ValueError):
+        PieceCache(policy="fifo")
@@ -0,0 +1,65 @@
+import os
+import threading
+import time
+
+import pytest
+
+from piece_manager import PieceManager
+
+PIECE_LEN = 4096
+
+
+def seed(base_dir, name='data.bin', size=10 * PIECE_LEN + 123, **kwargs):
+    os.makedirs(base_dir, exist_ok=True)
+    data = os.urandom(size)
+    with open(os.path.join(base_dir, name), 'wb') as f:
+        f.write(data)
+    return PieceManager(f'{base_dir}/', piece_len=PIECE_LEN, **kwargs), data
+
+
+@pytest.fixture
+def swarm(tmp_path):
+    seeder, data = seed(f'{tmp_path}/seeder')
+    os.makedirs(f'{tmp_path}/leecher')
+    leecher = PieceManager(f'{tmp_path}/leecher/', piece_len=PIECE_LEN)
+    leecher.add_file(torrent=seeder.torrents['data.bin'])
+    yield seeder, leecher, data
+    seeder.close()
+    leecher.close()
+
+
+def test_write_piece_once_when_copies_race(swarm):
+    seeder, leecher, _ = swarm
+    piece = seeder.read_piece('data.bin', 3)
+    announced = []
+    leecher.add_listener(lambda file, index: announced.append((file, index)))
+    storage = leecher.storage['data.bin']
+    writes = []
+    write = storage.write_piece
+
+    def slow_write(index, data):
+        writes.append(index)
+        time.sleep(0.05)  # both copies pass the hash check meanwhile
+        write(index, data)
+
+    storage.write_piece = slow_write
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(leecher.write_piece('data.bin', 3, piece)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [True] * 4
+    assert writes == [3] and announced == [('data.bin', 3)]
+    assert leecher.bitfield['data.bin'][3] and not leecher.writing
+    assert leecher.read_piece('data.bin', 3) == piece
+
+
+def test_write_piece_rejects_bad_copies(swarm):
+    seeder, leecher, _ = swarm
+    piece = seeder.read_piece('data.bin', 2)
+    assert leecher.write_piece('data.bin', 2, b'\0' * len(piece)) is False
+    assert not leecher.bitfield['data.bin'][2]
+    assert leecher.write_piece('data.bin', 2, piece) is True
+    assert leecher.bitfield['data.bin'][2]
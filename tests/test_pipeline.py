@@ -0,0 +1,71 @@
+import heapq
+import math
+
+import pytest
+
+from pipeline import RequestPipeline
+
+SIZE = 16384
+
+
+def simulate(pipeline, bandwidth, delay, steps=3000):
+    """
+    Keep the pipeline full over a link that answers in order at `bandwidth` bytes per second after `delay` seconds
+    """
+    now, link_free, n = 0.0, 0.0, 0
+    arrivals = []
+    for _ in range(steps):
+        while pipeline.free:
+            done = max(now + delay / 2, link_free) + SIZE / bandwidth
+            link_free = done
+            heapq.heappush(arrivals, (done + delay / 2, n))
+            pipeline.add(n, now)
+            n += 1
+        now, key = heapq.heappop(arrivals)
+        pipeline.complete(key, SIZE, now)
+    return pipeline
+
+
+@pytest.mark.parametrize('bandwidth, delay', [(1e6, 0.1), (1e6, 0.01), (4e6, 0.05), (2e5, 0.2)])
+def test_depth_follows_the_bandwidth_delay_product(bandwidth, delay):
+    pipeline = simulate(RequestPipeline(), bandwidth, delay)
+    # a round trip takes the delay and the time to send one piece
+    bdp = bandwidth * (delay + SIZE / bandwidth) / SIZE
+    assert math.isclose(pipeline.rate, bandwidth, rel_tol=0.05)
+    assert delay <= pipeline.rtt <= 1.25 * (delay + SIZE / bandwidth)
+    # enough to keep the link busy, without growing on the queue it builds
+    assert bdp <= pipeline.depth <= math.ceil(2.5 * bdp) + 1 < pipeline.max_depth
+
+
+def test_depth_is_bounded():
+    assert simulate(RequestPipeline(max_depth=8), 4e6, 0.1).depth == 8
+    assert simulate(RequestPipeline(min_depth=6), 1e6, 0.001).depth == 6
+    fixed = simulate(RequestPipeline(depth=3), 1e6, 0.1)
+    assert fixed.depth == 3 and fixed.rate is not None
+    pipeline = RequestPipeline()
+    pipeline.limit(1)
+    assert simulate(pipeline, 1e6, 0.1).depth == 1
+
+
+def test_delay_rises_only_through_requests_with_nothing_ahead():
+    pipeline = RequestPipeline()
+    pipeline.add('a', now=0.0)
+    pipeline.add('b', now=0.0)
+    assert pipeline.complete('a', SIZE, now=0.1)
+    assert pipeline.complete('b', SIZE, now=0.5)
+    assert pipeline.rtt == 0.1
+    pipeline.add('c', now=1.0)
+    assert pipeline.complete('c', SIZE, now=1.5)
+    assert math.isclose(pipeline.rtt, 0.1 + 0.4 / 16)
+    assert not pipeline.complete('c', SIZE, now=2.0)
+
+
+def test_drop():
+    pipeline = RequestPipeline()
+    for key in [('a', 0), ('a', 1), ('b', 0)]:
+        pipeline.add(key)
+    assert pipeline.free == 1
+    assert pipeline.drop(lambda key: key[0] == 'a') == [('a', 0), ('a', 1)]
+    assert ('b', 0) in pipeline and len(pipeline) == 1
+    assert pipeline.drop_all() == [('b', 0)]
+    assert pipeline.window_start is None
@@ -0,0 +1,48 @@
+import os
+import socket
+import threading
+
+from components.rdt_socket import rdt_socket, INITIAL_BUFFER_SIZE, RECV_BUFFER_SIZE
+
+
+def exchange(frames, **kwargs):
+    a, b = socket.socketpair()
+    try:
+        sender = threading.Thread(target=lambda: [rdt_socket(a).sendBytes(frame) for frame in frames])
+        sender.start()
+        rdt = rdt_socket(b, **kwargs)
+        sizes = []
+        received = []
+        for _ in frames:
+            received.append(rdt.recvBytes())
+            sizes.append(len(rdt.databuf))
+        sender.join()
+        return received, sizes
+    finally:
+        a.close()
+        b.close()
+
+
+def test_short_frames_keep_the_small_arena():
+    frames = [os.urandom(n) for n in (0, 1, 100, 5000, INITIAL_BUFFER_SIZE - 8)] * 20
+    received, sizes = exchange(frames)
+    assert received == frames
+    assert set(sizes) == {INITIAL_BUFFER_SIZE}
+
+
+def test_arena_grows_up_to_its_limit():
+    frames = [b'head', os.urandom(100 * 1024), b'tail', os.urandom(RECV_BUFFER_SIZE - 8),
+              os.urandom(3 * RECV_BUFFER_SIZE), b'end']
+    received, sizes = exchange(frames)
+    assert received == frames
+    assert sizes[:2] == [INITIAL_BUFFER_SIZE, 128 * 1024]
+    # larger frames get a buffer of their own, the arena stays at its limit
+    assert sizes[3:] == [RECV_BUFFER_SIZE] * 3
+    assert all(type(body) is bytearray for body in received)
+
+
+def test_small_limit():
+    frames = [os.urandom(n) for n in (10, 4096, 10, 20000)]
+    received, sizes = exchange(frames, buffer_size=4096)
+    assert received == frames
+    assert max(sizes) == 4096
@@ -0,0 +1,109 @@
+import os
+
+import bitarray
+
+from piece_manager import PieceManager
+from resume import ResumeData, fingerprint
+from storage import PART_SUFFIX
+from torrent import Torrent
+
+PIECE_LEN = 4096
+LENGTH = 3 * PIECE_LEN + 10
+
+
+def test_fingerprint_follows_size_and_mtime(tmp_path):
+    path = f'{tmp_path}/data.bin'
+    assert fingerprint(path) is None
+    with open(path, 'wb') as f:
+        f.write(b'a' * 10)
+    first = fingerprint(path)
+    assert first['size'] == 10
+    os.utime(path, ns=(first['mtime_ns'] + 10 ** 9, first['mtime_ns'] + 10 ** 9))
+    assert fingerprint(path) != first
+    with open(path, 'ab') as f:
+        f.write(b'b')
+    assert fingerprint(path)['size'] == 11
+
+
+def test_record_round_trip(tmp_path):
+    path = f'{tmp_path}/data.bin'
+    with open(path, 'wb') as f:
+        f.write(os.urandom(LENGTH))
+    torrent = Torrent(piece_len=PIECE_LEN)
+    torrent.make_torrent('data.bin', path, f'{tmp_path}/')
+    bitfield = bitarray.bitarray('1011')
+    resume = ResumeData(f'{tmp_path}/')
+    resume.save('data.bin', torrent, bitfield, False, path)
+    record = resume.load('data.bin')
+    assert resume.files() == ['data.bin']
+    assert resume.bitfield(record) == bitfield
+    assert resume.fresh(record, path)
+    with open(path, 'ab') as f:
+        f.write(b'x')
+    assert not resume.fresh(record, path)
+    resume.remove('data.bin')
+    assert resume.load('data.bin') is None and resume.files() == []
+
+
+def test_records_of_another_version_are_ignored(tmp_path):
+    resume = ResumeData(f'{tmp_path}/')
+    os.makedirs(resume.folder)
+    with open(resume.path('data.bin'), 'w') as f:
+        f.write('{"version": 0}')
+    assert resume.load('data.bin') is None
+    with open(resume.path('data.bin'), 'w') as f:
+        f.write('{"torn')
+    assert resume.load('data.bin') is None
+
+
+def count_hashing(monkeypatch):
+    hashed = []
+    check_file, make_torrent = PieceManager.check_file, Torrent.make_torrent
+    monkeypatch.setattr(PieceManager, 'check_file',
+                        lambda self, torrent, path: hashed.append(path) or check_file(self, torrent, path))
+    monkeypatch.setattr(Torrent, 'make_torrent',
+                        lambda self, file, path, base_dir: hashed.append(path) or make_torrent(self, file, path, base_dir))
+    return hashed
+
+
+def test_restart_hashes_only_changed_files(tmp_path, monkeypatch):
+    base_dir = f'{tmp_path}/seeder/'
+    os.makedirs(base_dir)
+    for name in ('a.bin', 'b.bin'):
+        with open(base_dir + name, 'wb') as f:
+            f.write(os.urandom(LENGTH))
+    PieceManager(base_dir, piece_len=PIECE_LEN).close()
+
+    hashed = count_hashing(monkeypatch)
+    PieceManager(base_dir, piece_len=PIECE_LEN).close()
+    assert hashed == []
+
+    with open(base_dir + 'b.bin', 'r+b') as f:
+        f.write(b'changed')
+    pieces = PieceManager(base_dir, piece_len=PIECE_LEN)
+    pieces.close()
+    assert {os.path.basename(path) for path in hashed} == {'b.bin'}
+    assert pieces.bitfield['b.bin'].all()
+
+
+def test_unfinished_download_resumes_from_its_record(tmp_path, monkeypatch):
+    os.makedirs(f'{tmp_path}/seeder')
+    with open(f'{tmp_path}/seeder/data.bin', 'wb') as f:
+        f.write(os.urandom(LENGTH))
+    seeder = PieceManager(f'{tmp_path}/seeder/', piece_len=PIECE_LEN)
+    os.makedirs(f'{tmp_path}/leecher')
+    leecher = PieceManager(f'{tmp_path}/leecher/', piece_len=PIECE_LEN)
+    leecher.add_file(torrent=seeder.torrents['data.bin'])
+    assert leecher.write_piece('data.bin', 1, bytes(seeder.read_piece('data.bin', 1)))
+    leecher.close()
+    seeder.close()
+    assert os.path.exists(f'{tmp_path}/leecher/data.bin' + PART_SUFFIX)
+
+    hashed = count_hashing(monkeypatch)
+    leecher = PieceManager(f'{tmp_path}/leecher/', piece_len=PIECE_LEN)
+    try:
+        assert hashed == []
+        assert leecher.bitfield['data.bin'].tolist() == [False, True, False, False]
+        assert sorted(index for file, index in leecher.required_pieces) == [0, 2, 3]
+    finally:
+        leecher.close()
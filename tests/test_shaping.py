@@ -0,0 +1,64 @@
+import math
+
+import pytest
+
+from components.shaping import TokenBucket, Shaper, UP, DOWN
+
+
+def test_bucket_refills_at_its_rate_up_to_the_burst():
+    bucket = TokenBucket(rate=1000, burst=500)
+    bucket.last = 0.0
+    assert bucket.charge(500, now=0.0) == 0.0
+    # in debt, the wait is what the debt takes to pay off
+    assert math.isclose(bucket.charge(300, now=0.0), 0.3)
+    assert math.isclose(bucket.charge(0, now=0.3), 0.0)
+    assert math.isclose(bucket.charge(200, now=0.5), 0.0)
+    # an idle spell refills no more than the burst
+    assert bucket.charge(500, now=100.0) == 0.0
+    assert math.isclose(bucket.charge(100, now=100.0), 0.1)
+
+
+def test_default_burst_and_no_limit():
+    assert TokenBucket(rate=400 * 1024).burst == 100 * 1024
+    assert TokenBucket(rate=1000).burst == 16 * 1024
+    bucket = TokenBucket()
+    assert bucket.charge(10 ** 9) == 0.0
+    bucket.set_rate(1000, burst=100)
+    # the tokens of the unlimited bucket do not carry over past the new burst
+    assert bucket.tokens == 100
+    bucket.set_rate(0)
+    assert bucket.rate is None and bucket.charge(10 ** 9) == 0.0
+
+
+def drain(bucket):
+    bucket.tokens = bucket.burst = 0
+
+
+def test_connections_share_the_global_bucket():
+    shaper = Shaper(up=1000, peer_up=10 ** 6)
+    drain(shaper.buckets[UP])
+    first, second = shaper.connection(), shaper.connection()
+    assert math.isclose(first.charge(UP, 1000), 1.0, rel_tol=0.05)
+    assert math.isclose(second.charge(UP, 1000), 2.0, rel_tol=0.05)
+    assert first.charge(DOWN, 10 ** 6) == 0.0
+
+
+def test_torrent_limits_only_charge_their_file():
+    shaper = Shaper()
+    shaper.set_limit('data.bin', UP, 100)
+    drain(shaper.torrent('data.bin')[UP])
+    connection = shaper.connection()
+    assert math.isclose(connection.charge(UP, 100, {'file': 'data.bin'}), 1.0, rel_tol=0.05)
+    assert connection.charge(UP, 100, {'file': 'other.bin'}) == 0.0
+    assert connection.charge(UP, 100) == 0.0
+
+
+def test_peer_limits_reach_open_connections():
+    shaper = Shaper()
+    connection = shaper.connection()
+    shaper.set_limit('peer', DOWN, 500)
+    assert connection.buckets[DOWN].rate == 500
+    assert shaper.connection().buckets[DOWN].rate == 500
+    assert shaper.limits()['peer'] == {UP: None, DOWN: 500}
+    with pytest.raises(ValueError):
+        shaper.set_limit('global', 'sideways', 10)
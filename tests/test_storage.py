@@ -0,0 +1,128 @@
+import os
+
+from piece_manager import PieceManager
+from storage import FileStorage, MmapFileStorage, PART_SUFFIX
+
+PIECE_LEN = 4096
+LENGTH = 2 * PIECE_LEN + 100
+
+
+def test_part_file_is_preallocated(tmp_path):
+    path = f'{tmp_path}/data.bin'
+    storage = FileStorage(path, LENGTH, PIECE_LEN)
+    try:
+        assert not os.path.exists(path)
+        assert os.path.getsize(path + PART_SUFFIX) == LENGTH
+        assert storage.piece_range(2) == (2 * PIECE_LEN, 100)
+        # pieces land at their own offsets, in any order
+        tail = os.urandom(100)
+        storage.write_piece(2, tail)
+        storage.write_piece(0, b'a' * PIECE_LEN)
+        assert storage.read_piece(2) == tail
+        assert storage.read_piece(1) == bytes(PIECE_LEN)
+        assert os.path.getsize(path + PART_SUFFIX) == LENGTH
+    finally:
+        storage.close()
+
+
+def test_finalize_renames_once(tmp_path):
+    path = f'{tmp_path}/data.bin'
+    storage = FileStorage(path, LENGTH, PIECE_LEN)
+    try:
+        storage.write_piece(1, b'b' * PIECE_LEN)
+        assert storage.finalize()
+        assert not storage.finalize()
+        assert os.path.exists(path) and not os.path.exists(path + PART_SUFFIX)
+        assert storage.current_path == path
+        # the descriptor outlives the rename
+        assert storage.read_piece(1) == b'b' * PIECE_LEN
+    finally:
+        storage.close()
+
+
+def make_swarm(tmp_path):
+    os.makedirs(f'{tmp_path}/seeder')
+    os.makedirs(f'{tmp_path}/leecher')
+    data = os.urandom(LENGTH)
+    with open(f'{tmp_path}/seeder/data.bin', 'wb') as f:
+        f.write(data)
+    seeder = PieceManager(f'{tmp_path}/seeder/', piece_len=PIECE_LEN)
+    return seeder, data
+
+
+def test_download_is_written_in_place(tmp_path):
+    seeder, data = make_swarm(tmp_path)
+    leecher = PieceManager(f'{tmp_path}/leecher/', piece_len=PIECE_LEN)
+    try:
+        leecher.add_file(torrent=seeder.torrents['data.bin'])
+        path = f'{tmp_path}/leecher/data.bin'
+        for index in (2, 0, 1):
+            assert not os.path.exists(path)
+            assert leecher.write_piece('data.bin', index, bytes(seeder.read_piece('data.bin', index)))
+        assert not os.path.exists(path + PART_SUFFIX)
+        with open(path, 'rb') as f:
+            assert f.read() == data
+    finally:
+        seeder.close()
+        leecher.close()
+
+
+def test_legacy_pieces_are_migrated(tmp_path):
+    seeder, data = make_swarm(tmp_path)
+    # a download left by the older layout, a file for each piece in [base_dir]/.pieces
+    os.makedirs(f'{tmp_path}/leecher/.pieces')
+    with open(f'{tmp_path}/leecher/.pieces/data.bin.1', 'wb') as f:
+        f.write(data[PIECE_LEN:2 * PIECE_LEN])
+    leecher = PieceManager(f'{tmp_path}/leecher/', piece_len=PIECE_LEN)
+    try:
+        leecher.add_file(torrent=seeder.torrents['data.bin'])
+        assert leecher.bitfield['data.bin'].tolist() == [False, True, False]
+        assert bytes(leecher.read_piece('data.bin', 1)) == data[PIECE_LEN:2 * PIECE_LEN]
+        assert not os.path.exists(f'{tmp_path}/leecher/.pieces')
+    finally:
+        seeder.close()
+        leecher.close()
+
+
+def test_mmap_reads_are_views_of_the_file(tmp_path):
+    path = f'{tmp_path}/data.bin'
+    data = os.urandom(LENGTH)
+    with open(path, 'wb') as f:
+        f.write(data)
+    storage = MmapFileStorage(path, LENGTH, PIECE_LEN, complete=True)
+    try:
+        piece = storage.read_piece(1)
+        assert isinstance(piece, memoryview)
+        assert piece == data[PIECE_LEN:2 * PIECE_LEN]
+        assert storage.read_piece(2) == data[2 * PIECE_LEN:]
+        piece.release()
+    finally:
+        storage.close()
+
+
+def test_mmap_sees_pieces_written_after_mapping(tmp_path):
+    storage = MmapFileStorage(f'{tmp_path}/data.bin', LENGTH, PIECE_LEN)
+    held = storage.read_piece(0)
+    storage.write_piece(0, b'c' * PIECE_LEN)
+    assert held == b'c' * PIECE_LEN
+    # a view handed out keeps its map alive past the close, which lets go of it once the view is gone
+    storage.close()
+    assert held == b'c' * PIECE_LEN and len(storage.retired) == 1
+    held.release()
+    storage.release_retired()
+    assert storage.retired == []
+
+
+def test_mmap_mode_reports_no_cache_stats(tmp_path):
+    seeder, data = make_swarm(tmp_path)
+    leecher = PieceManager(f'{tmp_path}/leecher/', piece_len=PIECE_LEN, storage_mode="mmap")
+    try:
+        leecher.add_file(torrent=seeder.torrents['data.bin'])
+        assert leecher.write_piece('data.bin', 0, bytes(seeder.read_piece('data.bin', 0)))
+        assert leecher.read_piece('data.bin', 0) == data[:PIECE_LEN]
+        assert len(leecher.piece_buffer) == 0
+        assert leecher.cache_stats() is None and leecher.stats()['cache'] is None
+        assert seeder.cache_stats()['hits'] + seeder.cache_stats()['misses'] > 0
+    finally:
+        seeder.close()
+        leecher.close()
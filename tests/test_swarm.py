@@ -0,0 +1,88 @@
+import random
+
+from swarm import Swarm, EncodedPeer, encode_peers, unpack_peers, pack_peers, PEER_FLAGS
+
+
+def make_peer(i, left=100, extensions=()):
+    return {'peer_id': f'10.0.{i // 256}.{i % 256}:6881', 'ip': f'10.0.{i // 256}.{i % 256}', 'port': 6881,
+            'left': left, 'extensions': list(extensions)}
+
+
+def check(swarm):
+    assert len(swarm.ids) == len(swarm.encoded) == len(swarm.index) == len(swarm.peers)
+    for position, peer_id in enumerate(swarm.ids):
+        assert swarm.index[peer_id] == position
+        encoded = swarm.encoded[position]
+        assert encoded is None or encoded.peer_id == peer_id
+    assert swarm.seeders == sum(peer.get('left') == 0 for peer in swarm.peers.values())
+
+
+def test_swap_remove_keeps_encoded_and_seeders():
+    swarm = Swarm()
+    for i in range(6):
+        swarm.add(make_peer(i, left=0 if i % 2 else 100))
+    swarm.sample_encoded(6)
+    check(swarm)
+    assert (swarm.seeders, swarm.leechers) == (3, 3)
+
+    # the last peer moves into the place of the one that leaves, its encoding with it
+    first, last = swarm.ids[0], swarm.ids[-1]
+    swarm.remove(first)
+    assert swarm.ids[0] == last
+    check(swarm)
+    # the last one itself
+    swarm.remove(swarm.ids[-1])
+    check(swarm)
+    assert swarm.remove('nobody') is None
+    assert len(swarm) == 4
+
+
+def test_random_churn():
+    rng = random.Random(2)
+    swarm = Swarm()
+    for _ in range(2000):
+        i = rng.randrange(50)
+        peer = make_peer(i, left=rng.choice([0, 10]))
+        if rng.random() < 0.4:
+            swarm.remove(peer['peer_id'])
+        else:
+            swarm.add(peer)
+        if rng.random() < 0.3:
+            sampled = swarm.sample_encoded(rng.randrange(1, 10))
+            assert len({encoded.peer_id for encoded in sampled}) == len(sampled)
+        check(swarm)
+
+
+def test_readd_drops_stale_encoding():
+    swarm = Swarm()
+    swarm.add(make_peer(1))
+    swarm.sample_encoded(1)
+    assert swarm.encoded[0] is not None
+    swarm.add(make_peer(1))
+    assert swarm.encoded[0] is not None  # nothing new
+    swarm.add(make_peer(1, left=0))
+    assert swarm.encoded[0] is None and swarm.seeders == 1
+    check(swarm)
+
+
+def test_sample_excludes_the_asking_peer():
+    swarm = Swarm()
+    for i in range(5):
+        swarm.add(make_peer(i))
+    asking = make_peer(2)['peer_id']
+    for _ in range(20):
+        assert asking not in [peer['peer_id'] for peer in swarm.sample(10, exclude=asking)]
+    assert len(swarm.sample(10, exclude=asking)) == 4
+    assert len(swarm.sample(3)) == 3
+
+
+def test_compact_list_carries_extensions():
+    peers = [make_peer(1, extensions=PEER_FLAGS), make_peer(2), make_peer(3, extensions=['blocks'])]
+    encoded = [EncodedPeer(peer) for peer in peers]
+    body = encode_peers(encoded, compact=True)
+    assert body.startswith(b'"peers":"BYTES')
+    flags = body.split(b'"peer_flags":"')[1].rstrip(b'"').decode()
+    unpacked = unpack_peers(pack_peers(peers), flags)
+    assert [unpacked[peer['peer_id']]['extensions'] for peer in peers] == [PEER_FLAGS, [], ['blocks']]
+    # a list without flags, from an older tracker
+    assert 'extensions' not in unpack_peers(pack_peers(peers))[peers[0]['peer_id']]
@@ -0,0 +1,58 @@
+from timing_wheel import TimingWheel
+
+
+def test_expires_at_deadline():
+    wheel = TimingWheel(10, tick=1.0)
+    wheel.schedule('a', 3)
+    assert wheel.advance(2.5) == []
+    assert wheel.advance(3) == ['a']
+    assert 'a' not in wheel and len(wheel) == 0
+
+
+def test_expires_a_full_rotation_ahead():
+    wheel = TimingWheel(10, tick=1.0)
+    rotation = wheel.slots * wheel.tick
+    wheel.schedule('turn', rotation)
+    wheel.schedule('past', rotation + 2)
+    wheel.schedule('far', 3 * rotation + 1)
+    # the slots of these deadlines come round before they are due
+    assert wheel.advance(rotation - 1) == []
+    assert wheel.advance(rotation) == ['turn']
+    assert wheel.advance(rotation + 1) == []
+    assert wheel.advance(2 * rotation + 1) == ['past']
+    assert wheel.advance(3 * rotation + 1) == ['far']
+    assert len(wheel) == 0
+
+
+def test_advance_past_a_full_rotation_at_once():
+    wheel = TimingWheel(10, tick=1.0)
+    for i in range(30):
+        wheel.schedule(i, i)
+    assert sorted(wheel.advance(25)) == list(range(26))
+    assert sorted(wheel.advance(100)) == list(range(26, 30))
+
+
+def test_reschedule_moves_the_deadline():
+    wheel = TimingWheel(10, tick=1.0)
+    wheel.schedule('a', 2)
+    wheel.schedule('a', 5)
+    assert len(wheel) == 1
+    assert wheel.advance(4) == []
+    assert wheel.advance(5) == ['a']
+
+    wheel.schedule('b', 9)
+    wheel.schedule('b', 7)
+    assert wheel.advance(7) == ['b']
+    assert wheel.advance(9) == []
+
+
+def test_cancel_and_past_deadlines():
+    wheel = TimingWheel(10, tick=0.5, now=100)
+    wheel.schedule('gone', 101)
+    wheel.cancel('gone')
+    wheel.cancel('never scheduled')
+    # a deadline that passed already is due at the next advance
+    wheel.schedule('late', 50)
+    assert wheel.advance(100) == ['late']
+    assert wheel.advance(102) == []
+    assert wheel.advance(99) == []
@@ -0,0 +1,157 @@
+import socket
+import struct
+
+import pytest
+
+from tracker import Tracker
+from swarm import unpack_peers
+from udp_tracker import HEADER, CONNECT_RESPONSE, ANNOUNCE, ANNOUNCE_RESPONSE, SCRAPE_ENTRY, RESPONSE_HEADER, \
+    PROTOCOL_ID, ACTION_CONNECT, ACTION_ANNOUNCE, ACTION_SCRAPE, ACTION_ERROR, EVENT_IDS, ConnectionIds, \
+    pack_info_hash, unpack_info_hash, pack_error
+
+ADDRESS = ('10.0.0.1', 6881)
+INFO_HASH = 'ab' * 20
+
+
+def test_packet_sizes():
+    # the layouts of BEP 15
+    assert HEADER.size == 16
+    assert CONNECT_RESPONSE.size == 16
+    assert HEADER.size + ANNOUNCE.size == 98
+    assert ANNOUNCE_RESPONSE.size == 20
+    assert SCRAPE_ENTRY.size == 12
+    assert HEADER.pack(PROTOCOL_ID, ACTION_CONNECT, 1)[:8] == bytes.fromhex('0000041727101980')
+
+
+def test_info_hash_and_error_packing():
+    assert unpack_info_hash(pack_info_hash(INFO_HASH)) == INFO_HASH
+    assert pack_info_hash('') == bytes(20)
+    assert unpack_info_hash(bytes(20)) == ''
+    error = pack_error(7, 'Invalid connection id')
+    assert RESPONSE_HEADER.unpack_from(error) == (ACTION_ERROR, 7)
+    assert error[RESPONSE_HEADER.size:] == b'Invalid connection id'
+
+
+def test_connection_ids_valid_for_one_to_two_periods():
+    ids = ConnectionIds(lifetime=60)
+    connection_id = ids.issue(ADDRESS, now=120)
+    assert ids.valid(connection_id, ADDRESS, now=120)
+    assert ids.valid(connection_id, ADDRESS, now=179.9)
+    assert ids.valid(connection_id, ADDRESS, now=239.9)
+    assert not ids.valid(connection_id, ADDRESS, now=240)
+    assert not ids.valid(connection_id, ('10.0.0.1', 6882), now=120)
+    assert not ids.valid(connection_id, ('10.0.0.2', 6881), now=120)
+    # ids are keyed by a secret of each tracker
+    assert not ConnectionIds(lifetime=60).valid(connection_id, ADDRESS, now=120)
+
+
+@pytest.fixture
+def tracker(tmp_path):
+    tracker = Tracker('test', base_dir=f'{tmp_path}/', host='127.0.0.1', port=0, udp=False, log_level='error')
+    yield tracker
+    tracker.logger.close()
+
+
+def connect(tracker, address=ADDRESS):
+    data = tracker.respond_udp(HEADER.pack(PROTOCOL_ID, ACTION_CONNECT, 11), address)
+    action, transaction_id, connection_id = CONNECT_RESPONSE.unpack(data)
+    assert (action, transaction_id) == (ACTION_CONNECT, 11)
+    return connection_id
+
+
+def announce(tracker, connection_id, port, event=None, left=100, address=ADDRESS, transaction_id=12):
+    ip, = struct.unpack('!I', socket.inet_aton(address[0]))
+    package = HEADER.pack(connection_id, ACTION_ANNOUNCE, transaction_id) + ANNOUNCE.pack(
+        pack_info_hash(INFO_HASH), bytes(20), 0, left, 0, EVENT_IDS[event], ip, 0, -1, port)
+    return tracker.respond_udp(package, address)
+
+
+def test_announce_and_scrape(tracker):
+    connection_id = connect(tracker)
+    announce(tracker, connection_id, 7001, 'started')
+    announce(tracker, connection_id, 7002, 'started', left=0)
+    data = announce(tracker, connection_id, 7003, 'started')
+    action, transaction_id, interval, leechers, seeders = ANNOUNCE_RESPONSE.unpack_from(data)
+    assert (action, transaction_id, interval) == (ACTION_ANNOUNCE, 12, tracker.interval)
+    assert (leechers, seeders) == (2, 1)
+    peers = unpack_peers(data[ANNOUNCE_RESPONSE.size:])
+    assert sorted(peers) == ['10.0.0.1:7001', '10.0.0.1:7002']
+
+    data = announce(tracker, connection_id, 7003, 'stopped')
+    assert ANNOUNCE_RESPONSE.unpack_from(data)[3:] == (1, 1)
+
+    package = HEADER.pack(connection_id, ACTION_SCRAPE, 13) + pack_info_hash(INFO_HASH) + pack_info_hash('cd' * 20)
+    data = tracker.respond_udp(package, ADDRESS)
+    assert RESPONSE_HEADER.unpack_from(data) == (ACTION_SCRAPE, 13)
+    assert SCRAPE_ENTRY.unpack_from(data, RESPONSE_HEADER.size) == (1, 0, 1)
+    assert SCRAPE_ENTRY.unpack_from(data, RESPONSE_HEADER.size + SCRAPE_ENTRY.size) == (0, 0, 0)
+
+
+def test_invalid_connection_ids_are_refused(tracker):
+    connection_id = connect(tracker)
+    data = announce(tracker, connection_id ^ 1, 7001, 'started')
+    assert RESPONSE_HEADER.unpack_from(data) == (ACTION_ERROR, 12)
+    # an id is bound to the address it was issued to
+    data = announce(tracker, connection_id, 7001, 'started', address=('10.0.0.2', 6881))
+    assert RESPONSE_HEADER.unpack_from(data)[0] == ACTION_ERROR
+    # a connect request needs the protocol id, and a short datagram gets no answer
+    assert tracker.respond_udp(HEADER.pack(0, ACTION_CONNECT, 1), ADDRESS) is None
+    assert tracker.respond_udp(b'\0' * 8, ADDRESS) is None
+    assert RESPONSE_HEADER.unpack_from(tracker.respond_udp(HEADER.pack(connection_id, ACTION_ANNOUNCE, 3),
+                                                           ADDRESS)) == (ACTION_ERROR, 3)
+
+
+def test_started_from_a_peer_in_the_swarm_is_refused(tracker):
+    connection_id = connect(tracker)
+    announce(tracker, connection_id, 7001, 'started')
+    data = announce(tracker, connection_id, 7001, 'started', transaction_id=13)
+    assert RESPONSE_HEADER.unpack_from(data) == (ACTION_ERROR, 13)
+    assert data[RESPONSE_HEADER.size:] == b"You're already in the network!"
+    # as it is over TCP, where the peer joined already
+    response = tracker.respond({'event': 'started', 'info_hash': INFO_HASH, 'peer_id': '10.0.0.1:7001',
+                                'ip': '10.0.0.1', 'port': 7001}, None)
+    assert response['error_code'] == 1
+    data = announce(tracker, connection_id, 7001)
+    assert ANNOUNCE_RESPONSE.unpack_from(data)[0] == ACTION_ANNOUNCE
+
+
+class FailingUdpTracker:
+    def announce(self, *args, **kwargs):
+        raise socket.timeout()
+
+    def close(self):
+        pass
+
+
+class RecordingClient:
+    clients = []
+
+    def __init__(self, host, port, log=None):
+        self.files = []
+        self.started = 0
+        RecordingClient.clients.append(self)
+
+    def send_file(self, file, recv_fn=None):
+        self.files.append(file)
+
+    def start(self):
+        self.started += 1
+
+
+def test_reannounce_falls_back_to_one_tcp_client(tmp_path):
+    from peer import Peer
+    peer = Peer('peer', f'{tmp_path}/', '127.0.0.1', 0)
+    try:
+        peer.client_cls = RecordingClient
+        peer.tracker_host, peer.tracker_port = '127.0.0.1', 1
+        peer.announce_interval = 60
+        peer.udpTracker = FailingUdpTracker()
+        peer.reannounce()
+        peer.reannounce()
+        client, = RecordingClient.clients
+        assert client.started == 1
+        assert [file['event'] for file in client.files] == ['', '']
+        assert peer.udpTracker is None
+    finally:
+        peer.server.serverSocket.close()
+        peer.logger.close()